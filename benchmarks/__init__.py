@@ -0,0 +1 @@
+# Benchmarks of npttf2utf, run with: python -m benchmarks --help
@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+# The benchmarks run against the package of this checkout unless another one is installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "src"))
+
+from . import suite
+from .corpus import DEFAULT_SEED
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Measure the throughput and peak memory of npttf2utf on synthetic "
+                                                 "inputs, and optionally fail on a regression against a baseline")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("-b", "--baseline", help="JSON results to compare with, exits with status 1 on a regression")
+    parser.add_argument("-t", "--threshold", type=float,
+                        help="Largest accepted throughput drop against the baseline, as a fraction (default: {}, {} "
+                             "with --quick)".format(suite.DEFAULT_THRESHOLD, suite.QUICK_THRESHOLD))
+    parser.add_argument("-mt", "--memory-threshold", type=float,
+                        help="Largest accepted peak memory growth against the baseline, as a fraction (default: "
+                             "the throughput threshold)")
+    parser.add_argument("-k", "--filter", action="append",
+                        help="Only run the benchmarks whose name contains this text, can be repeated")
+    parser.add_argument("-q", "--quick", action="store_true", help="Use small inputs for a fast check")
+    parser.add_argument("-r", "--repeat", type=int, help="Number of timed runs of each benchmark, the best is kept")
+    parser.add_argument("-s", "--seed", type=int, default=DEFAULT_SEED, help="Seed of the synthetic inputs")
+    parser.add_argument("-c", "--corpus-dir", help="Keep the generated inputs in this directory")
+    args = parser.parse_args(arguments)
+
+    parameters = dict(suite.QUICK_PARAMETERS if args.quick else suite.DEFAULT_PARAMETERS)
+    threshold = args.threshold
+    if threshold is None:
+        threshold = suite.QUICK_THRESHOLD if args.quick else suite.DEFAULT_THRESHOLD
+    if args.repeat:
+        parameters["repeat"] = args.repeat
+    baseline = None
+    if args.baseline:
+        if not os.path.isfile(args.baseline):
+            parser.error("there is no baseline at '{}', measure one with -o on the unchanged tree first".format(
+                args.baseline))
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        # Inputs of other sizes or seeds give throughputs which cannot be compared
+        for name, value in (("format", suite.RESULTS_FORMAT), ("seed", args.seed)):
+            if baseline.get(name) != value:
+                parser.error("the baseline has another {} ({} instead of {})".format(name, baseline.get(name),
+                                                                                    value))
+        for name in ("strings", "text_size", "paragraphs"):
+            if baseline["parameters"].get(name) != parameters[name]:
+                parser.error("the baseline was measured with another {} ({} instead of {}), use the same "
+                             "--quick option".format(name, baseline["parameters"].get(name), parameters[name]))
+
+    corpus_directory = args.corpus_dir or tempfile.mkdtemp(prefix="npttf2utf-benchmarks-")
+    os.makedirs(corpus_directory, exist_ok=True)
+    regressions = []
+    try:
+        results = suite.run(corpus_directory, parameters, args.filter, args.seed)
+        if baseline is not None and results["benchmarks"]:
+            regressions = suite.compare(results, baseline, threshold, args.memory_threshold)
+            if regressions:
+                # A regression has to show again in a second measurement, so that a run slowed down by something
+                # else on the machine does not fail the gate. The same benchmarks are run again in the same order,
+                # a benchmark measured on its own does not run in the same conditions
+                print("Measuring again after {} regression(s)".format(len(regressions)), file=sys.stderr)
+                suite.keep_best(results, suite.run(corpus_directory, parameters, args.filter, args.seed))
+                regressions = suite.compare(results, baseline, threshold, args.memory_threshold)
+    finally:
+        if not args.corpus_dir:
+            shutil.rmtree(corpus_directory, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if baseline is not None:
+        # A benchmark missing from the baseline would never be checked, the gate fails instead
+        missing = [name for name in results["benchmarks"] if name not in baseline["benchmarks"]]
+        for name in missing:
+            print("Not in the baseline: {}".format(name), file=sys.stderr)
+        if not results["benchmarks"]:
+            print("No benchmark was run, nothing was compared with {}".format(args.baseline), file=sys.stderr)
+        if missing or not results["benchmarks"]:
+            return 1
+        for name, metric, old, new in regressions:
+            print("Regression: {} {} went from {:,.0f} to {:,.0f} ({:+.1%})".format(name, metric, old, new,
+                                                                                     new / old - 1),
+                  file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regression against {}".format(args.baseline), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
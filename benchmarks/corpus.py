@@ -0,0 +1,148 @@
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+# Synthetic inputs of the benchmarks. Everything is generated from a seeded random.Random, so the same seed and
+# mapping definition always give the same strings and files, and results of different runs can be compared
+
+DEFAULT_SEED = 2021
+# Devanagari text for the benchmarks mapping from unicode, made of syllables (consonant and optional vowel sign)
+CONSONANTS = "कखगघङचछजझञटठडढणतथदधनपफबभमयरलवशषसह"
+VOWELS = "अआइईउऊएऐओऔ"
+VOWEL_SIGNS = ["", "", "", "ा", "ि", "ी", "ु", "ू", "ृ", "े", "ै", "ो", "ौ", "ं", "ँ", "ः"]
+VIRAMA = "्"
+PUNCTUATION = ["।", ",", "?", "!"]
+
+W_NAMESPACE = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+DOCUMENT_NAMESPACES = ('xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+                       'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" '
+                       'xmlns:mc="http://schemas.openxmlformats.org/markup-compatibility/2006" '
+                       'xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing" '
+                       'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+                       'xmlns:wps="http://schemas.microsoft.com/office/word/2010/wordprocessingShape"')
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+CONTENT_TYPES = ('<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                 '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                 '<Default Extension="xml" ContentType="application/xml"/>'
+                 '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-'
+                 'officedocument.wordprocessingml.document.main+xml"/>'
+                 '<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-'
+                 'officedocument.wordprocessingml.styles+xml"/></Types>')
+PACKAGE_RELATIONSHIPS = ('<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                         '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+                         'relationships/officeDocument" Target="word/document.xml"/></Relationships>')
+DOCUMENT_RELATIONSHIPS = ('<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                          '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+                          'relationships/styles" Target="styles.xml"/></Relationships>')
+
+
+class WordGenerator:
+    # Random words typed in a font: legacy fonts use the characters of their character map (letters being the most
+    # frequent, as in real text), "unicode" gives devanagari syllables
+
+    def __init__(self, font, rules, seed=DEFAULT_SEED):
+        self.font = font
+        self.random = random.Random("{}:{}".format(seed, font))
+        if font.lower() != "unicode":
+            characters = [character for character in rules[font]["rules"]["character-map"]
+                          if len(character) == 1 and not character.isspace()]
+            letters = [character for character in characters if character.isalpha()]
+            self.characters = characters + letters * 4
+
+    def word(self):
+        if self.font.lower() != "unicode":
+            return "".join(self.random.choice(self.characters) for _ in range(self.random.randint(1, 8)))
+        syllables = [self.random.choice(VOWELS)] if self.random.random() < 0.1 else []
+        for _ in range(self.random.randint(1, 4)):
+            if self.random.random() < 0.1:
+                # Conjunct
+                syllables.append(self.random.choice(CONSONANTS) + VIRAMA)
+            syllables.append(self.random.choice(CONSONANTS) + self.random.choice(VOWEL_SIGNS))
+        return "".join(syllables)
+
+    def words(self, count):
+        return " ".join(self.word() for _ in range(count))
+
+    def sentence(self):
+        sentence = self.words(self.random.randint(4, 14))
+        if self.font.lower() == "unicode":
+            sentence += self.random.choice(PUNCTUATION)
+        return sentence
+
+
+def short_strings(font, rules, count, seed=DEFAULT_SEED):
+    # Distinct strings of one to four words, like the labels and cells mapped one at a time by services
+    generator = WordGenerator(font, rules, seed)
+    return [generator.words(generator.random.randint(1, 4)) for _ in range(count)]
+
+
+def write_text(path, font, rules, size, seed=DEFAULT_SEED):
+    # Plain text file of about size characters, made of lines of a few sentences and some blank lines. Returns the
+    # number of characters written
+    generator = WordGenerator(font, rules, seed)
+    length = 0
+    with open(path, "w", encoding="utf-8", newline="\n") as text_file:
+        while length < size:
+            line = " ".join(generator.sentence() for _ in range(generator.random.randint(1, 6)))
+            if generator.random.random() < 0.1:
+                line += "\n"
+            text_file.write(line + "\n")
+            length += len(line) + 1
+    return length
+
+
+def _run(text, font):
+    return ('<w:r><w:rPr><w:rFonts w:ascii="{0}" w:hAnsi="{0}"/><w:sz w:val="24"/></w:rPr>'
+            '<w:t xml:space="preserve">{1}</w:t></w:r>').format(font, escape(text))
+
+
+def _paragraph(runs, font):
+    return '<w:p><w:pPr><w:rPr><w:rFonts w:ascii="{0}" w:hAnsi="{0}"/></w:rPr></w:pPr>{1}</w:p>'.format(
+        font, "".join(runs))
+
+
+def _text_box(paragraph):
+    return ('<w:r><w:drawing><wp:anchor><a:graphic><a:graphicData><wps:wsp><wps:txbx><w:txbxContent>{}'
+            '</w:txbxContent></wps:txbx></wps:wsp></a:graphicData></a:graphic></wp:anchor></w:drawing></w:r>'
+            ).format(paragraph)
+
+
+def write_docx(path, font, rules, paragraphs, seed=DEFAULT_SEED):
+    # DOCX file with paragraphs body elements: mostly paragraphs of a few runs in font (with some english text in
+    # between), every tenth a 3x3 table and every fifteenth a paragraph holding a text box. Returns the number of
+    # characters of text in font
+    generator = WordGenerator(font, rules, seed)
+    body = []
+    length = 0
+    for index in range(paragraphs):
+        if index % 10 == 9:
+            cells = [generator.words(generator.random.randint(1, 3)) for _ in range(9)]
+            length += sum(len(cell) for cell in cells)
+            rows = ["<w:tr>{}</w:tr>".format("".join("<w:tc><w:tcPr/>{}</w:tc>".format(
+                _paragraph([_run(cell, font)], font)) for cell in cells[row * 3:row * 3 + 3])) for row in range(3)]
+            body.append("<w:tbl><w:tblPr/>{}</w:tbl>".format("".join(rows)))
+        elif index % 15 == 14:
+            sentence, text_box_sentence = generator.sentence(), generator.sentence()
+            length += len(sentence) + len(text_box_sentence)
+            body.append(_paragraph([_run(sentence, font),
+                                    _text_box(_paragraph([_run(text_box_sentence, font)], font))], font))
+        else:
+            sentences = [generator.sentence() for _ in range(generator.random.randint(1, 3))]
+            length += sum(len(sentence) for sentence in sentences)
+            runs = [_run(sentence + " ", font) for sentence in sentences]
+            if generator.random.random() < 0.2:
+                runs.insert(1, _run("English text ", "Calibri"))
+            body.append(_paragraph(runs, font))
+    document = ('{}<w:document {}><w:body>{}<w:sectPr><w:pgSz w:w="11906" w:h="16838"/></w:sectPr></w:body>'
+                '</w:document>').format(XML_DECLARATION, DOCUMENT_NAMESPACES, "".join(body))
+    # Fixed timestamps, so the same arguments give the same bytes
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, content in (("[Content_Types].xml", XML_DECLARATION + CONTENT_TYPES),
+                              ("_rels/.rels", XML_DECLARATION + PACKAGE_RELATIONSHIPS),
+                              ("word/document.xml", document),
+                              ("word/_rels/document.xml.rels", XML_DECLARATION + DOCUMENT_RELATIONSHIPS),
+                              ("word/styles.xml", '{}<w:styles xmlns:w="{}"/>'.format(XML_DECLARATION,
+                                                                                      W_NAMESPACE))):
+            zf.writestr(zipfile.ZipInfo(name, date_time=(2021, 1, 1, 0, 0, 0)), content,
+                        compress_type=zipfile.ZIP_DEFLATED)
+    return length
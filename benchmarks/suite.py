@@ -0,0 +1,175 @@
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from npttf2utf import FontMapper, TxtHandler, DocxHandler
+from . import corpus
+
+# Bump whenever the inputs or the measurements change, results of different formats are not compared
+RESULTS_FORMAT = 1
+# Sizes of the inputs, the quick ones being meant for a fast check during development. A quick run only lasts a
+# few milliseconds, it is repeated more for its best time to be as stable
+DEFAULT_PARAMETERS = {"strings": 20000, "text_size": 2000000, "paragraphs": 2000, "repeat": 3}
+QUICK_PARAMETERS = {"strings": 2000, "text_size": 200000, "paragraphs": 200, "repeat": 10}
+# Largest accepted throughput drop, as a fraction. Two measurements of quick inputs on the same tree can still differ
+# by more than 10%
+DEFAULT_THRESHOLD = 0.1
+QUICK_THRESHOLD = 0.25
+# Seconds a benchmark is run before being timed, so that it is not measured while the process is still warming up
+WARM_UP_SECONDS = 0.5
+# Peak memory growth never reported as a regression, the peaks of the string benchmarks being a few kilobytes
+MEMORY_TOLERANCE = 1 << 16
+
+
+class Benchmark:
+    # One measured operation: run() does the work, prepare() resets any state (e.g. the mapping cache) so every
+    # repetition does the same work. chars and docs are the amount of text and documents handled by one run
+
+    def __init__(self, name, run, chars, docs=0, prepare=None):
+        self.name = name
+        self.run = run
+        self.chars = chars
+        self.docs = docs
+        self.prepare = prepare
+
+    def measure(self, repeat):
+        # Best time of repeat runs after warm up runs (the first one compiling the rules) lasting WARM_UP_SECONDS,
+        # then the peak memory allocated by a separate run, tracing allocations slowing it down too much to be timed
+        warm_up_end = time.perf_counter() + WARM_UP_SECONDS
+        times = []
+        while len(times) < repeat:
+            if self.prepare is not None:
+                self.prepare()
+            start = time.perf_counter()
+            self.run()
+            end = time.perf_counter()
+            if start >= warm_up_end:
+                times.append(end - start)
+        seconds = min(times)
+        if self.prepare is not None:
+            self.prepare()
+        tracemalloc.start()
+        try:
+            self.run()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        result = {"seconds": seconds, "chars": self.chars, "chars_per_second": self.chars / seconds,
+                  "peak_memory": peak_memory}
+        if self.docs:
+            result["docs"] = self.docs
+            result["docs_per_second"] = self.docs / seconds
+        return result
+
+
+def _map_strings(map_string, strings, font):
+    def run():
+        for string in strings:
+            map_string(string, font)
+    return run
+
+
+def is_selected(name, names):
+    return not names or any(selected in name for selected in names)
+
+
+def build(corpus_directory, parameters, seed=corpus.DEFAULT_SEED, names=None):
+    # Benchmarks of every font of the default mapping definition whose name contains one of names (all of them by
+    # default), their inputs being written to corpus_directory. Inputs are only generated for these benchmarks
+    mapper = FontMapper(cache_size=0)
+    rules = mapper.all_rules
+    fonts = list(rules)
+    # Handlers share a mapper whose cache is cleared before each run, documents repeating some of their texts
+    handler_mapper = FontMapper()
+    txt_handler = TxtHandler(handler_mapper)
+    docx_handler = DocxHandler(handler_mapper)
+    output_path = os.path.join(corpus_directory, "output")
+    benchmarks = []
+    for font in fonts:
+        name = "map_to_unicode/{}".format(font)
+        if not is_selected(name, names):
+            continue
+        strings = corpus.short_strings(font, rules, parameters["strings"], seed)
+        benchmarks.append(Benchmark(name, _map_strings(mapper.map_to_unicode, strings, font),
+                                    sum(len(string) for string in strings)))
+    for font in ["unicode"] + [font for font in fonts if font != "Preeti"]:
+        name = "map_to_preeti/{}".format(font)
+        if not is_selected(name, names):
+            continue
+        strings = corpus.short_strings(font, rules, parameters["strings"], seed)
+        benchmarks.append(Benchmark(name, _map_strings(mapper.map_to_preeti, strings, font),
+                                    sum(len(string) for string in strings)))
+    for font in fonts:
+        name = "TxtHandler.map_fonts/{}".format(font)
+        if not is_selected(name, names):
+            continue
+        path = os.path.join(corpus_directory, "{}.txt".format(font))
+        chars = corpus.write_text(path, font, rules, parameters["text_size"], seed)
+        benchmarks.append(Benchmark(name,
+                                    lambda path=path, font=font: txt_handler.map_fonts(path, output_path,
+                                                                                       from_font=font),
+                                    chars, prepare=handler_mapper.cache_clear))
+    for font in fonts:
+        name = "DocxHandler.map_fonts/{}".format(font)
+        if not is_selected(name, names):
+            continue
+        path = os.path.join(corpus_directory, "{}.docx".format(font))
+        chars = corpus.write_docx(path, font, rules, parameters["paragraphs"], seed)
+        benchmarks.append(Benchmark(name, lambda path=path: docx_handler.map_fonts(path, output_path),
+                                    chars, docs=1, prepare=handler_mapper.cache_clear))
+    return benchmarks
+
+
+def get_environment():
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(),
+            "platform": platform.platform(), "machine": platform.machine(), "cpus": os.cpu_count()}
+
+
+def run(corpus_directory, parameters, names=None, seed=corpus.DEFAULT_SEED, log=sys.stderr):
+    # Results of the benchmarks whose name contains one of names (all of them by default), as stored in the JSON
+    # results file
+    results = {}
+    for benchmark in build(corpus_directory, parameters, seed, names):
+        result = benchmark.measure(parameters["repeat"])
+        results[benchmark.name] = result
+        if log is not None:
+            print("{:<40} {:>12,.0f} chars/s {:>10.2f} MB peak".format(
+                benchmark.name, result["chars_per_second"], result["peak_memory"] / (1 << 20)), file=log)
+    return {"format": RESULTS_FORMAT, "environment": get_environment(), "seed": seed,
+            "parameters": dict(parameters), "benchmarks": results}
+
+
+def keep_best(results, other):
+    # Keep in results the best measurement of each benchmark of other (shortest time, smallest peak memory), a
+    # benchmark measured again then only regresses when it is slower every time
+    for name, result in other["benchmarks"].items():
+        best = results["benchmarks"].get(name)
+        if best is None:
+            results["benchmarks"][name] = result
+            continue
+        peak_memory = min(best["peak_memory"], result["peak_memory"])
+        if result["seconds"] < best["seconds"]:
+            best = results["benchmarks"][name] = dict(result)
+        best["peak_memory"] = peak_memory
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD, memory_threshold=None):
+    # Regressions of results against baseline: benchmarks whose throughput dropped by more than threshold (a
+    # fraction) or whose peak memory grew by more than memory_threshold (threshold by default) and more than
+    # MEMORY_TOLERANCE bytes. Returns a list of (benchmark name, metric, baseline value, new value)
+    if memory_threshold is None:
+        memory_threshold = threshold
+    regressions = []
+    for name, old in baseline["benchmarks"].items():
+        new = results["benchmarks"].get(name)
+        if new is None:
+            continue
+        for metric in ("chars_per_second", "docs_per_second"):
+            if metric in old and metric in new and new[metric] < old[metric] * (1 - threshold):
+                regressions.append((name, metric, old[metric], new[metric]))
+        growth = new["peak_memory"] - old["peak_memory"]
+        if growth > old["peak_memory"] * memory_threshold and growth > MEMORY_TOLERANCE:
+            regressions.append((name, "peak_memory", old["peak_memory"], new["peak_memory"]))
+    return regressions
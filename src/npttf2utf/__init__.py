@@ -1,45 +1,130 @@
 import argparse
+import importlib
 import json
 import os
-import zipfile
-from .base.docxhandler import DocxHandler, ET
+import sys
 from .base.exceptions import *
-from .base.fontmapper import FontMapper
-from .base.txthandler import TxtHandler
+
+# Classes exported by the package, imported on first use so that the command line tool only loads what the selected
+# mode needs
+_LAZY_EXPORTS = {
+    "DocxHandler": ".base.docxhandler",
+    "HtmlHandler": ".base.htmlhandler",
+    "ET": ".base.docxhandler",
+    "FontMapper": ".base.fontmapper",
+    "TxtHandler": ".base.txthandler",
+    "TabularHandler": ".base.tabularhandler",
+    "XlsxHandler": ".base.xlsxhandler",
+    "BatchConverter": ".base.batchconverter",
+    "configure_executor": ".base.executor",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_EXPORTS:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    return getattr(importlib.import_module(_LAZY_EXPORTS[name], __name__), name)
+
+
+def _file_format_errors():
+    # Errors raised for files not matching the conversion mode, only looked up once an error occurred
+    import zipfile
+    from xml.etree import ElementTree as ET
+    return zipfile.BadZipFile, KeyError, UnicodeDecodeError, ET.ParseError
 
 
 def main():
+    if sys.argv[1:2] == ["serve"]:
+        from .server import main as serve
+        return serve(sys.argv[2:])
     about = """ 
     Created by : Casual Snek (@casualsnek on GitHub)
     License    : GNU GENERAL PUBLIC LICENSE v3
     Version    : 0.3.7
     Email      : casualsnek@protonmail.com
     """
-    modes = ['string', 'plain', 'docx']
-    parser = argparse.ArgumentParser(description=about, formatter_class=argparse.RawDescriptionHelpFormatter)
+    modes = ['string', 'plain', 'tabular', 'docx', 'xlsx', 'html', 'batch']
+    parser = argparse.ArgumentParser(description=about, formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog='Run "npttf2utf serve -h" for the conversion daemon')
     parser.add_argument('-V', '--version', action='version', version="0.1a")
     parser.add_argument('-m', '--mode', dest='mode', help='Conversion mode ', choices=modes, required=True)
     parser.add_argument('-if', '--input-font', dest='font',
-                        help='Font used in input file. ("auto" can be used for docx mode)',
+                        help='Font used in input file. ("auto" can be used for docx, xlsx and html modes)',
                         default='preeti', required=True)
     parser.add_argument('-of', '--output-font', dest='outputfont',
-                        help='Font to which output will be mapped to. (If unspecified output font will be set to '
-                             'unicode)',
-                        default='unicode', choices=["Preeti", "unicode"], required=False)
+                        help='Font to which output will be mapped to. "unicode" or any font of the mapping definition '
+                             '(If unspecified output font will be set to unicode)',
+                        default='unicode', required=False)
     parser.add_argument('-dc', '--docx-components', dest='docxcomponents',
                         help='Component of docx which will be processed. (Comma separated) Available: '
-                             '"body_paragraph,table,shape" (If not specified all components will be processed)',
-                        default='body_paragraph,table,shape', required=False)
+                             '"body_paragraph,table,shape,header,footer,footnote,endnote,comment" (If not specified '
+                             'all components will be processed)',
+                        default='body_paragraph,table,shape,header,footer,footnote,endnote,comment', required=False)
     parser.add_argument('-kf', '--known-unicode-fonts', dest='knownunicodefonts',
                         help='Fonts to add to known supported unicode fonts while converting to preeti (If '
                              'Unspecified "Kalimati,Mangal,Noto Sans Devanagari" will be set)',
                         default='', required=False)
-    parser.add_argument('-i', '--input', dest='input', help='Input string or filepath', required=True)
-    parser.add_argument('-o', '--output', dest='output', help='Output file path. Not required for string mode')
+    parser.add_argument('-i', '--input', dest='input', nargs='+',
+                        help='Input string or filepath ("-" reads from stdin in plain, tabular and html modes). In '
+                             'batch mode any number of directories, files or glob patterns', required=True)
+    parser.add_argument('-o', '--output', dest='output', help='Output file path. Not required for string mode ("-" '
+                                                              'writes to stdout in plain, tabular and html modes). '
+                                                              'In batch mode the directory in which the input tree '
+                                                              'is recreated')
+    parser.add_argument('-c', '--columns', dest='columns',
+                        help='tabular mode only. Columns (header names or positions from 0) or JSON keys to map. '
+                             '(Comma separated, required in tabular mode)')
+    parser.add_argument('-tf', '--table-format', dest='tableformat', choices=['csv', 'tsv', 'jsonl'],
+                        help='tabular mode only. Format of the input (Defaults to the one of its extension, csv '
+                             'otherwise)')
+    parser.add_argument('-nh', '--no-header', dest='noheader', action='store_true',
+                        help='tabular mode only. The first row of the CSV/TSV input is a record, not a header')
+    parser.add_argument('-tif', '--txt-input-font', dest='txtfont',
+                        help='Batch mode only. Font used in the .txt files, which "auto" cannot detect (Defaults to '
+                             'the input font)')
+    parser.add_argument('-mn', '--manifest', dest='manifest',
+                        help='Batch mode only. Path of the per-file result manifest (Defaults to '
+                             '"manifest.jsonl" in the output directory)')
     parser.add_argument('-mf', '--map-file', dest='mapfile', help='Mapping definition file')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of worker processes used to convert a single large file in plain mode, the '
+                             'new values of each batch of records in tabular mode, the parts of a docx file or the '
+                             'files of a batch (Defaults to 1)')
+    parser.add_argument('-lm', '--low-memory', dest='lowmemory', action='store_true',
+                        help='docx mode only. Rewrite the document while it is read instead of loading it whole, '
+                             'for very large documents')
+    parser.add_argument('-cr', '--coalesce-runs', dest='coalesceruns', action='store_true',
+                        help='docx mode only. Merge adjacent runs with the same formatting before mapping them, words '
+                             'split across runs (by spell check, revisions...) are then mapped as a whole')
+    parser.add_argument('-cc', '--conversion-cache', dest='conversioncache', nargs='?', const='', default=None,
+                        help='plain, tabular, docx, xlsx, html and batch modes. Reuse the output of files converted '
+                             'the same way before, kept in this directory (Defaults to "conversions" in the user '
+                             'cache directory)')
+    parser.add_argument('-cm', '--cache-max-size', dest='cachemaxsize', type=int, default=1024,
+                        help='Size in MB above which the least recently used outputs are removed from the conversion '
+                             'cache (Defaults to 1024)')
+    parser.add_argument('-ch', '--cache-hardlink', dest='cachehardlink', action='store_true',
+                        help='Hardlink outputs from the conversion cache instead of copying them. They must then not '
+                             'be modified in place')
+    parser.add_argument('-st', '--stats', dest='stats', action='store_true',
+                        help='Print the calls, time and characters of every conversion stage (definition loading, '
+                             'XML parsing, pre-rules, character map, post-rules...) to stderr once done')
+    parser.add_argument('-pr', '--profile', dest='profile', nargs='?', const='', default=None,
+                        help='Run the conversion under cProfile and save the profile to this file, or print the '
+                             'slowest functions to stderr when no file is given')
     args = parser.parse_args()
     font = args.font
     op_mode = args.mode
+    if op_mode == "string":
+        args.input = " ".join(args.input)
+    elif op_mode != "batch":
+        if len(args.input) > 1:
+            parser.error("{} mode converts a single input, use batch mode for more".format(op_mode))
+        args.input = args.input[0]
+    elif args.output is None:
+        parser.error("batch mode needs an output directory (-o)")
+    if op_mode == "tabular" and not args.columns:
+        parser.error("tabular mode needs the columns to map (-c)")
 
     def splitnclean(string):
         lis = string.split(",")
@@ -47,28 +132,77 @@ def main():
             lis[index] = item.strip()
         return lis
 
+    conversion_cache = None
+    if args.conversioncache is not None:
+        from .base.convcache import ConversionCache
+        conversion_cache = ConversionCache(args.conversioncache or None, max_size=args.cachemaxsize << 20,
+                                           hardlink=args.cachehardlink)
+
     rule_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "map.json")
     if args.mapfile is not None:
         rule_file = args.mapfile
+    stats = None
+    if args.stats:
+        from .base import instrumentation
+        stats = instrumentation.Stats()
+        instrumentation.add_hook(stats)
+    profiler = None
+    if args.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
     try:
         if op_mode == "string":
+            from .base.fontmapper import FontMapper
             converter = FontMapper(rule_file)
-            if args.outputfont.lower() == 'unicode':
-                print(converter.map_to_unicode(args.input, from_font=args.font))
-            elif args.outputfont.lower() == 'preeti':
-                print(converter.map_to_preeti(args.input, from_font=args.font))
-            else:
-                raise UnsupportedMapToException
-        elif op_mode == "plain" or op_mode == "docx":
+            print(converter.map_to_font(args.input, from_font=args.font, to_font=args.outputfont))
+        elif op_mode in ("plain", "tabular", "docx", "xlsx", "html"):
             converter = None
+            extra_options = {}
+            components = splitnclean(args.docxcomponents)
             if op_mode == "plain":
+                from .base.txthandler import TxtHandler
                 converter = TxtHandler(rule_file)
+                extra_options["jobs"] = args.jobs
+            elif op_mode == "tabular":
+                from .base.tabularhandler import TabularHandler
+                converter = TabularHandler(rule_file)
+                components = splitnclean(args.columns)
+                # Resolved here so that the conversion cache tells formats apart
+                extra_options["table_format"] = args.tableformat or TabularHandler.get_table_format(args.input)
+                extra_options["header"] = not args.noheader
+                extra_options["jobs"] = args.jobs
             elif op_mode == "docx":
+                from .base.docxhandler import DocxHandler
                 converter = DocxHandler(rule_file)
-            converter.map_fonts(original_file_path=args.input, output_file_path=args.output, from_font=args.font,
-                                to_font=args.outputfont, components=splitnclean(args.docxcomponents),
-                                known_unicode_fonts=splitnclean(args.knownunicodefonts))
-            print("The converted file is saved as : {}".format(args.output))
+                extra_options["low_memory"] = args.lowmemory
+                extra_options["coalesce_runs"] = args.coalesceruns
+                extra_options["jobs"] = args.jobs
+            elif op_mode == "xlsx":
+                from .base.xlsxhandler import XlsxHandler
+                converter = XlsxHandler(rule_file)
+            elif op_mode == "html":
+                from .base.htmlhandler import HtmlHandler
+                converter = HtmlHandler(rule_file)
+            extra_options.update(from_font=args.font, to_font=args.outputfont,
+                                 components=components,
+                                 known_unicode_fonts=splitnclean(args.knownunicodefonts))
+            if conversion_cache is None:
+                converter.map_fonts(args.input, args.output, **extra_options)
+            elif conversion_cache.convert(converter, args.input, args.output, **extra_options):
+                print("Reused the output of an earlier conversion from the conversion cache")
+            if args.output != "-":
+                print("The converted file is saved as : {}".format(args.output))
+        elif op_mode == "batch":
+            from .base.batchconverter import BatchConverter
+            converter = BatchConverter(rule_file, jobs=args.jobs, conversion_cache=conversion_cache)
+            converted, failed = converter.convert(args.input, args.output, from_font=args.font,
+                                                  to_font=args.outputfont,
+                                                  components=splitnclean(args.docxcomponents),
+                                                  known_unicode_fonts=splitnclean(args.knownunicodefonts),
+                                                  manifest_path=args.manifest, txt_from_font=args.txtfont)
+            print("Converted {} files into '{}', {} failed. See '{}' for details.".format(
+                converted, args.output, failed, args.manifest or os.path.join(args.output, "manifest.jsonl")))
         else:
             print("Unsupported operation mode")
     except MapFileNotFoundException:
@@ -82,9 +216,27 @@ def main():
     except UnsupportedMapToException:
         print("Cannot map to given output font ! ({}) ".format(args.outputfont))
     except TxtAutoModeException:
-        print("Font auto detection does not work on plain text files :(")
-    except (zipfile.BadZipFile, KeyError, UnicodeDecodeError, ET.ParseError):
+        if op_mode == "batch":
+            print("Font auto detection does not work on plain text files, give their font with -tif :(")
+        else:
+            print("Font auto detection does not work on plain text files :(")
+    except BatchOutputCollisionException as e:
+        print("Two input files would be written to the same output file, convert them separately: {}".format(e))
+    except TabularFileException as e:
+        print(e)
+    except _file_format_errors():
         print("The type of file '{}' either does not match the conversion mode (-m) or "
               "the file is corrupted.".format(args.input))
     except PermissionError:
         print("Permission denied to read the input file or write the output file.")
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            if args.profile:
+                profiler.dump_stats(args.profile)
+                print("The profile is saved as : {}".format(args.profile), file=sys.stderr)
+            else:
+                import pstats
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(30)
+        if stats is not None:
+            print(stats.summary(), file=sys.stderr)
@@ -0,0 +1,163 @@
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from .txthandler import TxtHandler
+from .docxhandler import DocxHandler
+from .xlsxhandler import XlsxHandler
+from .htmlhandler import HtmlHandler
+from .fontmapper import FontMapper
+from .exceptions import TxtAutoModeException, BatchOutputCollisionException
+
+# Handler used for each file extension
+HANDLER_CLASSES = {
+    ".txt": TxtHandler,
+    ".docx": DocxHandler,
+    ".xlsx": XlsxHandler,
+    ".html": HtmlHandler,
+    ".htm": HtmlHandler,
+}
+
+# Handlers and conversion cache of the current worker process, created once per process by _init_worker()
+_worker_handlers = {}
+_worker_conversion_cache = None
+
+
+def _init_worker(rules_file, conversion_cache=None):
+    global _worker_conversion_cache
+    for extension, handler_class in HANDLER_CLASSES.items():
+        _worker_handlers[extension] = handler_class(rules_file)
+    _worker_conversion_cache = conversion_cache
+
+
+def _convert_file(task):
+    source_path, output_path, options = task
+    started = time.time()
+    result = {"input": source_path, "output": output_path, "status": "ok", "error": None}
+    try:
+        output_directory = os.path.dirname(output_path)
+        if output_directory:
+            os.makedirs(output_directory, exist_ok=True)
+        handler = _worker_handlers[os.path.splitext(source_path)[1].lower()]
+        if _worker_conversion_cache is None:
+            handler.map_fonts(source_path, output_path, **options)
+        else:
+            result["cached"] = _worker_conversion_cache.convert(handler, source_path, output_path, **options)
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    result["seconds"] = round(time.time() - started, 3)
+    return result
+
+
+def _is_within(path, directory):
+    # True when path is directory or inside it, both being real paths
+    try:
+        return os.path.commonpath([path, directory]) == directory
+    except ValueError:
+        # Paths on different drives
+        return False
+
+
+class BatchConverter:
+    # Converts many .txt/.docx/.xlsx/.html files at once. Every worker process loads the mapping definition a single
+    # time and then converts files until there are none left. A failing file does not stop the batch, the outcome of
+    # every file is written to a manifest (one JSON object per line) instead. With a ConversionCache, files converted
+    # the same way by an earlier batch are copied from the cache
+
+    def __init__(self, rules_file, jobs=1, conversion_cache=None):
+        # rules_file is the path of the mapping definition or a FontMapper, worker processes load their own from its
+        # path
+        self.rules_file = rules_file.map_json if isinstance(rules_file, FontMapper) else rules_file
+        self.jobs = max(1, jobs)
+        self.conversion_cache = conversion_cache
+
+    @staticmethod
+    def collect_files(inputs, exclude=None):
+        # Expand directories (recursively) and glob patterns to (file path, path relative to the input root) pairs.
+        # Files of an input tree found inside the directory exclude (the output directory, which would otherwise
+        # give back the outputs of earlier runs) are left out, unless the input itself is inside it. Files named
+        # explicitly are always kept
+        exclude = os.path.realpath(exclude) if exclude is not None else None
+
+        def is_excluded(path, root):
+            return exclude is not None and _is_within(os.path.realpath(path), exclude) \
+                and not _is_within(os.path.realpath(root), exclude)
+
+        collected = []
+        for item in inputs:
+            if os.path.isdir(item):
+                for directory, directories, files in os.walk(item):
+                    directories[:] = [name for name in directories
+                                      if not is_excluded(os.path.join(directory, name), item)]
+                    for name in sorted(files):
+                        path = os.path.join(directory, name)
+                        collected.append((path, os.path.relpath(path, item)))
+            elif glob.has_magic(item):
+                # Paths are made relative to the part of the pattern before its first wildcard
+                root = item
+                while glob.has_magic(root):
+                    root = os.path.dirname(root)
+                for path in sorted(glob.glob(item, recursive=True)):
+                    if os.path.isfile(path) and not is_excluded(path, root or os.curdir):
+                        collected.append((path, os.path.relpath(path, root or os.curdir)))
+            else:
+                collected.append((item, os.path.basename(item)))
+        # Inputs may overlap (a directory and a pattern inside it), a file found twice is converted once. Distinct
+        # files with the same output path (-i dir1 dir2 both holding a.txt) would overwrite each other
+        files = []
+        outputs = {}
+        for path, relative in collected:
+            if os.path.splitext(path)[1].lower() not in HANDLER_CLASSES:
+                continue
+            real_path = os.path.realpath(path)
+            key = os.path.normcase(os.path.normpath(relative))
+            if key in outputs:
+                if outputs[key][0] != real_path:
+                    raise BatchOutputCollisionException(
+                        "'{}' and '{}' would both be converted to '{}'".format(outputs[key][1], path, relative))
+                continue
+            outputs[key] = (real_path, path)
+            files.append((path, relative))
+        return files
+
+    def convert(self, inputs, output_root, from_font="auto", to_font="unicode", components=None,
+                known_unicode_fonts=None, manifest_path=None, txt_from_font=None):
+        # Convert every supported file found in inputs (directories, glob patterns or files) into output_root,
+        # mirroring the input directory tree. Returns (number of converted files, number of failed files). Plain
+        # text files have no fonts to detect, they are read as txt_from_font (from_font by default, which must then
+        # not be "auto"). Raises BatchOutputCollisionException, before converting anything, when two files of the
+        # inputs have the same path relative to their input. output_root is never searched for inputs
+        if manifest_path is None:
+            manifest_path = os.path.join(output_root, "manifest.jsonl")
+        options = {"from_font": from_font, "to_font": to_font, "components": components,
+                   "known_unicode_fonts": known_unicode_fonts if known_unicode_fonts is not None else []}
+        txt_options = dict(options, from_font=txt_from_font or from_font)
+        files = self.collect_files(inputs, exclude=output_root)
+        if txt_options["from_font"] == "auto" and any(path.lower().endswith(".txt") for path, _ in files):
+            raise TxtAutoModeException
+        tasks = [(path, os.path.join(output_root, relative),
+                  txt_options if path.lower().endswith(".txt") else options) for path, relative in files]
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+        converted = failed = 0
+        with open(manifest_path, "w", encoding="utf-8") as manifest:
+            if self.jobs == 1:
+                _init_worker(self.rules_file, self.conversion_cache)
+                results = map(_convert_file, tasks)
+                executor = None
+            else:
+                executor = ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker,
+                                               initargs=(self.rules_file, self.conversion_cache))
+                results = executor.map(_convert_file, tasks, chunksize=max(1, min(64, len(tasks) // (4 * self.jobs))))
+            try:
+                for result in results:
+                    if result["status"] == "ok":
+                        converted += 1
+                    else:
+                        failed += 1
+                    manifest.write(json.dumps(result, ensure_ascii=False) + "\n")
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+        return converted, failed
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import shutil
+from .mapcache import get_cache_directory
+from . import instrumentation
+
+# Bump whenever a change to the handlers changes their output, older entries are then never found again
+CONVERSION_CACHE_FORMAT = 1
+# Total size of the cached outputs above which the least recently used ones are removed
+DEFAULT_MAX_SIZE = 1 << 30
+# Path that stands for stdin/stdout, never cached
+STANDARD_STREAM = "-"
+_HASH_BUFFER_SIZE = 1 << 20
+
+
+def get_default_directory():
+    directory = get_cache_directory() or os.path.join(os.path.expanduser("~"), ".cache", "npttf2utf")
+    return os.path.join(directory, "conversions")
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as input_file:
+        for data in iter(lambda: input_file.read(_HASH_BUFFER_SIZE), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class ConversionCache:
+    # On disk cache of converted files, addressed by a hash of everything the output depends on: the input bytes,
+    # the mapping definition (content hash and font versions), the handler, the fonts and the components. A hit
+    # copies (or with hardlink, links) the stored output instead of converting again. The modification time of an
+    # entry records its last use, once the entries take more than max_size bytes the least recently used ones are
+    # removed. Several processes can share the same directory
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE, hardlink=False):
+        self.directory = directory or get_default_directory()
+        self.max_size = max_size
+        # A hardlinked output shares its modification time with the entry, and must not be modified in place
+        self.hardlink = hardlink
+        self.hits = 0
+        self.misses = 0
+        # Total size of the entries, only known once the directory was scanned
+        self.__size = None
+
+    def get_key(self, handler, original_file_path, options):
+        # Key of converting original_file_path with handler.map_fonts(**options), None when it cannot be cached
+        if original_file_path == STANDARD_STREAM or options.get("output_file_path") == STANDARD_STREAM:
+            return None
+        rules = handler.mapper.all_rules
+        components = options.get("components")
+        key = {
+            "format": CONVERSION_CACHE_FORMAT,
+            "handler": type(handler).__name__,
+            "unicode_font": getattr(handler, "default_unicode_font_name", None),
+            "input": hash_file(original_file_path),
+            "map": rules.sha256,
+            "versions": sorted((font, rules[font].get("version")) for font in rules),
+            "from_font": options.get("from_font"),
+            "to_font": options.get("to_font"),
+            "components": sorted(components) if components is not None else None,
+            "known_unicode_fonts": sorted(options.get("known_unicode_fonts") or []),
+            "low_memory": bool(options.get("low_memory")),
+            "coalesce_runs": bool(options.get("coalesce_runs")),
+            "table_format": options.get("table_format"),
+            "header": bool(options.get("header", True)),
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def __entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(self, key, output_file_path):
+        # Write the stored output of key to output_file_path, False when there is none
+        path = self.__entry_path(key)
+        try:
+            # Marks the entry as recently used
+            os.utime(path)
+            if self.hardlink:
+                try:
+                    if os.path.lexists(output_file_path):
+                        os.remove(output_file_path)
+                    os.link(path, output_file_path)
+                    return True
+                except OSError:
+                    pass
+            shutil.copyfile(path, output_file_path)
+        except FileNotFoundError:
+            # Never stored or evicted meanwhile by another process
+            return False
+        return True
+
+    def store(self, key, output_file_path):
+        # Keep a copy of output_file_path as the output of key. The cache is an optimization, failing to write to
+        # it is ignored
+        size = os.path.getsize(output_file_path)
+        if size > self.max_size:
+            return
+        path = self.__entry_path(key)
+        temporary_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(output_file_path, temporary_path)
+            os.replace(temporary_path, path)
+        except OSError:
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+            return
+        if self.__size is None:
+            self.evict()
+        else:
+            self.__size += size
+            if self.__size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        # Remove the least recently used entries until they take at most max_size bytes
+        entries = []
+        for directory, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self.__size = total
+
+    def convert(self, handler, original_file_path, output_file_path, **options):
+        # Same as handler.map_fonts(original_file_path, output_file_path, **options), reusing the output of an
+        # earlier identical conversion when there is one. Returns True for a cache hit
+        key = self.get_key(handler, original_file_path, dict(options, output_file_path=output_file_path))
+        if key is not None and self.fetch(key, output_file_path):
+            self.hits += 1
+            instrumentation.record("conversion_cache.hit")
+            return True
+        handler.map_fonts(original_file_path, output_file_path, **options)
+        if key is not None:
+            self.misses += 1
+            instrumentation.record("conversion_cache.miss")
+            self.store(key, output_file_path)
+        return False
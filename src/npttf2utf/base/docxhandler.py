@@ -1,47 +1,214 @@
 from xml.etree import ElementTree as ET
-from io import StringIO
-from .fontmapper import FontMapper
-from .exceptions import UnsupportedMapToException
+from io import BytesIO
+from .fontmapper import FontMapper, DEFAULT_CACHE_SIZE
+from .exceptions import UnsupportedMapToException, NoMapForOriginException
+from .ziprepack import repack_zip
+from .xmlescape import escape, quote_attribute
+from .textstream import is_file_object
+from . import instrumentation
+import itertools
 import os
+import posixpath
+import re
 import zipfile
-import tempfile
-import shutil
+
+# Bytes of document.xml parsed at once in low memory mode
+STREAM_CHUNK_SIZE = 1 << 16
+# Main part of the package. The other story parts are found through its relationships
+DOCUMENT_PART = "word/document.xml"
+DOCUMENT_RELATIONSHIPS_PART = "word/_rels/document.xml.rels"
+# Story parts besides document.xml, by the last segment of their relationship type, and the component enabling them
+STORY_PART_COMPONENTS = {
+    "header": "header",
+    "footer": "footer",
+    "footnotes": "footnote",
+    "endnotes": "endnote",
+    "comments": "comment",
+}
+# Elements whose children are the paragraphs and tables of a story part
+STORY_CONTAINER_TAGS = {
+    "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}body",
+    "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}hdr",
+    "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}ftr",
+    "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}footnote",
+    "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}endnote",
+    "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}comment",
+}
+# Components selecting what is mapped in the document body. The other story parts are always mapped whole
+CONTENT_COMPONENTS = ["body_paragraph", "table", "shape"]
+DEFAULT_COMPONENTS = CONTENT_COMPONENTS + list(STORY_PART_COMPONENTS.values())
+# Start tag of a "w:rFonts" element (whatever its prefix) and its attributes, the ascii font and the cs font, as found
+# in the raw bytes of a part by scan_run_fonts(). Starting with the literal name makes the scan several times faster
+RUN_FONTS_TAG = re.compile(rb'rFonts\b([^>]*)>')
+ASCII_FONT_ATTRIBUTE = re.compile(rb'\s(?:[^\s=:]+:)?ascii\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+CS_FONT_ATTRIBUTE = re.compile(rb'\s(?:[^\s=:]+:)?cs\s*=')
+
+
+def scan_run_fonts(chunks):
+    # Pre-scan of the raw bytes of a part, given as an iterable of chunks, without parsing it. Returns the fonts of
+    # the "w:ascii" attributes of its "w:rFonts" elements in order of appearance, and whether one of these elements
+    # has a "w:cs" font but no "w:ascii" one (mapping takes its runs for unicode). Only ever finds more than a parser
+    # would (in comments, other namespaces...), never less
+    fonts = []
+    unicode_runs = False
+    seen = set()
+    carry = b""
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            # What is left after the last chunk
+            data, end = carry, len(carry)
+        else:
+            data = carry + chunk
+            # A tag cut by the end of the chunk starts at the last "<", it is scanned along with the next chunk
+            end = data.rfind(b"<")
+            if end == -1:
+                end = len(data)
+        # Documents repeat the same few font settings over and over
+        for attributes in dict.fromkeys(RUN_FONTS_TAG.findall(data, 0, end)):
+            if attributes in seen:
+                continue
+            seen.add(attributes)
+            ascii_font = ASCII_FONT_ATTRIBUTE.search(attributes)
+            if ascii_font is None:
+                unicode_runs = unicode_runs or CS_FONT_ATTRIBUTE.search(attributes) is not None
+                continue
+            font = (ascii_font.group(1) if ascii_font.group(1) is not None else ascii_font.group(2)).decode("utf-8")
+            if "&" in font:
+                import html
+                font = html.unescape(font)
+            if font not in fonts:
+                fonts.append(font)
+        carry = data[end:]
+    return fonts, unicode_runs
+
+
+class DocxScan:
+    # Story parts of a docx file and the fonts their runs use according to scan_run_fonts(), see DocxHandler.scan().
+    # Parts parsed by DocxHandler.detect_used_fonts() are kept in trees for map_fonts(), which then does not parse
+    # them again
+
+    def __init__(self, path, story_parts, contents, run_fonts):
+        self.path = path
+        # (part name, component) of the parts besides document.xml
+        self.story_parts = story_parts
+        # Raw bytes of the parts, document.xml is missing when it was scanned for low memory mapping
+        self.contents = contents
+        # Part name -> (ascii fonts, whether there are runs with a cs font only)
+        self.run_fonts = run_fonts
+        self.trees = {}
+
+    def uses_fonts(self, part_name, fonts):
+        # Whether the runs of a part may use one of fonts ("Unicode" stands for the runs with a cs font only)
+        ascii_fonts, unicode_runs = self.run_fonts[part_name]
+        return (unicode_runs and "Unicode" in fonts) or any(font in fonts for font in ascii_fonts)
+
+    def read(self, zf, part_name):
+        if part_name in self.contents:
+            return self.contents[part_name]
+        return zf.read(part_name)
+
+
+def _element_key(element):
+    # Comparable form of an element and its descendants, equal for equivalent elements
+    return (element.tag, tuple(sorted(element.attrib.items())), (element.text or "").strip(),
+            tuple(_element_key(child) for child in element))
+
+
+def _get_plain_run(run):
+    # (properties key, text element) of a run holding only its properties and one "w:t", None for any other element
+    if run.tag != "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}r":
+        return None
+    children = list(run)
+    properties = None
+    if children and children[0].tag == "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}rPr":
+        properties = children.pop(0)
+    if len(children) != 1 or children[0].tag != "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}t" \
+            or len(children[0]):
+        return None
+    return _element_key(properties) if properties is not None else None, children[0]
+
+
+# Handler of the current worker process when the parts of a docx file are mapped in parallel
+_worker_handler = None
+
+
+def _init_worker(rules_file, default_unicode_font_name, cache_size):
+    global _worker_handler
+    _worker_handler = DocxHandler(rules_file, default_unicode_font_name, cache_size)
+
+
+def _map_part(xml_content, options, components):
+    return _worker_handler.map_xml_part(xml_content, components=components, **options)
+
+
+class NamespaceRegisteringTreeBuilder(ET.TreeBuilder):
+    # Tree builder that registers the prefix of every namespace declaration it comes across
+
+    def start_ns(self, prefix, uri):
+        ET.register_namespace(prefix, uri)
 
 
 class DocxHandler:
 
-    def __init__(self, rules_file, default_unicode_font_name="Kalimati"):
-        self.mapper = FontMapper(rules_file)
+    def __init__(self, rules_file, default_unicode_font_name="Kalimati", cache_size=DEFAULT_CACHE_SIZE):
+        # rules_file is the path of the mapping definition, whose shared FontMapper is used (see FontMapper.get), or
+        # a FontMapper. Run texts repeated through the document are mapped once, cache_size limits how many are
+        # remembered
+        self.mapper = rules_file if isinstance(rules_file, FontMapper) else FontMapper.get(rules_file, cache_size)
+        self.rules_file = self.mapper.map_json
         self.supported_ttf_fonts = self.mapper.supported_maps
         self.default_unicode_font_name = default_unicode_font_name
         self.known_devanagari_unicode_fonts = ["Kalimati", "Mangal", "Noto Sans Devanagari"]
 
     @staticmethod
-    def __get_xml(docx_file_path):
-        with zipfile.ZipFile(docx_file_path) as zf:
-            with zf.open('word/document.xml') as xf:
-                xml_content = xf.read().decode('utf-8')
-        return xml_content
+    def __parse_xml(xml_content, register_namespaces=False):
+        # With register_namespaces the namespaces of the part are registered during the same pass, so the tree can
+        # be written back with the original prefixes
+        with instrumentation.timed("docx.parse", len(xml_content)):
+            target = NamespaceRegisteringTreeBuilder() if register_namespaces else ET.TreeBuilder()
+            parser = ET.XMLParser(target=target)
+            parser.feed(xml_content)
+            return parser.close()
 
     @staticmethod
-    def __save_docx(xml_content, output_file_path, original_file_path):
-        tmp_dir = tempfile.mkdtemp()
-        with zipfile.ZipFile(original_file_path, 'r') as zipObj:
-            zipObj.extractall(tmp_dir)
-            filenames = zipObj.namelist()
-        with open(os.path.join(tmp_dir, 'word/document.xml'), 'w', encoding="utf-8") as f:
-            f.write(xml_content)
-        with zipfile.ZipFile(output_file_path, "w") as docx:
-            for filename in filenames:
-                docx.write(os.path.join(tmp_dir, filename), filename)
-        shutil.rmtree(tmp_dir)
-        return True
+    def __get_story_parts(zf):
+        # (part name, component) of every header, footer, footnotes, endnotes and comments part of the package
+        try:
+            relationships = ET.fromstring(zf.read(DOCUMENT_RELATIONSHIPS_PART))
+        except KeyError:
+            return []
+        names = set(zf.namelist())
+        parts = []
+        for relationship in relationships.iter(
+                "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"):
+            component = STORY_PART_COMPONENTS.get(relationship.get("Type", "").rsplit("/", 1)[-1])
+            if component is None or relationship.get("TargetMode") == "External":
+                continue
+            target = relationship.get("Target", "")
+            # Targets are relative to the "word" directory unless they start with "/"
+            if target.startswith("/"):
+                name = target[1:]
+            else:
+                name = posixpath.normpath(posixpath.join(posixpath.dirname(DOCUMENT_PART), target))
+            if name in names and (name, component) not in parts:
+                parts.append((name, component))
+        return parts
 
     @staticmethod
-    def __register_namespaces(xml):
-        namespaces = dict([node for _, node in ET.iterparse(xml, events=['start-ns'])])
-        for ns in namespaces:
-            ET.register_namespace(ns, namespaces[ns])
+    def __save_docx(replacements, output_file_path, original_file_path):
+        # Only the mapped parts are rewritten, every other part (images, fonts...) is copied without being
+        # decompressed. Parts mapped while the archive is written (low memory mode, worker processes) can still
+        # fail, the incomplete output file is then removed
+        with instrumentation.timed("docx.repack"):
+            try:
+                return repack_zip(original_file_path, output_file_path, replacements)
+            except BaseException:
+                if not is_file_object(output_file_path):
+                    try:
+                        os.remove(output_file_path)
+                    except OSError:
+                        pass
+                raise
 
     @staticmethod
     def __get_font_data_from_relation_property(relation_property):
@@ -68,18 +235,7 @@ class DocxHandler:
         # Strip un necessary font related attributes. Make it minimal.. Word processor
         # will add them back if necessary
         font_property.attrib = self.__strip_font_attributes(font_property.attrib)
-        if map_to.lower() == "preeti":
-            font_property.attrib[
-                "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}ascii"
-            ] = "Preeti"
-            font_property.attrib[
-                "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}hAnsi"
-            ] = "Preeti"
-            # Replace original text with mapped text
-            if text_container is not None:
-                original_text = text_container.text
-                text_container.text = self.mapper.map_to_preeti(original_text, used_font, unescape_html_input=True)
-        elif map_to.lower() == "unicode":
+        if map_to.lower() == "unicode":
             font_property.attrib[
                 "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}cs"
             ] = self.default_unicode_font_name
@@ -88,7 +244,22 @@ class DocxHandler:
                 original_text = text_container.text
                 text_container.text = self.mapper.map_to_unicode(original_text, used_font, unescape_html_input=True)
         else:
-            raise UnsupportedMapToException("Document cannot be mapped to target ")
+            # Any font of the mapping definition (or Preeti) can be the target
+            try:
+                font_name = self.mapper.get_font_name(map_to)
+            except UnsupportedMapToException:
+                raise UnsupportedMapToException("Document cannot be mapped to target ")
+            font_property.attrib[
+                "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}ascii"
+            ] = font_name
+            font_property.attrib[
+                "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}hAnsi"
+            ] = font_name
+            # Replace original text with mapped text
+            if text_container is not None:
+                original_text = text_container.text
+                text_container.text = self.mapper.map_to_font(original_text, used_font, font_name,
+                                                              unescape_html_input=True)
 
     @staticmethod
     def __strip_font_attributes(dictionary):
@@ -103,11 +274,38 @@ class DocxHandler:
                     "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}cs"
                 ]}
 
+    @staticmethod
+    def __coalesce_runs(paragraph):
+        # Merge adjacent runs of a paragraph that hold nothing but the same properties and a "w:t" into a single
+        # run. Word splits words across such runs (spell check, revisions, editing sessions), merged they are
+        # mapped as a whole and the rules can see across the former boundaries. Spell check marks ("w:proofErr")
+        # between merged runs are dropped, anything else between two runs keeps them apart
+        previous = None
+        skipped = []
+        for child in list(paragraph):
+            if child.tag == "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}proofErr" \
+                    and previous is not None:
+                skipped.append(child)
+                continue
+            plain_run = _get_plain_run(child)
+            if plain_run is not None and previous is not None and plain_run[0] == previous[0]:
+                text_container = previous[1]
+                text_container.text = (text_container.text or "") + (plain_run[1].text or "")
+                if text_container.text != text_container.text.strip():
+                    text_container.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
+                for element in skipped + [child]:
+                    paragraph.remove(element)
+            else:
+                previous = plain_run
+            skipped = []
+
     def __handle_wp_containers_in_paragraphs(self, paragraphs, from_font="auto", to_font="unicode",
-                                             known_unicode_fonts=None):
+                                             known_unicode_fonts=None, coalesce_runs=False):
         if known_unicode_fonts is None:
             known_unicode_fonts = []
         for paragraph in paragraphs:
+            if coalesce_runs:
+                self.__coalesce_runs(paragraph)
             for relation in paragraph.iterfind("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}r"):
                 relation_property = relation.find("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}rPr")
                 if relation_property is not None:
@@ -122,7 +320,10 @@ class DocxHandler:
                             # Check if the used font is in supported ttf fonts + "unicode"
                             if used_font in self.supported_ttf_fonts:
                                 set_from_font = used_font
-                                if to_font.lower() == "preeti":
+                                # Runs in another legacy font are rewritten to the target font, unicode runs
+                                # only when they use a known unicode font
+                                if to_font.lower() != "unicode" and (used_font == "Unicode" or
+                                                                     used_font.lower() == to_font.lower()):
                                     if used_unicode_font not in (self.known_devanagari_unicode_fonts +
                                                                  known_unicode_fonts + self.supported_ttf_fonts):
                                         continue_mapping = False
@@ -153,7 +354,8 @@ class DocxHandler:
                     # If on auto auto mode, only change base font when mapping is possible
                     if from_font == "auto":
                         if used_font in self.supported_ttf_fonts:
-                            if to_font.lower() == "preeti":
+                            if to_font.lower() != "unicode" and (used_font == "Unicode" or
+                                                                 used_font.lower() == to_font.lower()):
                                 if used_unicode_font not in (self.known_devanagari_unicode_fonts +
                                                              known_unicode_fonts + self.supported_ttf_fonts):
                                     continue_mapping = False
@@ -163,74 +365,287 @@ class DocxHandler:
                         self.__map_now(to_font, font_property)
         return True
 
+    def scan(self, docx_file_path, low_memory=False, scan_fonts=True):
+        # Read the story parts of a docx file and pre-scan their raw bytes for the fonts their runs use. With
+        # low_memory document.xml is scanned as it is read and not kept in memory. Without scan_fonts only the story
+        # parts are listed, their content is read when they are mapped
+        contents = {}
+        run_fonts = {}
+        with instrumentation.timed("docx.scan"), zipfile.ZipFile(docx_file_path) as zf:
+            story_parts = self.__get_story_parts(zf)
+            for part_name in ([DOCUMENT_PART] + [name for name, _ in story_parts] if scan_fonts else []):
+                if low_memory and part_name == DOCUMENT_PART:
+                    with zf.open(part_name) as member:
+                        run_fonts[part_name] = scan_run_fonts(iter(lambda: member.read(STREAM_CHUNK_SIZE), b""))
+                else:
+                    contents[part_name] = zf.read(part_name)
+                    run_fonts[part_name] = scan_run_fonts([contents[part_name]])
+        return DocxScan(docx_file_path, story_parts, contents, run_fonts)
+
     def detect_used_fonts(self, docx_file_path):
+        # docx_file_path can also be a DocxScan of the file, the parts parsed here are then kept in it for
+        # map_fonts(). Parts in which the pre-scan finds no supported font are not parsed at all
+        scan = docx_file_path if isinstance(docx_file_path, DocxScan) else self.scan(docx_file_path)
         detected_supported_fonts = []
-        tree = ET.ElementTree(ET.fromstring(self.__get_xml(docx_file_path)))
-        root = tree.getroot()
-
-        font_property_containers = root.iter("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}rFonts")
-        for container in font_property_containers:
-            used_font = container.attrib.get("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}ascii",
-                                             "SomeUnsupportedFonts6576")
-            if used_font in self.supported_ttf_fonts and used_font not in detected_supported_fonts:
-                detected_supported_fonts.append(used_font)
+        with zipfile.ZipFile(scan.path) as zf:
+            for part_name in [DOCUMENT_PART] + [name for name, _ in scan.story_parts]:
+                if not any(font in self.supported_ttf_fonts for font in scan.run_fonts[part_name][0]):
+                    continue
+                if part_name not in scan.trees:
+                    scan.trees[part_name] = self.__parse_xml(scan.read(zf, part_name), register_namespaces=True)
+                font_property_containers = scan.trees[part_name].iter(
+                    "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}rFonts")
+                for container in font_property_containers:
+                    used_font = container.attrib.get(
+                        "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}ascii",
+                        "SomeUnsupportedFonts6576")
+                    if used_font in self.supported_ttf_fonts and used_font not in detected_supported_fonts:
+                        detected_supported_fonts.append(used_font)
         return detected_supported_fonts
 
-    def map_fonts(self, original_file_path, output_file_path="mapped.docx", from_font="auto", to_font="unicode",
-                  components=None, known_unicode_fonts=None):
-        if known_unicode_fonts is None:
-            known_unicode_fonts = []
-        if components is None:
-            components = ["body_paragraph", "table", "shape"]
-        xml_string = self.__get_xml(original_file_path)
-        tree = ET.ElementTree(ET.fromstring(xml_string))
-        root = tree.getroot()
-        # GET INSIDE THE BODY
-        for body in root.iterfind("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}body"):
+    def __handle_body_child(self, child, from_font="auto", to_font="unicode", components=None,
+                            known_unicode_fonts=None, coalesce_runs=False):
+        # Map one direct child of "w:body". Children are independent of each other, so a document can be processed
+        # one child at a time
+        if child.tag == "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}p":
             # Process normal paragraphs. They (w:p) lie directly inside body as child
-            general_paragraphs = body.findall("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}p")
             if "body_paragraph" in components:
-                self.__handle_wp_containers_in_paragraphs(general_paragraphs,
+                self.__handle_wp_containers_in_paragraphs([child],
                                                           from_font=from_font,
                                                           to_font=to_font,
-                                                          known_unicode_fonts=known_unicode_fonts)
-
-            # Process paragraphs. They (w:p) lie inside "w:tbl" as child of table row and column, but we can just
-            # iterate inside table to get them
-            if "table" in components:
-                for table in body.iterfind("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}tbl"):
-                    # Now since we are not direct child of normal paragraphs but inside a table, We can use .iter()
-                    # to get all the paragraphs inside current table without modifying other components
-                    paragraphs = table.iter("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}p")
+                                                          known_unicode_fonts=known_unicode_fonts,
+                                                          coalesce_runs=coalesce_runs)
+            # Process shapes. They lie inside "w:p" (Main paragraphs), find them. Shapes wont be processed in
+            # "body_paragraph" and SHOULD NOT BE as content in shape lie much deeper
+            if "shape" in components:
+                tbx_content = child.iter("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}txbxContent")
+                # They contain  data for (t)e(x)t(b)o(x)/Shapes. They content another "w:p" which has actual
+                # text content
+                for txbx in tbx_content:
+                    paragraphs = txbx.iterfind("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}p")
                     self.__handle_wp_containers_in_paragraphs(paragraphs,
                                                               from_font=from_font,
                                                               to_font=to_font,
-                                                              known_unicode_fonts=known_unicode_fonts)
+                                                              known_unicode_fonts=known_unicode_fonts,
+                                                              coalesce_runs=coalesce_runs)
+        elif child.tag == "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}tbl":
+            # Process paragraphs. They (w:p) lie inside "w:tbl" as child of table row and column, but we can just
+            # iterate inside table to get them
+            if "table" in components:
+                paragraphs = child.iter("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}p")
+                self.__handle_wp_containers_in_paragraphs(paragraphs,
+                                                          from_font=from_font,
+                                                          to_font=to_font,
+                                                          known_unicode_fonts=known_unicode_fonts,
+                                                          coalesce_runs=coalesce_runs)
 
-            # Process shapes. They lie inside "w:p" (Main paragraphs), find them. Shapes wont be processed in
-            # "body_paragraph" and SHOULD NOT BE as content in shape lie much deeper
-            if "shape" in components:
-                for paragraph in general_paragraphs:
-                    tbx_content = paragraph.iter(
-                        "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}txbxContent")
-                    # They contain  data for (t)e(x)t(b)o(x)/Shapes. They content another "w:p" which has actual
-                    # text content
-                    for txbx in tbx_content:
-                        paragraphs = txbx.iterfind(
-                            "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}p")
-                        self.__handle_wp_containers_in_paragraphs(paragraphs,
-                                                                  from_font=from_font,
-                                                                  to_font=to_font,
-                                                                  known_unicode_fonts=known_unicode_fonts)
-
-        # Make a temp directory for working, extract the original docx file in that temp directory
-        # Replace content of document.xml in temporary directory with modified xml data . Repack everything back
-        # And save the resulting package with the passed filename
-
-        tmp_dir = tempfile.mkdtemp()
-        self.__register_namespaces(StringIO(xml_string))
-        tree.write(os.path.join(tmp_dir, "document.xml"), encoding="utf-8",xml_declaration=True)
-        with open(os.path.join(tmp_dir, "document.xml"), "r", encoding="utf-8", errors="ignore") as f:
-            xml_content = f.read()
-        self.__save_docx(xml_content, output_file_path, original_file_path)
-        shutil.rmtree(tmp_dir)
+    @staticmethod
+    def __stream_xml(source, target, is_open_element, handle_unit):
+        # Rewrite the XML read from the binary stream source into target one element at a time. Elements for which
+        # is_open_element(element, depth) is true (the root and w:body for document.xml) are written tag by tag,
+        # every other element below them is passed to handle_unit(element, depth) once complete, then serialized
+        # and dropped. Namespaces are registered from the same single pass over the input. Elements are written
+        # with the prefixes of the input, namespaces are only declared where the input declares them
+        parser = ET.XMLPullParser(events=("start-ns", "start", "end"))
+        # The xml prefix is bound without being declared
+        prefixes = {"http://www.w3.org/XML/1998/namespace": "xml"}
+        declarations = []
+        # Namespaces declared by elements below the open ones
+        local_declarations = {}
+        # [element, is open element, its text was already written]
+        stack = []
+        pending_tail = [None]
+
+        def qualified_name(name):
+            if name[:1] != "{":
+                return name
+            uri, local_name = name[1:].split("}", 1)
+            return prefixes[uri] + ":" + local_name if prefixes.get(uri) else local_name
+
+        def start_tag(element, element_declarations):
+            attributes = ["xmlns:" + prefix + "=" + quote_attribute(uri) if prefix
+                          else "xmlns=" + quote_attribute(uri) for prefix, uri in element_declarations]
+            attributes += [qualified_name(name) + "=" + quote_attribute(value)
+                           for name, value in element.attrib.items()]
+            return " ".join([qualified_name(element.tag)] + attributes)
+
+        def serialize(element, chunks):
+            # Same output as ElementTree, without declaring the namespaces again on every element
+            tag = start_tag(element, local_declarations.pop(element, ()))
+            if element.text or len(element):
+                chunks.append("<{}>".format(tag))
+                if element.text:
+                    chunks.append(escape(element.text))
+                for child in element:
+                    serialize(child, chunks)
+                    if child.tail:
+                        chunks.append(escape(child.tail))
+                chunks.append("</{}>".format(qualified_name(element.tag)))
+            else:
+                chunks.append("<{} />".format(tag))
+
+        def flush_text():
+            # Text of an open parent and tail of the previous complete sibling are only known once the next event
+            # arrives
+            if pending_tail[0] is not None:
+                target.write(escape(pending_tail[0].tail or "").encode("utf-8"))
+                pending_tail[0] = None
+            if stack and stack[-1][1] and not stack[-1][2]:
+                target.write(escape(stack[-1][0].text or "").encode("utf-8"))
+                stack[-1][2] = True
+
+        def handle_events():
+            for event, item in parser.read_events():
+                if event == "start-ns":
+                    prefix, uri = item
+                    ET.register_namespace(prefix, uri)
+                    prefixes[uri] = prefix
+                    declarations.append((prefix, uri))
+                elif event == "start":
+                    depth = len(stack)
+                    parent_open = not stack or stack[-1][1]
+                    if parent_open:
+                        flush_text()
+                    is_open = parent_open and is_open_element(item, depth)
+                    if is_open:
+                        target.write("<{}>".format(start_tag(item, declarations)).encode("utf-8"))
+                    elif declarations:
+                        local_declarations[item] = list(declarations)
+                    del declarations[:]
+                    stack.append([item, is_open, False])
+                else:
+                    element, is_open, _ = stack[-1]
+                    if is_open:
+                        flush_text()
+                    stack.pop()
+                    if is_open:
+                        target.write("</{}>".format(qualified_name(element.tag)).encode("utf-8"))
+                    elif not stack or not stack[-1][1]:
+                        continue
+                    else:
+                        handle_unit(element, len(stack))
+                        chunks = []
+                        serialize(element, chunks)
+                        target.write("".join(chunks).encode("utf-8"))
+                        stack[-1][0].remove(element)
+                    pending_tail[0] = element
+
+        target.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+        for data in iter(lambda: source.read(STREAM_CHUNK_SIZE), b""):
+            parser.feed(data)
+            handle_events()
+        parser.close()
+        handle_events()
+        if pending_tail[0] is not None and pending_tail[0].tail:
+            target.write(escape(pending_tail[0].tail).encode("utf-8"))
+
+    def __stream_document(self, original_file_path, target, **options):
+        def is_open_element(element, depth):
+            return depth == 0 or (depth == 1 and element.tag ==
+                                  "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}body")
+
+        def handle_unit(element, depth):
+            if depth == 2:
+                self.__handle_body_child(element, **options)
+
+        with instrumentation.timed("docx.stream_document"), zipfile.ZipFile(original_file_path) as zf:
+            with zf.open(DOCUMENT_PART) as source:
+                self.__stream_xml(source, target, is_open_element, handle_unit)
+
+    def map_xml_part(self, xml_content, from_font="auto", to_font="unicode", components=None,
+                     known_unicode_fonts=None, coalesce_runs=False):
+        # Map one story part (document.xml, a header, the footnotes...) given as bytes and return the mapped part.
+        # components selects which of the paragraphs, tables and shapes are mapped
+        root = self.__parse_xml(xml_content, register_namespaces=True)
+        return self.__map_tree(root, from_font, to_font, components, known_unicode_fonts, coalesce_runs)
+
+    def __map_tree(self, root, from_font, to_font, components, known_unicode_fonts, coalesce_runs=False):
+        if components is None:
+            components = CONTENT_COMPONENTS
+        # The paragraphs and tables lie inside "w:body" for the document, directly inside the root for headers and
+        # footers and inside each "w:footnote"/"w:endnote"/"w:comment" of the other parts
+        containers = [root] if root.tag in STORY_CONTAINER_TAGS else root
+        with instrumentation.timed("docx.map"):
+            for container in containers:
+                if container.tag in STORY_CONTAINER_TAGS:
+                    for child in container:
+                        self.__handle_body_child(child, from_font=from_font, to_font=to_font, components=components,
+                                                 known_unicode_fonts=known_unicode_fonts,
+                                                 coalesce_runs=coalesce_runs)
+        with instrumentation.timed("docx.serialize") as timer:
+            xml = BytesIO()
+            ET.ElementTree(root).write(xml, encoding="utf-8", xml_declaration=True)
+            timer.chars = xml.tell()
+            return xml.getvalue()
+
+    def map_fonts(self, original_file_path, output_file_path="mapped.docx", from_font="auto", to_font="unicode",
+                  components=None, known_unicode_fonts=None, low_memory=False, jobs=1, scan=None,
+                  coalesce_runs=False):
+        # original_file_path and output_file_path can also be binary file objects. With low_memory document.xml is
+        # rewritten as it is parsed, so only one paragraph/table is in memory at a time instead of the whole
+        # document. With jobs > 1 the story parts are mapped by that many worker processes while the output archive
+        # is written. scan is a DocxScan of the file (see detect_used_fonts), made here when not given, the fonts of
+        # the parts are only scanned in auto mode. In auto mode parts in which it finds no supported font are copied
+        # without being parsed, a file without any is copied as it is. With coalesce_runs adjacent runs with the same
+        # properties are merged before being mapped
+        if known_unicode_fonts is None:
+            known_unicode_fonts = []
+        if components is None:
+            components = DEFAULT_COMPONENTS
+        # Fail before writing anything when the source or target font is unknown
+        if from_font != "auto" and from_font.lower() != "unicode" and from_font not in self.supported_ttf_fonts:
+            raise NoMapForOriginException
+        if to_font.lower() != "unicode":
+            self.mapper.get_font_name(to_font)
+        if scan is None:
+            scan = self.scan(original_file_path, low_memory, scan_fonts=from_font == "auto")
+        options = {"from_font": from_font, "to_font": to_font, "known_unicode_fonts": known_unicode_fonts,
+                   "coalesce_runs": coalesce_runs}
+
+        def needs_mapping(part_name):
+            return from_font != "auto" or scan.uses_fonts(part_name, self.supported_ttf_fonts)
+
+        parts = [(name, CONTENT_COMPONENTS) for name, component in scan.story_parts
+                 if component in components and needs_mapping(name)]
+        stream_document = low_memory and needs_mapping(DOCUMENT_PART)
+        if not low_memory and needs_mapping(DOCUMENT_PART):
+            parts.insert(0, (DOCUMENT_PART, components))
+        replacements = {}
+        executor = None
+        if jobs > 1 and len(parts) + stream_document > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=min(jobs, len(parts)), initializer=_init_worker,
+                                           initargs=(self.rules_file, self.default_unicode_font_name,
+                                                     self.mapper.cache.maxsize))
+        try:
+            with zipfile.ZipFile(original_file_path) as zf:
+                for name, part_components in parts:
+                    if name in scan.trees:
+                        # Already parsed by detect_used_fonts()
+                        replacements[name] = self.__map_tree(scan.trees.pop(name), components=part_components,
+                                                             **options)
+                    elif executor is None:
+                        replacements[name] = self.map_xml_part(scan.read(zf, name), components=part_components,
+                                                               **options)
+                    else:
+                        # Written once the worker is done, meanwhile the parts before it are copied
+                        future = executor.submit(_map_part, scan.read(zf, name), options, part_components)
+                        replacements[name] = lambda target, mapped=future: target.write(mapped.result())
+            if stream_document:
+                replacements[DOCUMENT_PART] = lambda target: self.__stream_document(
+                    original_file_path, target, components=components, **options)
+            # Serialize every mapped part and repack them with the other parts of the original docx package
+            self.__save_docx(replacements, output_file_path, original_file_path)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    async def amap_fonts(self, original_file_path, output_file_path=None, from_font="auto", to_font="unicode",
+                         components=None, known_unicode_fonts=None, low_memory=False, jobs=1, coalesce_runs=False):
+        # map_fonts() for asyncio code, run in the shared executor (see executor.py). original_file_path can also be
+        # a file object or the bytes of the file. Returns the bytes of the mapped file when output_file_path is None
+        from .executor import run_in_executor, map_to_output
+        return await run_in_executor(map_to_output, self.map_fonts, original_file_path, output_file_path,
+                                     from_font=from_font, to_font=to_font, components=components,
+                                     known_unicode_fonts=known_unicode_fonts, low_memory=low_memory, jobs=jobs,
+                                     coalesce_runs=coalesce_runs)
@@ -13,6 +13,16 @@ class TxtAutoModeException(Exception):
     pass
 
 
+# Batch converter exceptions (two input files converted to the same output path)
+class BatchOutputCollisionException(Exception):
+    pass
+
+
 # Exception for when map file is not found
 class MapFileNotFoundException(Exception):
     pass
+
+
+# Tabular file handler exceptions (unknown column, malformed record)
+class TabularFileException(Exception):
+    pass
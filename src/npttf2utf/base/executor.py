@@ -0,0 +1,85 @@
+import asyncio
+import functools
+import os
+import threading
+import weakref
+from io import BytesIO
+
+# Executor shared by the async APIs (FontMapper.amap_*, TxtHandler.amap_fonts, DocxHandler.amap_fonts), which run
+# the blocking conversions there instead of on the event loop. It is a thread pool unless configure_executor() is
+# given another executor running the work in the same process (the work items are bound methods of handlers)
+_executor = None
+# True when _executor was created here, and so is shut down here when replaced
+_owns_executor = False
+_max_concurrency = None
+_configure_lock = threading.Lock()
+# Limit on the conversions running or waiting in the executor, one semaphore per event loop
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_default_max_concurrency():
+    return os.cpu_count() or 1
+
+
+def configure_executor(executor=None, max_concurrency=None):
+    # Use executor (a new thread pool by default) for the async APIs, with at most max_concurrency conversions
+    # (the number of CPUs by default) submitted to it at a time, the others waiting on the event loop. The previous
+    # shared executor is shut down when it was created here
+    global _executor, _owns_executor, _max_concurrency
+    with _configure_lock:
+        previous = _executor if _owns_executor else None
+        _max_concurrency = max_concurrency or get_default_max_concurrency()
+        _owns_executor = executor is None
+        _executor = executor if executor is not None else _new_executor(_max_concurrency)
+        _semaphores.clear()
+    if previous is not None:
+        previous.shutdown(wait=False)
+
+
+def _new_executor(max_workers):
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="npttf2utf")
+
+
+def get_executor():
+    # The shared executor, created on first use
+    global _executor, _owns_executor, _max_concurrency
+    with _configure_lock:
+        if _executor is None:
+            _max_concurrency = _max_concurrency or get_default_max_concurrency()
+            _owns_executor = True
+            _executor = _new_executor(_max_concurrency)
+        return _executor
+
+
+def _get_semaphore(loop):
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(_max_concurrency)
+    return semaphore
+
+
+async def run_in_executor(function, *args, **kwargs):
+    # Run function(*args, **kwargs) in the shared executor once fewer than max_concurrency conversions are running
+    executor = get_executor()
+    loop = asyncio.get_running_loop()
+    async with _get_semaphore(loop):
+        return await loop.run_in_executor(executor, functools.partial(function, *args, **kwargs))
+
+
+def as_file_object(source):
+    # bytes-like input as a binary file object, paths and file objects as they are
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return BytesIO(source)
+    return source
+
+
+def map_to_output(map_fonts, source, output_file_path, **options):
+    # Run a handler's map_fonts() on source (a path, a file object or bytes). Returns the bytes of the mapped file
+    # when output_file_path is None
+    source = as_file_object(source)
+    if output_file_path is not None:
+        return map_fonts(source, output_file_path, **options)
+    output = BytesIO()
+    map_fonts(source, output, **options)
+    return output.getvalue()
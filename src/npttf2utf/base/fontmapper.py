@@ -1,45 +1,171 @@
-import re
-import json
+import collections
+import itertools
 import html
-from .exceptions import NoMapForOriginException, MapFileNotFoundException
-from .preetimapper import convert as pmconvert
+import threading
+from .exceptions import NoMapForOriginException, MapFileNotFoundException, UnsupportedMapToException
+from .ruleengine import RuleEngine
+from .mappingcache import MappingCache
+from .fonttransform import FontTransform
+from .mapcache import MapDefinition, get_cache_directory
+from . import instrumentation
 import os
 
+# Number of mapped strings kept by default in the cache of a FontMapper
+DEFAULT_CACHE_SIZE = 4096
+# Longer strings (whole lines or chunks of text files) are rarely repeated and are never cached
+MAX_CACHED_LENGTH = 256
+# Number of strings sent to a worker process at once by map_many()
+MAP_MANY_BATCH_SIZE = 4096
+# Number of mapped strings map_many() remembers with dedupe, the least recently seen ones are forgotten first
+DEDUPE_MEMO_SIZE = 1 << 16
+# Whitespace character joining the strings of a batch into one buffer, see _map_joined()
+BATCH_SEPARATOR = "\u2029"
+
+# Mappers shared through FontMapper.get(), by (class, real path of the mapping definition, cache size), along with
+# the modification time of the file they were loaded from
+_shared_mappers = {}
+_shared_mappers_lock = threading.Lock()
+
+# Mapper of the current worker process of FontMapper.map_many()
+_worker_mapper = None
+
+
+def _init_worker(map_json):
+    global _worker_mapper
+    _worker_mapper = FontMapper(map_json, cache_size=0)
+
+
+def _map_batch(strings, from_font, to_font, dedupe):
+    return list(_worker_mapper.map_many(strings, from_font, to_font, dedupe=dedupe))
+
+
+def _map_joined(engine, strings):
+    # A buffer safe engine never maps across whitespace and keeps whitespace as it is, so strings joined with a
+    # whitespace character missing from its character map come back separated by that same character
+    joined = BATCH_SEPARATOR.join(strings)
+    if strings and joined.count(BATCH_SEPARATOR) == len(strings) - 1:
+        mapped = engine.map_buffer(joined).split(BATCH_SEPARATOR)
+        if len(mapped) == len(strings):
+            return mapped
+    return [engine.map(string) for string in strings]
+
 
 class FontMapper:
-    def __init__(self, map_json=None):
+    def __init__(self, map_json=None, cache_size=DEFAULT_CACHE_SIZE, compiled_cache=True):
         if map_json is None:
             # If user does not provide map_json, use the default one in the project
             map_json = self.get_default_map_json()
+        self.map_json = map_json
         try:
-            self.all_rules = json.load(open(map_json, 'r', encoding='utf-8'))
+            # Definitions and compiled rules of each font are loaded from the compiled map cache when the file
+            # did not change since the last run, see mapcache.py
+            with instrumentation.timed("mapper.load_definition"):
+                self.all_rules = MapDefinition(map_json, get_cache_directory() if compiled_cache else None)
         except FileNotFoundError as e:
             raise MapFileNotFoundException(str(e))
         self.supported_maps = list(self.all_rules.keys())
         self.supported_maps.append("Unicode")
         self.known_devanagari_unicode_fonts = ["Kalimati", "Mangal", "Noto Sans Devanagari"]
+        # Compiled rules of each font, built the first time the font is used
+        self.rule_engines = {}
+        # Direct font to font transforms, compiled the first time a pair of fonts is used
+        self.font_transforms = {}
+        # Documents repeat the same short texts (labels, table headers, numbering) many times, their mapping is
+        # looked up here before running the rules again
+        self.cache = MappingCache(cache_size)
+        # Guards the compilation of rule engines and font transforms when the mapper is shared between threads
+        self.__compile_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, map_json=None, cache_size=DEFAULT_CACHE_SIZE):
+        # Shared mapper of the mapping definition file map_json, loaded on the first call and returned by every later
+        # call from any thread until the file is modified. Meant for services creating handlers on demand, which
+        # then neither parse the file nor compile the rules again. Shared mappers must not be modified
+        if map_json is None:
+            map_json = cls.get_default_map_json()
+        path = os.path.realpath(map_json)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError as e:
+            raise MapFileNotFoundException(str(e))
+        key = (cls, path, cache_size)
+        with _shared_mappers_lock:
+            shared = _shared_mappers.get(key)
+            if shared is None or shared[0] != mtime:
+                shared = (mtime, cls(map_json, cache_size))
+                _shared_mappers[key] = shared
+        return shared[1]
 
     @staticmethod
     def get_default_map_json():
         return os.path.join(os.path.dirname(os.path.realpath(__file__)), "../map.json")
 
+    def get_rule_engine(self, font):
+        engine = self.rule_engines.get(font)
+        if engine is None:
+            if font not in self.all_rules:
+                raise NoMapForOriginException
+            with self.__compile_lock:
+                engine = self.rule_engines.get(font)
+                if engine is None:
+                    with instrumentation.timed("mapper.load_compiled"):
+                        engine = self.all_rules.load_engine(font)
+                    if engine is None:
+                        with instrumentation.timed("mapper.compile"):
+                            engine = RuleEngine.from_definition(font, self.all_rules[font])
+                        self.all_rules.store_engine(font, engine)
+                    self.rule_engines[font] = engine
+        return engine
+
+    def get_font_name(self, font):
+        # Name of font in the mapping definition, ignoring case
+        for name in self.all_rules:
+            if name.lower() == font.lower():
+                return name
+        if font.lower() == "preeti":
+            # preetimapper maps to Preeti even without its definition
+            return "Preeti"
+        raise UnsupportedMapToException
+
+    def get_font_transform(self, from_font, to_font):
+        # FontTransform between two fonts of the mapping definition, None when they do not share their rules
+        key = (from_font, to_font)
+        if key not in self.font_transforms:
+            with self.__compile_lock:
+                if key not in self.font_transforms:
+                    with instrumentation.timed("mapper.compile"):
+                        self.font_transforms[key] = FontTransform.compile(
+                            from_font, self.all_rules[from_font]['rules'], to_font, self.all_rules[to_font]['rules'])
+        return self.font_transforms[key]
+
+    def cache_info(self):
+        # (hits, misses, maxsize, currsize) of the mapping cache
+        return self.cache.info()
+
+    def cache_clear(self):
+        self.cache.clear()
+
+    def __map_cached(self, string, from_font, to_font, map_function):
+        if len(string) > MAX_CACHED_LENGTH or not self.cache.maxsize:
+            return map_function(string)
+        key = (from_font, to_font, string)
+        mapped_string = self.cache.get(key)
+        if mapped_string is None:
+            mapped_string = map_function(string)
+            self.cache.put(key, mapped_string)
+            if instrumentation.recording:
+                instrumentation.record("mapper.cache_miss", chars=len(string))
+        elif instrumentation.recording:
+            instrumentation.record("mapper.cache_hit", chars=len(string))
+        return mapped_string
+
     def map_to_unicode(self, string, from_font="Preeti", unescape_html_input=False, escape_html_output=False):
         if not from_font.lower() == "unicode":
             if from_font in self.supported_maps:
                 if unescape_html_input:
                     string = html.unescape(string)
 
-                rules = self.all_rules[from_font]['rules']
-                split_pattern = re.compile(r'(\s+|\S+)')
-                mapped_string = ''
-
-                for word in re.findall(split_pattern, string):
-                    for rule in rules['pre-rules']:
-                        word = re.sub(re.compile(rule[0]), rule[1], word)
-                    mapped_word = ''.join(rules['character-map'].get(character, character) for character in word)
-                    for rule in rules['post-rules']:
-                        mapped_word = re.sub(re.compile(rule[0]), rule[1], mapped_word)
-                    mapped_string = mapped_string + mapped_word
+                mapped_string = self.__map_cached(string, from_font, "unicode", self.get_rule_engine(from_font).map)
                 if escape_html_output:
                     return html.escape(mapped_string)
                 else:
@@ -49,17 +175,138 @@ class FontMapper:
         else:
             return string
 
-    def map_to_preeti(self, string, from_font="Preeti", unescape_html_input=False, escape_html_output=False):
+    def __map_to_unicode_uncached(self, string, from_font):
+        if from_font.lower() == "unicode":
+            return string
+        if from_font not in self.supported_maps:
+            raise NoMapForOriginException
+        return self.get_rule_engine(from_font).map(string)
+
+    def __map_to_font_uncached(self, string, from_font, to_font):
+        if from_font.lower() != "unicode":
+            if from_font not in self.supported_maps:
+                raise NoMapForOriginException
+            # Rewrite the characters directly when both fonts allow it
+            if to_font in self.all_rules:
+                transform = self.get_font_transform(from_font, to_font)
+                if transform is not None and transform.supports(string):
+                    return instrumentation.instrument(transform.map, "mapper.font_transform")(string)
+        # Otherwise go through unicode. preetimapper gives Preeti text, which is then rewritten to the target font
+        # (characters the target font has no equivalent for are left as they are). preetimapper compiles its rules
+        # when imported, only mappings to a font need it
+        from .preetimapper import convert as pmconvert
+        preeti_string = instrumentation.instrument(pmconvert, "mapper.preetimapper")(
+            self.__map_to_unicode_uncached(string, from_font))
+        if to_font == "Preeti":
+            return preeti_string
+        if "Preeti" not in self.all_rules or self.get_font_transform("Preeti", to_font) is None:
+            raise UnsupportedMapToException
+        return instrumentation.instrument(self.get_font_transform("Preeti", to_font).map,
+                                          "mapper.font_transform")(preeti_string)
+
+    def map_to_font(self, string, from_font="Preeti", to_font="unicode", unescape_html_input=False,
+                    escape_html_output=False):
+        # Map string written in from_font to to_font, which is "unicode" or any font of the mapping definition
+        if to_font.lower() == "unicode":
+            return self.map_to_unicode(string, from_font, unescape_html_input, escape_html_output)
+        to_font = self.get_font_name(to_font)
         if unescape_html_input:
             string = html.unescape(string)
-        if not from_font.lower() == "preeti":
-            # Map the string to unicode first
-            unicode_mapped_string = self.map_to_unicode(string, from_font)
-            # Now map the unicode to preeti
-            mapped_string = pmconvert(unicode_mapped_string)
+        if not from_font.lower() == to_font.lower():
+            mapped_string = self.__map_cached(string, from_font, to_font,
+                                              lambda text: self.__map_to_font_uncached(text, from_font, to_font))
             if escape_html_output:
                 return html.escape(mapped_string)
             else:
                 return mapped_string
         else:
             return string
+
+    def map_to_preeti(self, string, from_font="Preeti", unescape_html_input=False, escape_html_output=False):
+        return self.map_to_font(string, from_font, "Preeti", unescape_html_input, escape_html_output)
+
+    async def amap_to_font(self, string, from_font="Preeti", to_font="unicode", unescape_html_input=False,
+                           escape_html_output=False):
+        # map_to_font() for asyncio code. Strings longer than MAX_CACHED_LENGTH are mapped in the shared executor
+        # (see executor.py), shorter ones right away as handing them over would take longer than mapping them
+        if len(string) <= MAX_CACHED_LENGTH:
+            return self.map_to_font(string, from_font, to_font, unescape_html_input, escape_html_output)
+        from .executor import run_in_executor
+        return await run_in_executor(self.map_to_font, string, from_font, to_font, unescape_html_input,
+                                     escape_html_output)
+
+    async def amap_to_unicode(self, string, from_font="Preeti", unescape_html_input=False, escape_html_output=False):
+        return await self.amap_to_font(string, from_font, "unicode", unescape_html_input, escape_html_output)
+
+    async def amap_to_preeti(self, string, from_font="Preeti", unescape_html_input=False, escape_html_output=False):
+        return await self.amap_to_font(string, from_font, "Preeti", unescape_html_input, escape_html_output)
+
+    def __get_string_mapper(self, from_font, to_font):
+        # Function mapping a single string from from_font to to_font, with every font lookup already done
+        if to_font.lower() == "unicode":
+            if from_font.lower() == "unicode":
+                return str
+            if from_font not in self.supported_maps:
+                raise NoMapForOriginException
+            return self.get_rule_engine(from_font).map
+        to_font = self.get_font_name(to_font)
+        if from_font.lower() == to_font.lower():
+            return str
+        if from_font.lower() != "unicode" and from_font not in self.supported_maps:
+            raise NoMapForOriginException
+        return lambda string: self.__map_to_font_uncached(string, from_font, to_font)
+
+    def __get_batch_mapper(self, from_font, to_font):
+        # Function mapping a list of strings from from_font to to_font
+        if to_font.lower() == "unicode" and from_font.lower() != "unicode":
+            if from_font not in self.supported_maps:
+                raise NoMapForOriginException
+            engine = self.get_rule_engine(from_font)
+            if engine.buffer_safe and ord(BATCH_SEPARATOR) not in engine.translation_table:
+                return lambda strings: _map_joined(engine, strings)
+        map_string = self.__get_string_mapper(from_font, to_font)
+        return lambda strings: [map_string(string) for string in strings]
+
+    @staticmethod
+    def __map_batches(strings, map_batch, dedupe, batch_size):
+        memo = MappingCache(DEDUPE_MEMO_SIZE)
+        for batch in iter(lambda: list(itertools.islice(strings, batch_size)), []):
+            if dedupe:
+                known = {}
+                new_strings = []
+                for string in dict.fromkeys(batch):
+                    mapped = memo.get(string)
+                    if mapped is None:
+                        new_strings.append(string)
+                    else:
+                        known[string] = mapped
+                for string, mapped in zip(new_strings, map_batch(new_strings)):
+                    known[string] = mapped
+                    memo.put(string, mapped)
+                yield from [known[string] for string in batch]
+            else:
+                yield from map_batch(batch)
+
+    def __map_many_parallel(self, strings, from_font, to_font, dedupe, jobs, batch_size):
+        # Batches are mapped by the worker processes and yielded in order, with a bounded number of them in flight
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(self.map_json,)) as executor:
+            pending = collections.deque()
+            for batch in iter(lambda: list(itertools.islice(strings, batch_size)), []):
+                pending.append(executor.submit(_map_batch, batch, from_font, to_font, dedupe))
+                if len(pending) >= 2 * jobs:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def map_many(self, strings, from_font="Preeti", to_font="unicode", dedupe=False, jobs=1,
+                 batch_size=MAP_MANY_BATCH_SIZE):
+        # Map every string of the iterable strings from from_font to to_font ("unicode" or a font of the mapping
+        # definition). Returns an iterator over the results in input order. Fonts are looked up once and strings
+        # are mapped batch_size at a time, joined into a single buffer when the rules allow it. The mapping cache
+        # is bypassed, with dedupe identical strings are mapped only once instead, as long as they are among the
+        # last DEDUPE_MEMO_SIZE distinct ones. With jobs > 1 the batches are mapped by that many worker processes
+        map_batch = self.__get_batch_mapper(from_font, to_font)
+        if jobs > 1:
+            return self.__map_many_parallel(iter(strings), from_font, to_font, dedupe, jobs, batch_size)
+        return self.__map_batches(iter(strings), map_batch, dedupe, batch_size)
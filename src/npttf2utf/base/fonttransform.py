@@ -0,0 +1,89 @@
+def single_character_map(character_map):
+    # Only single character keys of "character-map" are used while mapping, see RuleEngine.build_translation_table
+    return {character: mapped for character, mapped in character_map.items() if len(character) == 1}
+
+
+def reverse_character_map(character_map):
+    # Unicode (or rule marker) text -> character of the font mapped to it. When several characters map to the same
+    # text the first one of the map is kept
+    reverse = {}
+    for character, mapped in single_character_map(character_map).items():
+        if mapped:
+            reverse.setdefault(mapped, character)
+    return reverse
+
+
+def spell_in_font(text, character_map, reverse_map):
+    # Shortest string in a font whose character map output is text, None if the font cannot produce it. Characters
+    # missing from the map stand for themselves
+    longest = max([len(mapped) for mapped in reverse_map] + [1])
+    spellings = [''] + [None] * len(text)
+    for end in range(1, len(text) + 1):
+        for start in range(max(0, end - longest), end):
+            if spellings[start] is None:
+                continue
+            piece = text[start:end]
+            character = reverse_map.get(piece)
+            if character is None and len(piece) == 1 and piece not in character_map:
+                character = piece
+            if character is not None and (spellings[end] is None or len(spellings[start]) + 1 < len(spellings[end])):
+                spellings[end] = spellings[start] + character
+    return spellings[-1]
+
+
+def _keeps_token(character, spelling):
+    # Text is mapped token by token (runs of whitespace/non whitespace), a rewrite must not move token boundaries
+    if character.isspace():
+        return len(spelling) == 1 and spelling.isspace()
+    return bool(spelling) and not any(piece.isspace() for piece in spelling)
+
+
+class FontTransform:
+    # Direct conversion of text written in one legacy font to another legacy font, without going through unicode.
+    # It is only compiled for fonts sharing the same rules: every character is then rewritten to the characters of
+    # the target font which its character map sends to the same text, so that mapping the result to unicode with
+    # the target font gives exactly what mapping the original with the source font gives. Characters the target
+    # font has no such rewrite for are listed in "unsupported" and are left as they are by map()
+    __slots__ = ('from_font', 'to_font', 'table', 'unsupported')
+
+    def __init__(self, from_font, to_font, table, unsupported):
+        self.from_font = from_font
+        self.to_font = to_font
+        self.table = table
+        self.unsupported = frozenset(unsupported)
+
+    def __repr__(self):
+        return "<FontTransform {!r} -> {!r}>".format(self.from_font, self.to_font)
+
+    @classmethod
+    def compile(cls, from_font, from_rules, to_font, to_rules):
+        # from_rules/to_rules are the "rules" of the fonts in map.json. Returns None unless neither font has
+        # pre-rules and both share their post-rules, no character level rewrite is exact otherwise: pre-rules
+        # rewrite the text of the font before its character map, which the table below does not replay
+        if any(rule for rule in from_rules.get('pre-rules', [])) or any(rule for rule in to_rules.get('pre-rules', [])):
+            return None
+        if [rule for rule in from_rules.get('post-rules', []) if rule] != \
+                [rule for rule in to_rules.get('post-rules', []) if rule]:
+            return None
+        source_map = single_character_map(from_rules.get('character-map', {}))
+        target_map = single_character_map(to_rules.get('character-map', {}))
+        reverse_map = reverse_character_map(target_map)
+        table = {}
+        unsupported = []
+        # Characters missing from both maps are unicode text in both fonts and never change
+        for character in list(source_map) + [character for character in target_map if character not in source_map]:
+            meaning = source_map.get(character, character)
+            if target_map.get(character, character) == meaning:
+                continue
+            spelling = spell_in_font(meaning, target_map, reverse_map)
+            if spelling is None or not _keeps_token(character, spelling):
+                unsupported.append(character)
+            else:
+                table[ord(character)] = spelling
+        return cls(from_font, to_font, table, unsupported)
+
+    def supports(self, string):
+        return self.unsupported.isdisjoint(string)
+
+    def map(self, string):
+        return string.translate(self.table)
@@ -0,0 +1,333 @@
+from html.parser import HTMLParser
+from .fontmapper import FontMapper, DEFAULT_CACHE_SIZE
+from .textstream import open_text_input, open_text_output, close_text_stream, last_token_start, CHUNK_SIZE
+from . import instrumentation
+import html
+import re
+
+# Elements that never have content or an end tag
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source",
+                 "track", "wbr"}
+# Elements whose content is never mapped
+RAW_TEXT_ELEMENTS = {"script", "style"}
+# Elements whose end tag is often left out, an open one is closed by the start tag of the next one
+IMPLIED_END_ELEMENTS = {"p", "li", "dt", "dd", "option", "tr", "td", "th"}
+# Number of distinct start tags whose font declaration is remembered
+MAX_CACHED_START_TAGS = 4096
+# Font declarations of a start tag: the "face" attribute of <font> and the font-family of an inline style. Only the
+# first family of a list is looked at, it is the one used when the font is installed
+FACE_ATTRIBUTE = re.compile(r'(\sface\s*=\s*)(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'=<>`]+))', re.I)
+STYLE_ATTRIBUTE = re.compile(r'(\sstyle\s*=\s*)(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'=<>`]+))', re.I)
+FONT_FAMILY = re.compile(r'(font-family\s*:\s*)([^;]*)', re.I)
+
+
+def _get_attribute_value(match):
+    for group in (2, 3, 4):
+        if match.group(group) is not None:
+            return html.unescape(match.group(group))
+
+
+def _split_first_family(families):
+    # (first family name without its quotes, rest of the list) of a comma separated list of font families
+    first, separator, rest = families.partition(",")
+    return first.strip().strip("\"'").strip(), separator + rest
+
+
+def _get_declared_font(attrs):
+    # Font declared by the attributes of a start tag, None when it has none. An inline style overrides "face"
+    declared = None
+    for name, value in attrs:
+        if value is None:
+            continue
+        if name == "style":
+            family = FONT_FAMILY.search(value)
+            if family is not None:
+                return _split_first_family(family.group(2))[0] or None
+        elif name == "face":
+            declared = _split_first_family(value)[0] or None
+    return declared
+
+
+class _FontCollector(HTMLParser):
+    # Collects the fonts declared by the start tags of a document
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.fonts = []
+
+    def handle_starttag(self, tag, attrs):
+        font = _get_declared_font(attrs)
+        if font is not None and font not in self.fonts:
+            self.fonts.append(font)
+
+    handle_startendtag = handle_starttag
+
+
+class _FontRewriter(HTMLParser):
+    # Writes the document back as it is read, event by event. Text inside an element whose font (declared by the
+    # element or one of its ancestors) is mapped goes through map_text, the font declarations of those elements are
+    # renamed to target_font. Everything else is written as it was read. Text is held back until the next tag so
+    # that words split across the fed chunks are mapped whole
+
+    def __init__(self, write, map_text, get_source_font, target_font, root_source):
+        super().__init__(convert_charrefs=False)
+        self.__write = write
+        self.__map_text = map_text
+        self.__get_source_font = get_source_font
+        self.__target_font = target_font
+        self.__root_source = root_source
+        # (tag, source font) of the open elements
+        self.__open_elements = []
+        # Text of the current mapped scope, with its character references resolved
+        self.__pending_text = []
+        self.__pending_length = 0
+        self.__end_tag_start = None
+        # {start tag text: (whether it declares a font, source font, start tag to write)}
+        self.__declarations = {}
+
+    def __get_source(self):
+        return self.__open_elements[-1][1] if self.__open_elements else self.__root_source
+
+    def __flush(self, keep_last_token=False):
+        # Map and write the pending text. With keep_last_token the trailing word (or whitespace) is kept pending,
+        # as more of it may follow
+        text = "".join(self.__pending_text)
+        self.__pending_text = []
+        self.__pending_length = 0
+        if keep_last_token:
+            cut = last_token_start(text)
+            if cut:
+                self.__pending_text.append(text[cut:])
+                self.__pending_length = len(text) - cut
+                text = text[:cut]
+        if text:
+            self.__write(html.escape(self.__map_text(text, self.__get_source()), quote=False))
+
+    def __add_text(self, text):
+        self.__pending_text.append(text)
+        self.__pending_length += len(text)
+        if self.__pending_length >= CHUNK_SIZE:
+            # Keep memory bounded on huge text nodes
+            self.__flush(keep_last_token=True)
+
+    def __write_markup(self, markup):
+        if self.__pending_text:
+            self.__flush()
+        self.__write(markup)
+
+    def __rename_first_family(self, families, quote_name):
+        name, rest = _split_first_family(families)
+        if not name or self.__get_source_font(name) is None:
+            return families
+        target = self.__target_font
+        if quote_name and re.search(r'[^\w-]', target):
+            target = "'{}'".format(target)
+        return families[:len(families) - len(families.lstrip())] + target + rest
+
+    def __rewrite_attribute(self, tag_text, attribute, rewrite_value):
+        match = attribute.search(tag_text)
+        if match is None:
+            return tag_text
+        value = _get_attribute_value(match)
+        new_value = rewrite_value(value)
+        if new_value == value:
+            return tag_text
+        quote = "'" if match.group(3) is not None else '"'
+        return "{}{}{}{}{}{}".format(tag_text[:match.start()], match.group(1), quote, html.escape(new_value), quote,
+                                     tag_text[match.end():])
+
+    def __rewrite_start_tag(self, tag_text):
+        # Rename the font declarations of a start tag whose font is mapped
+        tag_text = self.__rewrite_attribute(tag_text, FACE_ATTRIBUTE,
+                                            lambda value: self.__rename_first_family(value, False))
+        return self.__rewrite_attribute(tag_text, STYLE_ATTRIBUTE, lambda value: FONT_FAMILY.sub(
+            lambda family: family.group(1) + self.__rename_first_family(family.group(2), True), value))
+
+    def __start_element(self, tag, attrs, void):
+        if self.__pending_text:
+            self.__flush()
+        if tag in IMPLIED_END_ELEMENTS and self.__open_elements and self.__open_elements[-1][0] == tag:
+            self.__open_elements.pop()
+        tag_text = self.get_starttag_text()
+        declaration = self.__declarations.get(tag_text)
+        if declaration is None:
+            # Pages repeat the same few start tags, each is looked at once
+            font = _get_declared_font(attrs)
+            if font is None:
+                declaration = (False, None, tag_text)
+            else:
+                source = self.__get_source_font(font)
+                declaration = (True, source, self.__rewrite_start_tag(tag_text) if source is not None else tag_text)
+            if len(self.__declarations) >= MAX_CACHED_START_TAGS:
+                self.__declarations.clear()
+            self.__declarations[tag_text] = declaration
+        declared, source, tag_text = declaration
+        if tag in RAW_TEXT_ELEMENTS:
+            source = None
+        elif not declared:
+            source = self.__get_source()
+        self.__write(tag_text)
+        if not void and tag not in VOID_ELEMENTS:
+            self.__open_elements.append((tag, source))
+
+    def handle_starttag(self, tag, attrs):
+        self.__start_element(tag, attrs, False)
+
+    def handle_startendtag(self, tag, attrs):
+        self.__start_element(tag, attrs, True)
+
+    def parse_endtag(self, i):
+        # Remember where the end tag starts, to write it as it was read
+        self.__end_tag_start = i
+        try:
+            return super().parse_endtag(i)
+        finally:
+            self.__end_tag_start = None
+
+    def handle_endtag(self, tag):
+        end = self.rawdata.find(">", self.__end_tag_start) + 1 if self.__end_tag_start is not None else 0
+        self.__write_markup(self.rawdata[self.__end_tag_start:end] if end else "</{}>".format(tag))
+        for index in range(len(self.__open_elements) - 1, -1, -1):
+            if self.__open_elements[index][0] == tag:
+                del self.__open_elements[index:]
+                break
+
+    def handle_data(self, data):
+        if self.__get_source() is None:
+            self.__write_markup(data)
+        else:
+            self.__add_text(data)
+
+    def __handle_reference(self, reference):
+        if self.__get_source() is None:
+            self.__write_markup(reference)
+        else:
+            self.__add_text(html.unescape(reference))
+
+    def handle_charref(self, name):
+        self.__handle_reference("&#{};".format(name))
+
+    def handle_entityref(self, name):
+        self.__handle_reference("&{};".format(name))
+
+    def handle_comment(self, data):
+        self.__write_markup("<!--{}-->".format(data))
+
+    def handle_decl(self, decl):
+        self.__write_markup("<!{}>".format(decl))
+
+    def handle_pi(self, data):
+        self.__write_markup("<?{}>".format(data))
+
+    def unknown_decl(self, data):
+        self.__write_markup("<![{}]]>".format(data))
+
+    def close(self):
+        super().close()
+        if self.__pending_text:
+            self.__flush()
+
+
+class HtmlHandler:
+    # Maps the text of HTML documents written in legacy fonts. Fonts are declared by <font face="..."> and by the
+    # font-family of inline styles, only the text inside elements whose font is mapped is mapped and those
+    # declarations are renamed. The document is parsed and written back while it is read, without building a tree,
+    # so memory use does not depend on its size
+
+    def __init__(self, rules_file, default_unicode_font_name="Kalimati", cache_size=DEFAULT_CACHE_SIZE):
+        # rules_file is the path of the mapping definition, whose shared FontMapper is used (see FontMapper.get), or
+        # a FontMapper
+        self.mapper = rules_file if isinstance(rules_file, FontMapper) else FontMapper.get(rules_file, cache_size)
+        self.rules_file = self.mapper.map_json
+        self.supported_ttf_fonts = self.mapper.supported_maps
+        self.default_unicode_font_name = default_unicode_font_name
+        self.known_devanagari_unicode_fonts = ["Kalimati", "Mangal", "Noto Sans Devanagari"]
+
+    @staticmethod
+    def __feed(parser, original_file):
+        while True:
+            chunk = original_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.feed(chunk)
+        parser.close()
+
+    def detect_used_fonts(self, html_file_path):
+        # Supported fonts declared by the elements of the document
+        collector = _FontCollector()
+        html_file = open_text_input(html_file_path)
+        try:
+            self.__feed(collector, html_file)
+        finally:
+            close_text_stream(html_file, html_file_path)
+        detected_supported_fonts = []
+        for font in collector.fonts:
+            font = self.__find_supported_font(font)
+            if font is not None and font not in detected_supported_fonts:
+                detected_supported_fonts.append(font)
+        return detected_supported_fonts
+
+    def __find_supported_font(self, font_name):
+        # Name in the mapping definition of the legacy font font_name, ignoring case (CSS font names are not case
+        # sensitive), None when it is not one
+        folded = font_name.casefold()
+        for name in self.mapper.all_rules:
+            if name.casefold() == folded:
+                return name
+        return None
+
+    def __get_source_font(self, font_name, from_font, to_font, known_unicode_fonts):
+        # Font the text written in font_name is mapped from, None when it is left as it is
+        if from_font != "auto":
+            return from_font
+        source = self.__find_supported_font(font_name)
+        if source is not None and source.casefold() != to_font.casefold():
+            return source
+        if to_font.lower() != "unicode" and font_name.casefold() in [
+                name.casefold() for name in self.known_devanagari_unicode_fonts + known_unicode_fonts]:
+            return "unicode"
+        return None
+
+    def map_fonts(self, original_file_path, output_file_path="mapped.html", from_font="auto", to_font="unicode",
+                  components=None, known_unicode_fonts=None):
+        # original_file_path and output_file_path can also be "-" (stdin/stdout) or text or binary (UTF-8) file
+        # objects, which are left open. In auto mode the text of elements in a supported font is mapped (when
+        # mapping to a font, also of those in a known unicode font), otherwise all the text of the document is read
+        # as from_font. The content of <script> and <style> is never mapped.
+        # components serves no purpose, it is there to match the method call of DocxHandler
+        if known_unicode_fonts is None:
+            known_unicode_fonts = []
+        if to_font.lower() == "unicode":
+            target_font = self.default_unicode_font_name
+        else:
+            # Fail before writing anything when the target font is unknown
+            target_font = self.mapper.get_font_name(to_font)
+
+        def get_source_font(font_name):
+            return self.__get_source_font(font_name, from_font, to_font, known_unicode_fonts)
+
+        def map_text(text, source):
+            return self.mapper.map_to_font(text, source, to_font)
+
+        # The input is opened first, so that no output file is left behind when it cannot be read
+        original_file = open_text_input(original_file_path)
+        try:
+            output_file = open_text_output(output_file_path)
+            try:
+                parser = _FontRewriter(output_file.write, instrumentation.instrument(map_text, "html.map"),
+                                       get_source_font, target_font, from_font if from_font != "auto" else None)
+                self.__feed(parser, original_file)
+            finally:
+                close_text_stream(output_file, output_file_path)
+        finally:
+            close_text_stream(original_file, original_file_path)
+        return True
+
+    async def amap_fonts(self, original_file_path, output_file_path=None, from_font="auto", to_font="unicode",
+                         components=None, known_unicode_fonts=None):
+        # map_fonts() for asyncio code, run in the shared executor (see executor.py). original_file_path can also be
+        # a file object or the bytes of the file. Returns the bytes of the mapped file when output_file_path is None
+        from .executor import run_in_executor, map_to_output
+        return await run_in_executor(map_to_output, self.map_fonts, original_file_path, output_file_path,
+                                     from_font=from_font, to_font=to_font, components=components,
+                                     known_unicode_fonts=known_unicode_fonts)
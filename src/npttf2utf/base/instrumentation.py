@@ -0,0 +1,134 @@
+import threading
+import time
+
+# Stage level instrumentation of FontMapper, TxtHandler and DocxHandler. Every measured stage is reported to the
+# registered hooks as hook(stage, seconds, chars), the seconds being 0 for plain events such as cache hits. Nothing
+# is measured while no hook is registered, the instrumented code then only checks "recording".
+# Stages nest: "docx.repack" includes the mapping of the parts written during the repack, and every mapping
+# includes the "rules.*" stages of the rule engine. Worker processes (jobs > 1) are not measured
+
+# True while at least one hook is registered
+recording = False
+_hooks = ()
+_hooks_lock = threading.Lock()
+
+
+def add_hook(hook):
+    global recording, _hooks
+    with _hooks_lock:
+        _hooks = _hooks + (hook,)
+        recording = True
+
+
+def remove_hook(hook):
+    global recording, _hooks
+    with _hooks_lock:
+        hooks = list(_hooks)
+        hooks.remove(hook)
+        _hooks = tuple(hooks)
+        recording = bool(_hooks)
+
+
+def record(stage, seconds=0.0, chars=0):
+    for hook in _hooks:
+        hook(stage, seconds, chars)
+
+
+class timed:
+    # Context manager measuring the wall time of its block as stage, when recording. chars can be set inside the
+    # block once the amount of text handled is known
+    __slots__ = ("stage", "chars", "start")
+
+    def __init__(self, stage, chars=0):
+        self.stage = stage
+        self.chars = chars
+        self.start = None
+
+    def __enter__(self):
+        if recording:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if self.start is not None:
+            record(self.stage, time.perf_counter() - self.start, self.chars)
+
+
+def instrument(function, stage):
+    # function itself when not recording, otherwise a wrapper measuring each call as stage, the length of the first
+    # argument being the number of characters handled
+    if not recording:
+        return function
+
+    def measured(argument, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(argument, *args, **kwargs)
+        finally:
+            record(stage, time.perf_counter() - start, len(argument))
+    return measured
+
+
+def instrument_iterator(iterable, stage):
+    # Same as instrument() for the time taken to produce each item of iterable
+    if not recording:
+        return iterable
+    return _measure_iterator(iter(iterable), stage)
+
+
+def _measure_iterator(iterator, stage):
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        record(stage, time.perf_counter() - start, len(item))
+        yield item
+
+
+class Stats:
+    # Hook summing up the calls, wall time and characters of every stage. Safe to share between threads
+    def __init__(self):
+        self.stages = {}
+        self.__lock = threading.Lock()
+
+    def __call__(self, stage, seconds, chars):
+        with self.__lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                self.stages[stage] = [1, seconds, chars]
+            else:
+                totals[0] += 1
+                totals[1] += seconds
+                totals[2] += chars
+
+    def as_dict(self):
+        # {stage: {"calls": ..., "seconds": ..., "chars": ...}}
+        with self.__lock:
+            return {stage: {"calls": calls, "seconds": seconds, "chars": chars}
+                    for stage, (calls, seconds, chars) in self.stages.items()}
+
+    def summary(self):
+        # Table of the stages, slowest first
+        lines = ["{:<28} {:>10} {:>12} {:>14} {:>14}".format("stage", "calls", "seconds", "chars", "chars/s")]
+        stages = sorted(self.as_dict().items(), key=lambda item: (-item[1]["seconds"], item[0]))
+        for stage, totals in stages:
+            speed = "{:,.0f}".format(totals["chars"] / totals["seconds"]) \
+                if totals["seconds"] and totals["chars"] else "-"
+            lines.append("{:<28} {:>10,} {:>12.4f} {:>14,} {:>14}".format(
+                stage, totals["calls"], totals["seconds"], totals["chars"], speed))
+        return "\n".join(lines)
+
+
+class collect:
+    # Context manager registering a Stats hook for its block: with collect() as stats: ...
+    def __init__(self):
+        self.stats = Stats()
+
+    def __enter__(self):
+        add_hook(self.stats)
+        return self.stats
+
+    def __exit__(self, exception_type, exception, traceback):
+        remove_hook(self.stats)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from collections.abc import Mapping
+from .ruleengine import RuleEngine
+
+# Bump whenever the stored form of the compiled rules (RuleEngine.compile_rules) changes, older cache files are then
+# ignored
+COMPILED_CACHE_FORMAT = 2
+# Environment variable overriding the cache directory, an empty value disables the compiled cache
+CACHE_DIRECTORY_VARIABLE = "NPTTF2UTF_CACHE_DIR"
+
+
+def get_cache_directory():
+    # Per user cache directory of the platform, None when caching is disabled
+    directory = os.environ.get(CACHE_DIRECTORY_VARIABLE)
+    if directory is not None:
+        return directory or None
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+        return os.path.join(base, "npttf2utf", "Cache")
+    if sys.platform == "darwin":
+        return os.path.join(os.path.expanduser("~"), "Library", "Caches", "npttf2utf")
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                        "npttf2utf")
+
+
+class MapDefinition(Mapping):
+    # Read only {font: definition} view of a mapping definition file, backed by a compiled cache in the user cache
+    # directory. The cache entry of a file is keyed on its real path and is valid while the file keeps the same
+    # modification time and size, or else the same SHA-256 hash. Fonts are decoded one by one when first used,
+    # along with their compiled rules (see load_engine/store_engine), so the mapping definition file is not even
+    # read when the cache is up to date. The cache only holds JSON data, never anything that could run code when
+    # loaded. Any problem with the cache falls back to reading the file
+    def __init__(self, map_json, cache_directory=None):
+        self.map_json = map_json
+        self.__cache_path = None
+        if cache_directory is not None:
+            self.__cache_path = os.path.join(cache_directory, "compiled-maps", "{}.json".format(
+                hashlib.sha256(os.path.realpath(map_json).encode("utf-8")).hexdigest()[:32]))
+        self.__definitions = {}
+        stat = os.stat(map_json)
+        self.__entry = self.__load_entry(stat)
+        if self.__entry is None:
+            with open(map_json, "rb") as map_file:
+                content = map_file.read()
+            sha256 = hashlib.sha256(content).hexdigest()
+            self.__entry = self.__load_entry(stat, sha256)
+            if self.__entry is not None:
+                # Same content with a new modification time (the file was touched or copied over)
+                self.__entry["mtime_ns"] = stat.st_mtime_ns
+                self.__save_entry()
+            else:
+                definitions = json.loads(content.decode("utf-8"))
+                self.__definitions = dict(definitions)
+                self.__entry = {
+                    "format": COMPILED_CACHE_FORMAT,
+                    "python": list(sys.version_info[:2]),
+                    "mtime_ns": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "sha256": sha256,
+                    "fonts": list(definitions),
+                    "definitions": {font: json.dumps(definition, ensure_ascii=False)
+                                    for font, definition in definitions.items()},
+                    "engines": {},
+                }
+                self.__save_entry()
+        # Content hash of the file, identifies the version of the mapping definition (see convcache.py)
+        self.sha256 = self.__entry["sha256"]
+
+    def __load_entry(self, stat, sha256=None):
+        # Cache entry of the file when it is valid for stat (or for the content hash sha256), None otherwise
+        if self.__cache_path is None:
+            return None
+        try:
+            with open(self.__cache_path, "rb") as cache_file:
+                entry = json.loads(cache_file.read().decode("utf-8"))
+            if entry["format"] != COMPILED_CACHE_FORMAT or entry["python"] != list(sys.version_info[:2]):
+                return None
+            if sha256 is None:
+                valid = entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size
+            else:
+                valid = entry["sha256"] == sha256
+        except Exception:
+            return None
+        return entry if valid else None
+
+    def __save_entry(self):
+        if self.__cache_path is None:
+            return
+        temporary_path = None
+        try:
+            directory = os.path.dirname(self.__cache_path)
+            os.makedirs(directory, exist_ok=True)
+            # Written next to the cache file under a unique name, then renamed over it, so processes and threads
+            # saving at the same time never see a partial file
+            with tempfile.NamedTemporaryFile("wb", dir=directory, suffix=".tmp", delete=False) as cache_file:
+                temporary_path = cache_file.name
+                cache_file.write(json.dumps(self.__entry, ensure_ascii=False).encode("utf-8"))
+            os.replace(temporary_path, self.__cache_path)
+        except OSError:
+            if temporary_path is not None:
+                try:
+                    os.remove(temporary_path)
+                except OSError:
+                    pass
+
+    def __getitem__(self, font):
+        if font not in self.__definitions:
+            self.__definitions[font] = json.loads(self.__entry["definitions"][font])
+        return self.__definitions[font]
+
+    def __iter__(self):
+        return iter(self.__entry["fonts"])
+
+    def __len__(self):
+        return len(self.__entry["fonts"])
+
+    def __contains__(self, font):
+        return font in self.__entry["definitions"]
+
+    def load_engine(self, font):
+        # Compiled rules of font stored by an earlier run, None if there are none
+        stored = self.__entry["engines"].get(font)
+        if stored is None:
+            return None
+        try:
+            return RuleEngine(font, None, stored["version"], stored["compiled"])
+        except Exception:
+            return None
+
+    def store_engine(self, font, engine):
+        self.__entry["engines"][font] = {"version": engine.version, "compiled": engine.compiled}
+        self.__save_entry()
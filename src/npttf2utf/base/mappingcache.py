@@ -0,0 +1,47 @@
+import collections
+import threading
+
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class MappingCache:
+    # Bounded least recently used cache of mapped strings, keyed on (from_font, to_font, text). A maxsize of 0
+    # disables caching. Safe to use from several threads (see FontMapper.get)
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = max(0, maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        # Returns None (and counts a miss) when key is not cached
+        with self.__lock:
+            try:
+                value = self.__entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if not self.maxsize:
+            return
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            if len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def info(self):
+        with self.__lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.__entries))
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = 0
+            self.misses = 0
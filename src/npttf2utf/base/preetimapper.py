@@ -24,6 +24,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import re
+from .ruleengine import RuleEngine, plan_rule_passes, build_rule_passes
+
 unicodeToPreetiDict = \
     {
         "अ": "c",
@@ -100,120 +103,119 @@ unicodeToPreetiDict = \
         ")": "_"
     }
 
+# Characters (all of them map to a single character) whose half form is their uppercase Preeti character
+HALF_FORM_CHARACTERS = {character for character, mapped in unicodeToPreetiDict.items()
+                        if len(character) == 1 and mapped in list('wertyuxasdghjkzvn')}
+# Half forms of the characters without an uppercase one
+SPECIAL_HALF_FORMS = {'स': ':', 'ष': 'i'}
+# Half forms as found in the normalized text
+HALF_FORMS = set('WERTYUXASDGHJK:ZVN')
+# Everything in the normalized text that is not at a position found by CONVERSION_TRIGGER maps one character at
+# a time through this table ("\ufeff" is dropped)
+CONVERSION_TABLE = {ord(character): mapped for character, mapped in unicodeToPreetiDict.items() if len(character) == 1}
+CONVERSION_TABLE[0xfeff] = None
+
+# Positions where normalizeUnicode() does more than copying the character: a character followed by a halant (and
+# one more character that is not a space, "।", "," or "र") that has a half form, and "्र"
+NORMALIZATION_TRIGGER = re.compile('([{}])्(?=[^ ।,र])|्र'.format(
+    ''.join(sorted(HALF_FORM_CHARACTERS | set(SPECIAL_HALF_FORMS)))))
+# Superset of the positions where the scan of convert() may do more than mapping the character through
+# CONVERSION_TABLE: before a hraswo ukaar ("ि") within 3 characters and at a reph ("र्")
+CONVERSION_TRIGGER = re.compile('[\\s\\S](?=ि)|[{}Ii](?=[\\s\\S]{{1,2}}ि)|र(?=्)'.format(
+    re.escape(''.join(sorted(HALF_FORMS)))))
+
+# Composite glyphs of Preeti, applied in this order on the converted text
+COMPOSITE_RULES = [[re.escape(original), composite] for original, composite in [
+    ('Si', 'I'),  # Si in preeti is aadha ka aadha ष, so replace with I which is aadha क्ष
+    ('H`', '1'),  # H` is the product of composite nature of unicode ज्ञ
+    ('b\\w', '4'),  # b\w means in preeti द halanta ध, so replace the composite
+    ('z|', '>'),  # composite for श्र
+    ("/'", '?'),  # composite for रु
+    ('/"', '¿'),  # composite for रू
+    ('Tt', 'Q'),  # composite for त्त
+    ('b\\lj', 'lå'),  # composite for द्वि
+    ('b\\j', 'å'),  # composite for द्व
+    ('0f\\', '0'),  # composite for ण् to get the aadha ण in say गण्डक
+    ('`\\', '~'),  # composite for aadha ञ्
+]]
+# Independent composites are replaced in the same pass
+COMPOSITE_PASSES = build_rule_passes(plan_rule_passes(COMPOSITE_RULES), COMPOSITE_RULES)
+
+
+def _normalize_match(match):
+    half_form_character = match.group(1)
+    if half_form_character is not None:
+        # for aadha akshars
+        return SPECIAL_HALF_FORMS.get(half_form_character) or chr(
+            ord(unicodeToPreetiDict[half_form_character]) - 32)
+    # for खुट्टा चिर्ने चिन्ह in the likes of क्रम and ट्रक.
+    # The character before "्" at the start of the text is the last one of the text, as it always was
+    previous = match.string[match.start() - 1]
+    if previous == 'र':
+        return match.group()
+    if previous in 'टठड':
+        return '«'  # for sign as in ट्रक
+    return '|'  # for sign as in क्रम
+
 
 def normalizeUnicode(unicodetext):
-    index = -1
-    normalized = ''
-    while index + 1 < len(unicodetext):
-        index += 1
-        character = unicodetext[index]
+    normalized = NORMALIZATION_TRIGGER.sub(_normalize_match, unicodetext)
+    return normalized.replace('त|', 'q')  # for त्र
+
+
+def _convert_at(text, index):
+    # Convert the character at index, which may consume the characters after it. Returns the converted piece and
+    # the index of the next character to convert. Lookups past the end of the text and characters missing from
+    # unicodeToPreetiDict fall back to converting the character alone
+    character = text[index]
+    if character == '\ufeff':
+        return '', index + 1
+    try:
         try:
-            try:
-                if character != 'र':  # for aadha akshars
-                    if unicodetext[index + 1] == '्' and unicodetext[index + 2] != ' ' and unicodetext[index+2] != '।' \
-                            and unicodetext[index + 2] != ',':
-                        if unicodetext[index + 2] != 'र':
-                            if unicodeToPreetiDict[character] in list('wertyuxasdghjkzvn'):
-                                normalized += chr(ord(unicodeToPreetiDict[character]) - 32)
-                                index += 1
-                                continue
-                            elif character == 'स':
-                                normalized += ':'
-                                index += 1
-                                continue
-                            elif character == 'ष':
-                                normalized += 'i'
-                                index += 1
-                                continue
-                if unicodetext[index - 1] != 'र' and character == '्' and unicodetext[index + 1] == 'र':
-                    # for खुट्टा चिर्ने चिन्ह in the likes of क्रम and ट्रक
-                    if unicodetext[index - 1] != 'ट' and unicodetext[index - 1] != 'ठ' and unicodetext[index-1] != 'ड':
-                        normalized += '|'  # for sign as in क्रम
-                        index += 1
-                        continue
-                    else:
-                        normalized += '«'  # for sign as in ट्रक
-                        index += 1
-                        continue
-            except IndexError:
-                pass
-            normalized += character
-        except KeyError:
-            normalized += character
-    normalized = normalized.replace('त|', 'q')  # for त्र
-    return normalized
+            if text[index + 1] == 'ि':  # for normal hraswo ukaar
+                if character == 'q':
+                    return 'l' + character, index + 2
+                return 'l' + unicodeToPreetiDict[character], index + 2
+
+            if text[index + 2] == 'ि':  # for constructs like त्ति
+                if character in HALF_FORMS:
+                    if text[index + 1] != 'q':  # if not like न्त्रि
+                        return 'l' + character + unicodeToPreetiDict[text[index + 1]], index + 3
+                    return 'l' + character + text[index + 1], index + 3
+
+            if text[index + 1] == '्' and character == 'र':  # for reph as in वार्ता
+                if text[index + 3] in 'ाोौेैी':
+                    return unicodeToPreetiDict[text[index + 2]] + unicodeToPreetiDict[text[index + 3]] + '{', \
+                        index + 4
+                elif text[index + 3] == 'ि':
+                    return unicodeToPreetiDict[text[index + 3]] + unicodeToPreetiDict[text[index + 2]] + '{', \
+                        index + 4
+                return unicodeToPreetiDict[text[index + 2]] + '{', index + 3
+
+            if text[index + 3] == 'ि':  # for the likes of ष्ट्रिय
+                if text[index + 2] == '|' or text[index + 2] == '«':
+                    if character in HALF_FORMS or character in 'Ii':
+                        return 'l' + character + unicodeToPreetiDict[text[index + 1]] + text[index + 2], index + 4
+        except IndexError:
+            pass
+        return unicodeToPreetiDict[character], index + 1
+    except KeyError:
+        return character, index + 1
 
 
 def convert(unicodestring):
+    # Single forward scan: the text between two trigger positions is converted in bulk with str.translate, only
+    # the trigger positions go through _convert_at()
     normalizedunicodetext = normalizeUnicode(unicodestring)
-    converted = ''
-    index = -1
-    while index + 1 < len(normalizedunicodetext):
-        index += 1
-        character = normalizedunicodetext[index]
-        if character == '\ufeff':
-            continue
-        try:
-            try:
-                if normalizedunicodetext[index + 1] == 'ि':  # for normal hraswo ukaar
-                    if character == 'q':
-                        converted += 'l' + character
-                    else:
-                        converted += 'l' + unicodeToPreetiDict[character]
-                    index += 1
-                    continue
-
-                if normalizedunicodetext[index + 2] == 'ि':  # for constructs like त्ति
-                    if character in list('WERTYUXASDGHJK:ZVN'):
-                        if normalizedunicodetext[index + 1] != 'q':  # if not like न्त्रि
-                            converted += 'l' + character + unicodeToPreetiDict[normalizedunicodetext[index + 1]]
-                            index += 2
-                            continue
-                        elif normalizedunicodetext[index + 1] == 'q':
-                            converted += 'l' + character + normalizedunicodetext[index + 1]
-                            index += 2
-                            continue
-
-                if normalizedunicodetext[index + 1] == '्' and character == 'र':  # for reph as in वार्ता
-                    if normalizedunicodetext[index + 3] == 'ा' or normalizedunicodetext[index + 3] == 'ो' or \
-                            normalizedunicodetext[index + 3] == 'ौ' or normalizedunicodetext[index + 3] == 'े' or \
-                            normalizedunicodetext[index + 3] == 'ै' or normalizedunicodetext[index + 3] == 'ी':
-                        converted += unicodeToPreetiDict[normalizedunicodetext[index + 2]] + unicodeToPreetiDict[
-                            normalizedunicodetext[index + 3]] + '{'
-                        index += 3
-                        continue
-                    elif normalizedunicodetext[index + 3] == 'ि':
-                        converted += unicodeToPreetiDict[normalizedunicodetext[index + 3]] + unicodeToPreetiDict[
-                            normalizedunicodetext[index + 2]] + '{'
-                        index += 3
-                        continue
-                    converted += unicodeToPreetiDict[normalizedunicodetext[index + 2]] + '{'
-                    index += 2
-                    continue
-
-                if normalizedunicodetext[index + 3] == 'ि':  # for the likes of ष्ट्रिय
-                    if normalizedunicodetext[index + 2] == '|' or normalizedunicodetext[index + 2] == '«':
-                        if character in list('WERTYUXASDGHJK:ZVNIi'):
-                            converted += 'l' + character + unicodeToPreetiDict[normalizedunicodetext[index + 1]] + \
-                                         normalizedunicodetext[index + 2]
-                            index += 3
-                            continue
-
-            except IndexError:
-                pass
-            converted += unicodeToPreetiDict[character]
-        except KeyError:
-            converted += character
-
-    converted = converted.replace('Si', 'I')  # Si in preeti is aadha ka aadha ष, so replace with I which is aadha क्ष
-    converted = converted.replace('H`', '1')  # H` is the product of composite nature of unicode ज्ञ
-    converted = converted.replace('b\w', '4')  # b\w means in preeti द halanta ध, so replace the composite
-    converted = converted.replace('z|', '>')  # composite for श्र
-    converted = converted.replace("/'", '?')  # composite for रु
-    converted = converted.replace('/"', '¿')  # composite for रू
-    converted = converted.replace('Tt', 'Q')  # composite for त्त
-    converted = converted.replace('b\lj', 'lå')  # composite for द्वि
-    converted = converted.replace('b\j', 'å')  # composite for द्व
-    converted = converted.replace('0f\\', '0')  # composite for ण् to get the aadha ण in say गण्डक
-    converted = converted.replace('`\\', '~')  # composite for aadha ञ्
-    return converted
+    converted = []
+    index = 0
+    length = len(normalizedunicodetext)
+    while index < length:
+        trigger = CONVERSION_TRIGGER.search(normalizedunicodetext, index)
+        if trigger is None:
+            converted.append(normalizedunicodetext[index:].translate(CONVERSION_TABLE))
+            break
+        converted.append(normalizedunicodetext[index:trigger.start()].translate(CONVERSION_TABLE))
+        piece, index = _convert_at(normalizedunicodetext, trigger.start())
+        converted.append(piece)
+    return RuleEngine.apply_passes(COMPOSITE_PASSES, ''.join(converted))
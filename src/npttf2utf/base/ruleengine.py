@@ -0,0 +1,370 @@
+import re
+import time
+from . import instrumentation
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+# Input is mapped token by token, a token being either a run of whitespace or a run of anything else
+TOKEN_PATTERN = re.compile(r'(\s+|\S+)')
+# Group references are the only escapes allowed in a replacement template for whole buffer mapping
+TEMPLATE_GROUP_REFERENCE = re.compile(r'\\(?:\d+|g<\w+>)')
+# Every character str.isspace() (and so "\s") accepts, the last one is U+3000. Computed when first needed, engines
+# loaded from the compiled map cache never need it
+WHITESPACE_CHARACTERS = None
+
+
+def confine_pattern(pattern):
+    # Rewrite a regex so that it can never match whitespace or look past a whitespace boundary: "." becomes "\S",
+    # negated classes exclude "\s" and anchors are turned into token boundaries. Applied on a whole buffer the
+    # rewritten regex then behaves exactly like the original applied on each token separately. Returns None
+    # when the regex uses a construct for which this cannot be guaranteed
+    confined = []
+    index = 0
+    while index < len(pattern):
+        character = pattern[index]
+        if character == '\\':
+            escaped = pattern[index + 1:index + 2]
+            # \s, \S, \W, \D, \A, \Z, \n, \t, \xhh ... can match or refer to whitespace/string ends
+            if not escaped or (escaped.isalnum() and not escaped.isdigit() and escaped not in 'dwbB') \
+                    or escaped.isspace():
+                return None
+            confined.append(character + escaped)
+            index += 2
+            continue
+        if character == '[':
+            end = _class_end(pattern, index)
+            if end is None:
+                return None
+            character_class = pattern[index:end + 1]
+            if character_class.startswith('[^'):
+                character_class = character_class[:-1] + '\\s]'
+            elif _class_matches_whitespace(character_class):
+                return None
+            confined.append(character_class)
+            index = end + 1
+            continue
+        if character == '.':
+            confined.append('\\S')
+        elif character == '^':
+            confined.append('(?<!\\S)')
+        elif character == '$':
+            confined.append('(?!\\S)')
+        elif character == '(' and pattern.startswith('(?', index) and not pattern.startswith('(?:', index):
+            # Lookarounds, inline flags, named groups ...
+            return None
+        elif character.isspace():
+            return None
+        else:
+            confined.append(character)
+        index += 1
+    return ''.join(confined)
+
+
+def _class_end(pattern, start):
+    index = start + 1
+    if pattern.startswith('^', index):
+        index += 1
+    if pattern.startswith(']', index):
+        index += 1
+    while index < len(pattern):
+        if pattern[index] == '\\':
+            index += 2
+            continue
+        if pattern[index] == ']':
+            return index
+        index += 1
+    return None
+
+
+def _class_matches_whitespace(character_class):
+    global WHITESPACE_CHARACTERS
+    if WHITESPACE_CHARACTERS is None:
+        WHITESPACE_CHARACTERS = tuple(chr(code) for code in range(0x3000 + 1) if chr(code).isspace())
+    matcher = re.compile(character_class)
+    return any(matcher.match(character) for character in WHITESPACE_CHARACTERS)
+
+
+def _requires_non_whitespace(parsed):
+    # True if every match of the parsed (sub)pattern contains at least one non whitespace character, meaning
+    # the pattern can match neither an empty string nor anything inside a whitespace token. Literals and
+    # positive classes are known to be whitespace free here, confine_pattern() rejects every other case
+    for op, argument in parsed:
+        name = str(op)
+        if name in ('LITERAL', 'IN') and not (name == 'IN' and argument and str(argument[0][0]) == 'NEGATE'):
+            return True
+        if name == 'SUBPATTERN' and _requires_non_whitespace(argument[-1]):
+            return True
+        if name == 'ATOMIC_GROUP' and _requires_non_whitespace(argument):
+            return True
+        if name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') and argument[0] > 0 \
+                and _requires_non_whitespace(argument[2]):
+            return True
+        if name == 'BRANCH' and all(_requires_non_whitespace(branch) for branch in argument[1]):
+            return True
+    return False
+
+
+def confine_rule(rule):
+    # Returns the (pattern, replacement) pair rewritten for whole buffer mapping or None if not possible
+    pattern, replacement = rule[0], rule[1]
+    confined = confine_pattern(pattern)
+    if confined is None or not _requires_non_whitespace(sre_parse.parse(pattern)):
+        return None
+    template = TEMPLATE_GROUP_REFERENCE.sub('', replacement)
+    if '\\' in template or any(character.isspace() for character in template):
+        return None
+    return confined, replacement
+
+
+def character_map_keeps_tokens(character_map):
+    # Whitespace has to stay whitespace and nothing else may turn into whitespace, otherwise token boundaries
+    # would move after the character map is applied
+    for character, mapped in character_map.items():
+        if character.isspace():
+            if not mapped.isspace():
+                return False
+        elif any(mapped_character.isspace() for mapped_character in mapped):
+            return False
+    return True
+
+
+def _literal_text(rule):
+    # Text matched by a literal rule (plain characters in the pattern, no escapes in the replacement), None for
+    # anything else. Only literal rules are fused into a single pass
+    if '\\' in rule[1]:
+        return None
+    parsed = sre_parse.parse(rule[0])
+    if not len(parsed) or any(str(op) != 'LITERAL' for op, _ in parsed):
+        return None
+    return ''.join(chr(argument) for _, argument in parsed)
+
+
+def _can_overlap(first, second):
+    # True if an occurrence of "first" and one of "second" can share characters in some text
+    if first in second or second in first:
+        return True
+    return any(first.endswith(second[:length]) or second.endswith(first[:length])
+               for length in range(1, min(len(first), len(second))))
+
+
+def _required_character(parsed):
+    # A character every match of the parsed (sub)pattern contains. A pass can be skipped when it is absent
+    for op, argument in parsed:
+        name = str(op)
+        if name == 'LITERAL':
+            return chr(argument)
+        found = None
+        if name == 'SUBPATTERN':
+            found = _required_character(argument[-1])
+        elif name == 'ATOMIC_GROUP':
+            found = _required_character(argument)
+        elif name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') and argument[0] > 0:
+            found = _required_character(argument[2])
+        if found is not None:
+            return found
+    return None
+
+
+def plan_rule_passes(rules):
+    # Group consecutive rules that can be applied in one regex pass. re.sub never rescans its own output, so a
+    # run of literal rules gives the same result in a single alternation as one after another provided that no
+    # two of their patterns can overlap and no pattern can overlap the replacement of an earlier rule of the run.
+    # A replacement that deletes text can join its neighbours into new matches, so it ends the run.
+    # Returns a list of (rule indexes, reason) where reason tells why the pass was not extended further
+    passes = []
+    current = []
+    literals = [_literal_text(rule) for rule in rules]
+    for index, rule in enumerate(rules):
+        if literals[index] is None:
+            if current:
+                passes.append((current, "followed by a regular expression rule"))
+                current = []
+            passes.append(([index], "regular expression"))
+            continue
+        conflict = None
+        for earlier in current:
+            if not rules[earlier][1]:
+                conflict = "rule {} deletes text".format(earlier)
+            elif _can_overlap(literals[earlier], literals[index]):
+                conflict = "overlaps the pattern of rule {}".format(earlier)
+            elif _can_overlap(rules[earlier][1], literals[index]):
+                conflict = "reads the output of rule {}".format(earlier)
+            if conflict is not None:
+                break
+        if conflict is not None:
+            passes.append((current, "next rule " + conflict))
+            current = []
+        current.append(index)
+    if current:
+        passes.append((current, "last rule"))
+    return passes
+
+
+class _FusedReplacement:
+    __slots__ = ('replacements',)
+
+    def __init__(self, replacements):
+        self.replacements = replacements
+
+    def __call__(self, match):
+        return self.replacements[match.group()]
+
+
+def describe_rule_passes(plan, rules, patterns=None):
+    # Passes of a plan from plan_rule_passes() as plain data: [pattern, replacement, required character] where the
+    # replacement of a fused pass is a {literal: replacement} dict. "patterns" optionally overrides the pattern of
+    # each rule, the grouping stays valid for the token confined variants since literal rules are never rewritten
+    described = []
+    for indexes, _ in plan:
+        if len(indexes) == 1:
+            pattern = rules[indexes[0]][0] if patterns is None else patterns[indexes[0]]
+            replacement = rules[indexes[0]][1]
+            required = _required_character(sre_parse.parse(rules[indexes[0]][0]))
+        else:
+            literals = [_literal_text(rules[index]) for index in indexes]
+            pattern = '|'.join(re.escape(literal) for literal in literals)
+            replacement = {literal: rules[index][1] for literal, index in zip(literals, indexes)}
+            required = None
+        described.append([pattern, replacement, required])
+    return described
+
+
+def compile_rule_passes(described):
+    # Regex passes from the data of describe_rule_passes()
+    return tuple((re.compile(pattern), _FusedReplacement(replacement) if isinstance(replacement, dict) else replacement,
+                  required) for pattern, replacement, required in described)
+
+
+def build_rule_passes(plan, rules, patterns=None):
+    # Compile a plan from plan_rule_passes(), see describe_rule_passes()
+    return compile_rule_passes(describe_rule_passes(plan, rules, patterns))
+
+
+class RuleEngine:
+    # Compiled and immutable form of the rules of a single font from the mapping definition. Regexes are compiled
+    # once and the single character entries of "character-map" are turned into a str.translate table so that
+    # mapping a string does not have to do any setup work.
+    # When every rule can be confined to a token (see confine_pattern) the whole input is mapped at once instead
+    # of token by token, which gives the same output in a handful of regex passes over the buffer.
+    # Rules are applied as passes planned by plan_rule_passes(), see rule_report() for how they were grouped
+    __slots__ = ('font', 'version', 'compiled', 'pre_rules', 'post_rules', 'translation_table', 'buffer_pre_rules',
+                 'buffer_post_rules', 'buffer_safe', 'pre_rule_plan', 'post_rule_plan')
+
+    def __init__(self, font, rules, version=None, compiled=None):
+        # compiled is the result of compile_rules(rules) when it is already known (see mapcache.py), rules are then
+        # not used
+        if compiled is None:
+            compiled = self.compile_rules(rules)
+        object.__setattr__(self, 'font', font)
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'compiled', compiled)
+        for stage in ('pre_rule_plan', 'post_rule_plan'):
+            object.__setattr__(self, stage, tuple(
+                (tuple(tuple(rule) for rule in stage_rules), reason) for stage_rules, reason in compiled[stage]))
+        for stage in ('pre_rules', 'post_rules', 'buffer_pre_rules', 'buffer_post_rules'):
+            object.__setattr__(self, stage, compile_rule_passes(compiled[stage]))
+        object.__setattr__(self, 'translation_table', self.build_translation_table(compiled['character_map']))
+        object.__setattr__(self, 'buffer_safe', bool(compiled['buffer_safe']))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("RuleEngine is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError("RuleEngine is immutable")
+
+    @staticmethod
+    def compile_rules(rules):
+        # The work of compiling the rules of a font (parsing, confining and grouping them into passes) as plain data
+        # (dicts, lists, strings and booleans), which the compiled map cache stores as JSON. Only re.compile() is
+        # left to do on it
+        pre_rules = [rule for rule in rules.get('pre-rules', []) if rule]
+        post_rules = [rule for rule in rules.get('post-rules', []) if rule]
+        character_map = rules.get('character-map', {})
+        buffer_pre_rules = [confine_rule(rule) for rule in pre_rules]
+        buffer_post_rules = [confine_rule(rule) for rule in post_rules]
+        buffer_safe = character_map_keeps_tokens(character_map) and None not in buffer_pre_rules + buffer_post_rules
+        pre_rule_plan = plan_rule_passes(pre_rules)
+        post_rule_plan = plan_rule_passes(post_rules)
+        return {
+            'pre_rule_plan': [[[pre_rules[index] for index in indexes], reason] for indexes, reason in pre_rule_plan],
+            'post_rule_plan': [[[post_rules[index] for index in indexes], reason]
+                               for indexes, reason in post_rule_plan],
+            'pre_rules': describe_rule_passes(pre_rule_plan, pre_rules),
+            'post_rules': describe_rule_passes(post_rule_plan, post_rules),
+            'buffer_pre_rules': describe_rule_passes(pre_rule_plan, pre_rules, [
+                rule[0] for rule in buffer_pre_rules]) if buffer_safe else [],
+            'buffer_post_rules': describe_rule_passes(post_rule_plan, post_rules, [
+                rule[0] for rule in buffer_post_rules]) if buffer_safe else [],
+            'character_map': {character: mapped for character, mapped in character_map.items()
+                              if len(character) == 1},
+            'buffer_safe': buffer_safe,
+        }
+
+    def __repr__(self):
+        return "<RuleEngine font={!r} version={!r}>".format(self.font, self.version)
+
+    @classmethod
+    def from_definition(cls, font, definition):
+        # "definition" is the value of a font key in map.json: {"version": ..., "rules": {...}}
+        return cls(font, definition['rules'], definition.get('version'))
+
+    @staticmethod
+    def build_translation_table(character_map):
+        # Only single character keys can ever match since mapping is done character by character
+        return {ord(character): mapped for character, mapped in character_map.items() if len(character) == 1}
+
+    def rule_report(self):
+        # Human readable description of how the rules were compiled into passes
+        lines = ["{}: {} mapping".format(self.font, "whole buffer" if self.buffer_safe else "token by token")]
+        for stage, plan in (("pre-rules", self.pre_rule_plan), ("post-rules", self.post_rule_plan)):
+            rule_count = sum(len(rules) for rules, _ in plan)
+            lines.append("{}: {} rules in {} passes".format(stage, rule_count, len(plan)))
+            for number, (rules, reason) in enumerate(plan):
+                lines.append("  pass {:>2} {} {} ({})".format(
+                    number, "fused " if len(rules) > 1 else "single", ", ".join(repr(rule[0]) for rule in rules),
+                    reason))
+        return "\n".join(lines)
+
+    @staticmethod
+    def apply_passes(passes, string):
+        for pattern, replacement, required in passes:
+            if required is None or required in string:
+                string = pattern.sub(replacement, string)
+        return string
+
+    def map_word(self, word):
+        word = self.apply_passes(self.pre_rules, word)
+        return self.apply_passes(self.post_rules, word.translate(self.translation_table))
+
+    def map_buffer(self, string):
+        if instrumentation.recording:
+            return self.__map_recorded([string], self.buffer_pre_rules, self.buffer_post_rules)
+        string = self.apply_passes(self.buffer_pre_rules, string)
+        return self.apply_passes(self.buffer_post_rules, string.translate(self.translation_table))
+
+    def map(self, string):
+        if self.buffer_safe:
+            return self.map_buffer(string)
+        if instrumentation.recording:
+            return self.__map_recorded(TOKEN_PATTERN.findall(string), self.pre_rules, self.post_rules)
+        map_word = self.map_word
+        return ''.join([map_word(word) for word in TOKEN_PATTERN.findall(string)])
+
+    def __map_recorded(self, tokens, pre_rules, post_rules):
+        # Same as mapping each of the tokens, but one stage at a time over all of them so that each stage is
+        # measured once (see instrumentation.py)
+        chars = sum(len(token) for token in tokens)
+        start = time.perf_counter()
+        tokens = [self.apply_passes(pre_rules, token) for token in tokens]
+        pre_rules_end = time.perf_counter()
+        tokens = [token.translate(self.translation_table) for token in tokens]
+        character_map_end = time.perf_counter()
+        tokens = [self.apply_passes(post_rules, token) for token in tokens]
+        end = time.perf_counter()
+        instrumentation.record("rules.pre", pre_rules_end - start, chars)
+        instrumentation.record("rules.character_map", character_map_end - pre_rules_end, chars)
+        instrumentation.record("rules.post", end - character_map_end, chars)
+        return ''.join(tokens)
@@ -0,0 +1,285 @@
+import collections
+import csv
+import itertools
+import json
+import os
+import re
+from .fontmapper import FontMapper, DEFAULT_CACHE_SIZE
+from .mappingcache import MappingCache
+from . import instrumentation
+from .exceptions import TxtAutoModeException, TabularFileException
+from .textstream import open_text_input, open_text_output, close_text_stream
+
+# Records read, mapped and written at once. With jobs > 1 this is also the work sent to a worker process at once
+RECORD_BATCH_SIZE = 4096
+# Number of mapped values remembered for each column. Categorical columns (districts, wards...) repeat a few values
+# over and over, they are then mapped once
+DEFAULT_MEMO_SIZE = 1 << 14
+# Table formats, by file extension
+TABLE_FORMATS = {".csv": "csv", ".tsv": "tsv", ".tab": "tsv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+# JSON whitespace, see _member_spans()
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Mapper of the current worker process of a parallel conversion, see TabularHandler.map_fonts()
+_worker_mapper = None
+
+
+def _init_worker(rules_file):
+    global _worker_mapper
+    _worker_mapper = FontMapper(rules_file, cache_size=0)
+
+
+def _map_values(values_by_column, from_font, to_font):
+    return [list(_worker_mapper.map_many(values, from_font, to_font)) for values in values_by_column]
+
+
+def _member_spans(line):
+    # {key: (start, end)} of the text of the values of the top level members of the (valid) JSON object on line
+    decoder = json.JSONDecoder()
+    spans = {}
+    index = JSON_WHITESPACE.match(line, JSON_WHITESPACE.match(line).end() + 1).end()
+    while line[index] == '"':
+        key, index = json.decoder.scanstring(line, index + 1)
+        start = JSON_WHITESPACE.match(line, JSON_WHITESPACE.match(line, index).end() + 1).end()
+        _, end = decoder.raw_decode(line, start)
+        spans[key] = (start, end)
+        index = JSON_WHITESPACE.match(line, end).end()
+        if line[index] != ",":
+            break
+        index = JSON_WHITESPACE.match(line, index + 1).end()
+    return spans
+
+
+class _DelimitedTable:
+    # Records of a CSV (or TSV) file as lists of fields. The selected columns are found by name in the header row,
+    # or by position, as soon as the table is created (before anything is written). TSV fields are never quoted, a
+    # '"' is part of the field (Preeti text is full of them). Files are opened with newline='' as the csv module
+    # expects, line breaks inside quoted fields are kept as they are
+
+    def __init__(self, input_file, delimiter, header, columns):
+        self.__options = {"delimiter": delimiter}
+        if delimiter == "\t":
+            self.__options.update(quoting=csv.QUOTE_NONE, quotechar=None)
+        self.__reader = csv.reader(input_file, **self.__options)
+        self.__writer = None
+        self.__header = next(self.__reader, None) if header else None
+        positions = []
+        for column in columns:
+            if self.__header is not None and column in self.__header:
+                positions.append(self.__header.index(column))
+            elif isinstance(column, int) or str(column).isdigit():
+                positions.append(int(column))
+            elif not header or self.__header is not None:
+                raise TabularFileException("Cannot find the column '{}'".format(column))
+        self.columns = list(dict.fromkeys(positions))
+
+    def start(self, output_file):
+        self.__writer = csv.writer(output_file, lineterminator="\n", **self.__options)
+        if self.__header is not None:
+            self.__writer.writerow(self.__header)
+
+    def iter_batches(self):
+        for batch in iter(lambda: list(itertools.islice(self.__reader, RECORD_BATCH_SIZE)), []):
+            yield batch
+
+    def get_value(self, record, column):
+        return record[column] if column < len(record) and record[column] else None
+
+    def write(self, batch, mapped):
+        # mapped holds {value: mapped value} for each column
+        for record in batch:
+            for column, mapped_values in zip(self.columns, mapped):
+                if column < len(record) and record[column] in mapped_values:
+                    record[column] = mapped_values[record[column]]
+        self.__writer.writerows(batch)
+
+
+class _JsonLinesTable:
+    # Records of a JSON Lines file as (line, object). Only the string values of the selected top level keys are
+    # mapped. Only the text of these values changes in the written line, everything else (other values, number
+    # formats, spacing, key order) is kept as it was read
+
+    def __init__(self, input_file, columns):
+        self.__input_file = input_file
+        self.__output_file = None
+        self.columns = list(dict.fromkeys(columns))
+        self.__line_number = 0
+
+    def start(self, output_file):
+        self.__output_file = output_file
+
+    def __parse(self, line):
+        self.__line_number += 1
+        if not line.strip():
+            return line, None
+        try:
+            return line, json.loads(line)
+        except ValueError as e:
+            raise TabularFileException("Invalid JSON on line {}: {}".format(self.__line_number, e))
+
+    def iter_batches(self):
+        for lines in iter(lambda: list(itertools.islice(self.__input_file, RECORD_BATCH_SIZE)), []):
+            yield [self.__parse(line) for line in lines]
+
+    def get_value(self, record, column):
+        record = record[1]
+        if isinstance(record, dict):
+            value = record.get(column)
+            if isinstance(value, str) and value:
+                return value
+        return None
+
+    def write(self, batch, mapped):
+        lines = []
+        for line, record in batch:
+            changes = {}
+            if isinstance(record, dict):
+                for column, mapped_values in zip(self.columns, mapped):
+                    value = record.get(column)
+                    if isinstance(value, str) and value in mapped_values and mapped_values[value] != value:
+                        changes[column] = mapped_values[value]
+            if changes:
+                spans = _member_spans(line)
+                # Replaced from the end of the line, so that the spans before stay valid
+                for start, end, value in sorted(((spans[column] + (value,)) for column, value in changes.items()),
+                                                reverse=True):
+                    line = line[:start] + json.dumps(value, ensure_ascii=False) + line[end:]
+            lines.append(line)
+        self.__output_file.write("".join(lines))
+
+
+class TabularHandler:
+    # Maps selected columns of CSV/TSV files and selected keys of JSON Lines files (database exports), leaving the
+    # other columns (numbers, codes, ASCII text) untouched. Records are streamed in batches. Every column has its
+    # own bounded memo of mapped values, only the values of a batch missing from it are mapped, each once
+
+    def __init__(self, rules_file, cache_size=DEFAULT_CACHE_SIZE, memo_size=DEFAULT_MEMO_SIZE):
+        # rules_file is the path of the mapping definition, whose shared FontMapper is used (see FontMapper.get), or
+        # a FontMapper
+        self.mapper = rules_file if isinstance(rules_file, FontMapper) else FontMapper.get(rules_file, cache_size)
+        self.rules_file = self.mapper.map_json
+        self.supported_ttf_fonts = self.mapper.supported_maps
+        self.memo_size = memo_size
+
+    @staticmethod
+    def detect_used_fonts(table_file_path):
+        return []
+
+    @staticmethod
+    def get_table_format(path):
+        # Format of a file from its extension, "csv" when it is not known (or for stdin)
+        if not isinstance(path, str):
+            return "csv"
+        return TABLE_FORMATS.get(os.path.splitext(path)[1].lower(), "csv")
+
+    def __map_table(self, table, from_font, to_font, jobs):
+        memos = [MappingCache(self.memo_size) for _ in table.columns]
+
+        def split(batch):
+            # Values of the batch already in the memo of their column, and the ones still to map
+            known = []
+            misses = []
+            for position, column in enumerate(table.columns):
+                memo = memos[position]
+                column_known = {}
+                column_misses = []
+                for value in dict.fromkeys([table.get_value(record, column) for record in batch]):
+                    if value is None:
+                        continue
+                    mapped = memo.get(value)
+                    if mapped is None:
+                        column_misses.append(value)
+                    else:
+                        column_known[value] = mapped
+                if instrumentation.recording and column_known:
+                    instrumentation.record("tabular.memo_hit", chars=sum(len(value) for value in column_known))
+                known.append(column_known)
+                misses.append(column_misses)
+            return known, misses
+
+        def write(batch, known, misses, results):
+            for position, (column_known, column_misses, column_results) in enumerate(zip(known, misses, results)):
+                for value, mapped in zip(column_misses, column_results):
+                    column_known[value] = mapped
+                    memos[position].put(value, mapped)
+            with instrumentation.timed("tabular.write"):
+                table.write(batch, known)
+
+        executor = None
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(self.rules_file,))
+        try:
+            pending = collections.deque()
+            batches = table.iter_batches()
+            while True:
+                with instrumentation.timed("tabular.read"):
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                known, misses = split(batch)
+                if executor is None:
+                    with instrumentation.timed("tabular.map", sum(len(value) for values in misses for value in values)):
+                        results = [list(self.mapper.map_many(values, from_font, to_font)) for values in misses]
+                    write(batch, known, misses, results)
+                    continue
+                # Batches are mapped by the worker processes and written in order, with a bounded number of them in
+                # flight. Batches without anything new to map wait for the ones before them
+                future = executor.submit(_map_values, misses, from_font, to_font) if any(misses) else None
+                pending.append((batch, known, misses, future))
+                while len(pending) >= 2 * jobs or (pending and pending[0][3] is None):
+                    batch, known, misses, future = pending.popleft()
+                    write(batch, known, misses, future.result() if future is not None else misses)
+            while pending:
+                batch, known, misses, future = pending.popleft()
+                write(batch, known, misses, future.result() if future is not None else misses)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def map_fonts(self, original_file_path, output_file_path="mapped.csv", from_font="Preeti", to_font="unicode",
+                  components=None, known_unicode_fonts=None, table_format=None, header=True, jobs=1):
+        # components are the columns to map: names of the header row or positions (from 0) for CSV/TSV, top level
+        # keys for JSON Lines. table_format is "csv", "tsv" or "jsonl", found from the file extension by default.
+        # Without header the first row of a CSV/TSV file is a record, columns are then positions. "-" can be used as
+        # original_file_path/output_file_path to read from stdin/write to stdout, both can also be text or binary
+        # (UTF-8) file objects, which are left open (text ones should be opened with newline='' for CSV/TSV). The
+        # selected columns are checked before the output is created. With jobs > 1 the new values of each batch of
+        # records are mapped by that many worker processes. known_unicode_fonts serves no purpose, it is there to
+        # match the method call of DocxHandler
+        if from_font == "auto":
+            raise TxtAutoModeException
+        if not components:
+            raise TabularFileException("No column to map was given")
+        table_format = (table_format or self.get_table_format(original_file_path)).lower()
+        if table_format not in TABLE_FORMATS.values():
+            raise ValueError("Unsupported table format '{}'".format(table_format))
+        # Fail before writing anything when a font is unknown
+        self.mapper.map_many([], from_font, to_font)
+        newline = None if table_format == "jsonl" else ""
+        original_file = open_text_input(original_file_path, newline)
+        try:
+            if table_format == "jsonl":
+                table = _JsonLinesTable(original_file, components)
+            else:
+                table = _DelimitedTable(original_file, "\t" if table_format == "tsv" else ",", header, components)
+            output_file = open_text_output(output_file_path, newline)
+            try:
+                table.start(output_file)
+                self.__map_table(table, from_font, to_font, jobs)
+            finally:
+                close_text_stream(output_file, output_file_path)
+        finally:
+            close_text_stream(original_file, original_file_path)
+        return True
+
+    async def amap_fonts(self, original_file_path, output_file_path=None, from_font="Preeti", to_font="unicode",
+                         components=None, known_unicode_fonts=None, table_format=None, header=True, jobs=1):
+        # map_fonts() for asyncio code, run in the shared executor (see executor.py). original_file_path can also be
+        # the bytes of the file. Returns the bytes of the mapped file when output_file_path is None
+        from .executor import run_in_executor, map_to_output
+        return await run_in_executor(map_to_output, self.map_fonts, original_file_path, output_file_path,
+                                     from_font=from_font, to_font=to_font, components=components,
+                                     known_unicode_fonts=known_unicode_fonts, table_format=table_format,
+                                     header=header, jobs=jobs)
@@ -0,0 +1,108 @@
+import io
+import re
+import sys
+
+# Number of characters read from the input at once while streaming
+CHUNK_SIZE = 1 << 20
+# A single line longer than this is split at the last whitespace instead of being kept in memory whole
+MAX_LINE_SIZE = 16 * CHUNK_SIZE
+# Size of the buffer used for the output file
+WRITE_BUFFER_SIZE = 1 << 20
+# Path that stands for stdin/stdout
+STANDARD_STREAM = "-"
+
+_TRAILING_TOKEN = re.compile(r'\s+|\S+')
+
+
+def is_file_object(path):
+    return hasattr(path, "read") or hasattr(path, "write")
+
+
+def open_text_input(path, newline=None):
+    # path can also be a text or binary (UTF-8) file object. newline is the one of open(), it does not apply to
+    # text file objects
+    if path == STANDARD_STREAM:
+        return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline=newline)
+    if is_file_object(path):
+        return path if isinstance(path, io.TextIOBase) else io.TextIOWrapper(path, encoding="utf-8", newline=newline)
+    return open(path, "r", encoding="utf-8", newline=newline)
+
+
+def open_text_output(path, newline=None):
+    if path == STANDARD_STREAM:
+        return io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", newline=newline)
+    if is_file_object(path):
+        return path if isinstance(path, io.TextIOBase) else io.TextIOWrapper(path, encoding="utf-8", newline=newline)
+    return open(path, "w", encoding="utf-8", newline=newline, buffering=WRITE_BUFFER_SIZE)
+
+
+def close_text_stream(stream, path):
+    # Never close the process' own stdin/stdout or a file object of the caller, only flush and let go of the wrapper
+    if path == STANDARD_STREAM or is_file_object(path):
+        stream.flush()
+        if stream is not path:
+            stream.detach()
+    else:
+        stream.close()
+
+
+def last_token_start(text):
+    # Index at which the last whitespace or non whitespace run of text starts
+    return len(text) - _TRAILING_TOKEN.match(text[::-1]).end()
+
+
+def iter_line_chunks(stream, chunk_size=CHUNK_SIZE, max_line_size=MAX_LINE_SIZE):
+    # Yield the content of stream in pieces of about chunk_size characters that always end with a complete line,
+    # so that mapping every piece gives the same result as mapping the file line by line
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        cut = pending.rfind('\n') + 1
+        if not cut and len(pending) >= max_line_size:
+            # One huge line, fall back to a token boundary to keep memory bounded
+            cut = last_token_start(pending) or len(pending)
+        if cut:
+            yield pending[:cut]
+            pending = pending[cut:]
+    if pending:
+        yield pending
+
+
+def split_lines(text):
+    # Same split as file.readlines() on a stream opened in text mode: on "\n" only, line ends are kept
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def iter_line_aligned_ranges(data, chunk_size=4 * CHUNK_SIZE, max_line_size=4 * MAX_LINE_SIZE):
+    # Split bytes-like UTF-8 data (e.g. a mmap) into (start, end) ranges of about chunk_size bytes that end right
+    # after a b"\n" so no line (and so no word) is cut. A line longer than max_line_size is cut after its last
+    # space or tab before the limit, or between two UTF-8 characters if it has none
+    start = 0
+    size = len(data)
+    while start < size:
+        end = data.find(b'\n', min(start + chunk_size, size) - 1, start + max_line_size) + 1
+        if not end:
+            end = min(start + max_line_size, size)
+            if end < size:
+                end = max(data.rfind(b' ', start, end), data.rfind(b'\t', start, end)) + 1 or end
+            # Never cut inside a multibyte character or a "\r\n" pair
+            while start < end < size and (0x80 <= data[end] < 0xC0 or data[end - 1:end + 1] == b'\r\n'):
+                end -= 1
+        yield start, end
+        start = end
+
+
+def decode_text_range(path, start, end):
+    # Read bytes [start, end) of a UTF-8 file as a stream opened in text mode would, with universal newlines
+    with open(path, "rb") as file:
+        file.seek(start)
+        text = file.read(end - start).decode("utf-8")
+    return text.replace('\r\n', '\n').replace('\r', '\n')
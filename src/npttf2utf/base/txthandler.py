@@ -1,31 +1,106 @@
-from .fontmapper import FontMapper
+import collections
+import mmap
+import os
+from .fontmapper import FontMapper, DEFAULT_CACHE_SIZE
+from . import instrumentation
 from .exceptions import TxtAutoModeException, UnsupportedMapToException
+from .textstream import open_text_input, open_text_output, close_text_stream, iter_line_chunks, split_lines, \
+    iter_line_aligned_ranges, decode_text_range, is_file_object, STANDARD_STREAM
+
+# Chunk mapper of the current worker process of a parallel conversion, see TxtHandler.map_fonts()
+_worker_chunk_mapper = None
+
+
+def _init_worker(rules_file, from_font, to_font):
+    global _worker_chunk_mapper
+    _worker_chunk_mapper = TxtHandler(rules_file).get_chunk_mapper(from_font, to_font)
+
+
+def _map_range(path, start, end):
+    return _worker_chunk_mapper(decode_text_range(path, start, end))
 
 
 class TxtHandler:
 
-    def __init__(self, rules_file):
-        self.mapper = FontMapper(rules_file)
+    def __init__(self, rules_file, cache_size=DEFAULT_CACHE_SIZE):
+        # rules_file is the path of the mapping definition, whose shared FontMapper is used (see FontMapper.get), or
+        # a FontMapper. Short lines mapped one at a time (e.g. lists, forms) go through the mapping cache of size
+        # cache_size
+        self.mapper = rules_file if isinstance(rules_file, FontMapper) else FontMapper.get(rules_file, cache_size)
+        self.rules_file = self.mapper.map_json
         self.supported_ttf_fonts = self.mapper.supported_maps
 
     @staticmethod
     def detect_used_fonts(self, txt_file_path):
         return []
 
+    def get_chunk_mapper(self, from_font, to_font):
+        # Returns a function mapping a piece of text made of complete lines, exactly as if it was mapped line by line
+        if to_font.lower() == "unicode":
+            map_text = self.mapper.map_to_unicode
+            if from_font.lower() == "unicode" or self.mapper.get_rule_engine(from_font).buffer_safe:
+                # Rules never look past whitespace, so many lines can be mapped at once
+                return lambda chunk: map_text(chunk, from_font, False)
+            return lambda chunk: ''.join([map_text(line, from_font, False) for line in split_lines(chunk)])
+        # Any font of the mapping definition (or Preeti) can be the target
+        to_font = self.mapper.get_font_name(to_font)
+        map_to_font = self.mapper.map_to_font
+        return lambda chunk: ''.join([map_to_font(line, from_font, to_font) for line in split_lines(chunk)])
+
+    def __map_parallel(self, original_file, original_file_path, output_file, from_font, to_font, jobs):
+        # The input is memory mapped only to find line aligned chunk boundaries, each worker reads and maps its own
+        # chunk. Results are written in order with a bounded number of chunks in flight
+        from concurrent.futures import ProcessPoolExecutor
+        with mmap.mmap(original_file.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                    initargs=(self.rules_file, from_font, to_font)) as executor:
+            pending = collections.deque()
+            for start, end in iter_line_aligned_ranges(data):
+                pending.append(executor.submit(_map_range, original_file_path, start, end))
+                if len(pending) >= 2 * jobs:
+                    output_file.write(pending.popleft().result())
+            while pending:
+                output_file.write(pending.popleft().result())
+
     def map_fonts(self, original_file_path, output_file_path="mapped.txt", from_font="Preeti", to_font="unicode",
-                  components=[], known_unicode_fonts=[]):
+                  components=[], known_unicode_fonts=[], jobs=1):
+        # "-" can be used as original_file_path/output_file_path to read from stdin/write to stdout, both can also be
+        # text or binary (UTF-8) file objects, which are left open. The input is streamed in chunks, so memory use
+        # does not depend on the size of the file. With jobs > 1 the chunks of a (non empty) input file are mapped
+        # by that many worker processes. The input is always opened first, so that no output file is left behind when
+        # it cannot be read
         if from_font != "auto":
-            with open(original_file_path, "r", encoding="utf-8") as original_file:
-                lines_original = original_file.readlines()
-            output_file = open(output_file_path, "w")
-            for line in lines_original:
-                if to_font.lower() == "unicode":
-                    output_file.write(self.mapper.map_to_unicode(line, from_font, False))
-                elif to_font.lower() == "preeti":
-                    output_file.write(self.mapper.map_to_preeti(line, from_font, False))
-                else:
-                    raise UnsupportedMapToException
-            output_file.close()
+            map_chunk = self.get_chunk_mapper(from_font, to_font)
+            if jobs > 1 and original_file_path != STANDARD_STREAM and not is_file_object(original_file_path) \
+                    and os.path.getsize(original_file_path):
+                with open(original_file_path, "rb") as original_file:
+                    output_file = open_text_output(output_file_path)
+                    try:
+                        self.__map_parallel(original_file, original_file_path, output_file, from_font, to_font, jobs)
+                    finally:
+                        close_text_stream(output_file, output_file_path)
+                return True
+            original_file = open_text_input(original_file_path)
+            try:
+                output_file = open_text_output(output_file_path)
+                try:
+                    map_chunk = instrumentation.instrument(map_chunk, "txt.map")
+                    write = instrumentation.instrument(output_file.write, "txt.write")
+                    for chunk in instrumentation.instrument_iterator(iter_line_chunks(original_file), "txt.read"):
+                        write(map_chunk(chunk))
+                finally:
+                    close_text_stream(output_file, output_file_path)
+            finally:
+                close_text_stream(original_file, original_file_path)
         else:
             raise TxtAutoModeException
         return True
+
+    async def amap_fonts(self, original_file_path, output_file_path=None, from_font="Preeti", to_font="unicode",
+                         components=[], known_unicode_fonts=[], jobs=1):
+        # map_fonts() for asyncio code, run in the shared executor (see executor.py). original_file_path can also be
+        # the bytes of the file. Returns the bytes of the mapped file when output_file_path is None
+        from .executor import run_in_executor, map_to_output
+        return await run_in_executor(map_to_output, self.map_fonts, original_file_path, output_file_path,
+                                     from_font=from_font, to_font=to_font, components=components,
+                                     known_unicode_fonts=known_unicode_fonts, jobs=jobs)
@@ -0,0 +1,361 @@
+from xml.etree import ElementTree as ET
+from .fontmapper import FontMapper, DEFAULT_CACHE_SIZE
+from .ziprepack import repack_zip
+from .xmlescape import escape, quote_attribute
+from . import instrumentation
+import html
+import posixpath
+import re
+import zipfile
+
+WORKBOOK_PART = "xl/workbook.xml"
+WORKBOOK_RELATIONSHIPS_PART = "xl/_rels/workbook.xml.rels"
+# Parts of the workbook found through its relationships, by the last segment of the relationship type
+WORKBOOK_PART_TYPES = ("worksheet", "sharedStrings", "styles")
+# Parts are rewritten with regular expressions instead of being parsed, so whatever the parts hold besides the text
+# and the font names is kept byte for byte. Element names may carry a namespace prefix ("x:" in some generators)
+FONTS_BLOCK = re.compile(r'<((?:\w+:)?)fonts\b[^>]*>(.*?)</\1fonts>', re.S)
+FONT_ELEMENT = re.compile(r'<((?:\w+:)?)font\b[^>]*?(?:/>|>(.*?)</\1font>)', re.S)
+CELL_FORMATS_BLOCK = re.compile(r'<((?:\w+:)?)cellXfs\b[^>]*>(.*?)</\1cellXfs>', re.S)
+CELL_FORMAT_TAG = re.compile(r'<(?:\w+:)?xf\b([^>]*)>')
+FONT_ID_ATTRIBUTE = re.compile(r'\sfontId\s*=\s*["\'](\d+)["\']')
+# Font name of a font of styles.xml ("name") or of a rich text run ("rFont")
+FONT_NAME = re.compile(r'(<(?:\w+:)?(?:name|rFont)\s+val\s*=\s*)(?:"([^"]*)"|\'([^\']*)\')')
+STRING_TABLE_TAG = re.compile(r'<(?:\w+:)?sst\b[^>]*>')
+UNIQUE_COUNT_ATTRIBUTE = re.compile(r'(\suniqueCount\s*=\s*["\'])\d+(["\'])')
+STRING_ITEM = re.compile(r'<((?:\w+:)?)si>(.*?)</\1si>|<(?:\w+:)?si\s*/>', re.S)
+RICH_TEXT_RUN = re.compile(r'<((?:\w+:)?)r>(.*?)</\1r>', re.S)
+TEXT = re.compile(r'<((?:\w+:)?)t((?:\s[^>]*)?)>(.*?)</\1t>', re.S)
+# Phonetic runs and properties follow the text of a string item, they are never mapped
+PHONETIC = re.compile(r'<(?:\w+:)?(?:rPh|phoneticPr)\b')
+# Escaped characters of OOXML strings (_xHHHH_), and what has to be escaped when writing them back
+ESCAPED_CHARACTER = re.compile(r'_x([0-9A-Fa-f]{4})_')
+CHARACTER_TO_ESCAPE = re.compile(r'[\x00-\x08\x0b\x0c\r\x0e-\x1f]|_(?=x[0-9A-Fa-f]{4}_)')
+# Start tag of a cell of type cell_type ("s" for a shared string, "inlineStr" for an inline string) whatever the
+# order of its attributes, capturing its style (cell format index, empty when it has none). Other cells are
+# skipped by the regular expression engine itself, which keeps large sheets fast to scan
+_CELL_START = (rb'<(?:\w+:)?c\b(?=[^>]*\st\s*=\s*["\']%s["\'])(?:(?=[^>]*\ss\s*=\s*["\'](\d+)["\']))?[^>]*')
+# (style, shared string index) of the shared string cells of a sheet
+SHARED_STRING_CELL = re.compile(_CELL_START % b"s" + rb'>\s*<(?:\w+:)?v>\s*(\d+)')
+INLINE_STRING_CELL = re.compile(rb'(' + _CELL_START % b"inlineStr" + rb'(?<!/)>)(.*?)(?=</(?:\w+:)?c>)', re.S)
+INLINE_STRING = re.compile(rb'<((?:\w+:)?)is>(.*?)</\1is>', re.S)
+
+
+def _compile_shared_string_cells(indexes):
+    # Shared string cells whose index is one of indexes, with the start of the cell up to the index to rewrite it.
+    # Only the cells to point to another string then reach Python, however large the sheet
+    indexes = b"|".join(b"%d" % index for index in sorted(indexes))
+    return re.compile(rb'(' + _CELL_START % b"s" + rb'>\s*<(?:\w+:)?v>\s*)(' + indexes + rb')(?!\d)')
+
+
+def _decode_text(text):
+    return ESCAPED_CHARACTER.sub(lambda match: chr(int(match.group(1), 16)), html.unescape(text))
+
+
+def _encode_text(text):
+    return escape(CHARACTER_TO_ESCAPE.sub(lambda match: "_x{:04X}_".format(ord(match.group())), text))
+
+
+def _get_font_name(match):
+    return match.group(2) if match.group(2) is not None else match.group(3)
+
+
+class XlsxHandler:
+    # Maps the text of .xlsx workbooks. The font of a cell comes from its cell format in styles.xml, cells whose
+    # font is a legacy font have their text mapped and the font renamed. Every shared string (xl/sharedStrings.xml)
+    # is mapped once however many cells use it, sheets made of repeated names and places cost only their unique
+    # strings. Sheets are only rewritten when they hold inline strings to map, or cells whose shared string is also
+    # used with another font (such cells get a mapped copy of the string)
+
+    def __init__(self, rules_file, default_unicode_font_name="Kalimati", cache_size=DEFAULT_CACHE_SIZE):
+        # rules_file is the path of the mapping definition, whose shared FontMapper is used (see FontMapper.get), or
+        # a FontMapper
+        self.mapper = rules_file if isinstance(rules_file, FontMapper) else FontMapper.get(rules_file, cache_size)
+        self.rules_file = self.mapper.map_json
+        self.supported_ttf_fonts = self.mapper.supported_maps
+        self.default_unicode_font_name = default_unicode_font_name
+        self.known_devanagari_unicode_fonts = ["Kalimati", "Mangal", "Noto Sans Devanagari"]
+
+    @staticmethod
+    def __get_workbook_parts(zf):
+        # {relationship type: [part names]} of the worksheets, shared strings and styles of the workbook
+        parts = {part_type: [] for part_type in WORKBOOK_PART_TYPES}
+        try:
+            relationships = ET.fromstring(zf.read(WORKBOOK_RELATIONSHIPS_PART))
+        except KeyError:
+            return parts
+        names = set(zf.namelist())
+        for relationship in relationships.iter(
+                "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"):
+            part_type = relationship.get("Type", "").rsplit("/", 1)[-1]
+            if part_type not in parts or relationship.get("TargetMode") == "External":
+                continue
+            target = relationship.get("Target", "")
+            # Targets are relative to the "xl" directory unless they start with "/"
+            if target.startswith("/"):
+                name = target[1:]
+            else:
+                name = posixpath.normpath(posixpath.join(posixpath.dirname(WORKBOOK_PART), target))
+            if name in names and name not in parts[part_type]:
+                parts[part_type].append(name)
+        return parts
+
+    @staticmethod
+    def __read_text(zf, part_names):
+        # Content of the first of part_names as text, None when the workbook has none
+        return zf.read(part_names[0]).decode("utf-8") if part_names else None
+
+    def detect_used_fonts(self, xlsx_file_path):
+        # Supported fonts named by the fonts of styles.xml and by the rich text runs of the shared strings
+        detected_supported_fonts = []
+        with zipfile.ZipFile(xlsx_file_path) as zf:
+            parts = self.__get_workbook_parts(zf)
+            texts = [self.__read_text(zf, parts["styles"]), self.__read_text(zf, parts["sharedStrings"])]
+        for text in texts:
+            for match in FONT_NAME.finditer(text or ""):
+                font = self.__find_supported_font(_get_font_name(match))
+                if font is not None and font not in detected_supported_fonts:
+                    detected_supported_fonts.append(font)
+        return detected_supported_fonts
+
+    def __find_supported_font(self, font_name):
+        # Name in the mapping definition of the legacy font font_name, ignoring case, None when it is not one
+        folded = font_name.casefold()
+        for name in self.mapper.all_rules:
+            if name.casefold() == folded:
+                return name
+        return None
+
+    def __get_source_font(self, font_name, from_font, to_font, known_unicode_fonts):
+        # Font the text written in font_name (None for a font without a name) is mapped from, None when it is left
+        # as it is. Every font is read as from_font outside of auto mode
+        if from_font != "auto":
+            return from_font
+        if font_name is None:
+            return None
+        source = self.__find_supported_font(font_name)
+        if source is not None and source.casefold() != to_font.casefold():
+            return source
+        if to_font.lower() != "unicode" and font_name.casefold() in [
+                name.casefold() for name in self.known_devanagari_unicode_fonts + known_unicode_fonts]:
+            return "unicode"
+        return None
+
+    def __map_styles(self, styles, get_source_font, target_font):
+        # Rename the fonts of styles.xml that are mapped, returns the new styles.xml and the font each cell format
+        # (by index) is mapped from
+        font_sources = []
+
+        def map_font(match):
+            name_match = FONT_NAME.search(match.group(0))
+            source = get_source_font(_get_font_name(name_match) if name_match is not None else None)
+            font_sources.append(source)
+            if source is None:
+                return match.group(0)
+            return FONT_NAME.sub(lambda name: name.group(1) + quote_attribute(target_font), match.group(0))
+
+        def map_fonts(match):
+            return FONT_ELEMENT.sub(map_font, match.group(0))
+
+        styles = FONTS_BLOCK.sub(map_fonts, styles, count=1)
+        format_sources = []
+        formats = CELL_FORMATS_BLOCK.search(styles)
+        if formats is not None:
+            for tag in CELL_FORMAT_TAG.finditer(formats.group(2)):
+                font_id = FONT_ID_ATTRIBUTE.search(tag.group(1))
+                font_id = int(font_id.group(1)) if font_id is not None else 0
+                format_sources.append(font_sources[font_id] if font_id < len(font_sources) else get_source_font(None))
+        return styles, format_sources
+
+    def __map_string_item(self, content, cell_source, get_source_font, to_font, target_font):
+        # Map the content of a string item (<si> or <is>) of a cell whose font is mapped from cell_source (None when
+        # it is not mapped). Rich text runs naming their own font follow that font instead
+
+        def map_texts(text, source):
+            return TEXT.sub(lambda match: "<{0}t{1}>{2}</{0}t>".format(
+                match.group(1), match.group(2), _encode_text(self.mapper.map_to_font(
+                    _decode_text(match.group(3)), source, to_font))), text)
+
+        def map_run(match):
+            run = match.group(2)
+            font_name = FONT_NAME.search(run)
+            source = cell_source if font_name is None else get_source_font(_get_font_name(font_name))
+            if source is None:
+                return match.group(0)
+            run = map_texts(run, source)
+            if font_name is not None:
+                run = FONT_NAME.sub(lambda name: name.group(1) + quote_attribute(target_font), run)
+            return "<{0}r>{1}</{0}r>".format(match.group(1), run)
+
+        if RICH_TEXT_RUN.search(content):
+            return RICH_TEXT_RUN.sub(map_run, content)
+        if cell_source is None:
+            return content
+        phonetic = PHONETIC.search(content)
+        cut = phonetic.start() if phonetic is not None else len(content)
+        return map_texts(content[:cut], cell_source) + content[cut:]
+
+    @staticmethod
+    def __scan_sheet(sheet, format_sources, default_source, references):
+        # Add the shared strings used by the cells of sheet, and the fonts they are mapped from, to references.
+        # Returns the set of (shared string index, source font) of the sheet. Cells are deduplicated on their
+        # (style, index) before anything is done with them in Python. Cells with a style missing from styles.xml
+        # are mapped from default_source
+        used = set()
+        for style, index in set(SHARED_STRING_CELL.findall(sheet)):
+            style = int(style or 0)
+            key = (int(index), format_sources[style] if style < len(format_sources) else default_source)
+            if key not in used:
+                used.add(key)
+                references.setdefault(key[0], set()).add(key[1])
+        return used
+
+    def __map_shared_strings(self, shared_strings, references, map_string_item):
+        # Map every referenced shared string once per source font it is used with. The first variant keeps the
+        # index of the string, the others are appended to the table. Returns the new table and
+        # {(index, source font): new index} for the cells to point to an appended string
+        items = list(STRING_ITEM.finditer(shared_strings))
+        mapped_items = {}
+        appended = []
+        appended_indexes = {}
+        moved = {}
+        output = []
+        position = 0
+        for index, match in enumerate(items):
+            sources = references.get(index)
+            if not sources or match.group(2) is None:
+                continue
+            content = match.group(2)
+            # Cells not mapped keep the string, otherwise any variant can
+            sources = sorted(sources, key=lambda source: (source is not None, source or ""))
+            variants = {}
+            for source in sources:
+                key = (content, source)
+                if key not in mapped_items:
+                    mapped_items[key] = map_string_item(content, source)
+                variants[source] = mapped_items[key]
+            kept = variants[sources[0]]
+            for source in sources[1:]:
+                if variants[source] != kept:
+                    if variants[source] not in appended_indexes:
+                        appended_indexes[variants[source]] = len(items) + len(appended)
+                        appended.append("<{0}si>{1}</{0}si>".format(match.group(1), variants[source]))
+                    moved[(index, source)] = appended_indexes[variants[source]]
+            if kept != content:
+                output.append(shared_strings[position:match.start(2)])
+                output.append(kept)
+                position = match.end(2)
+        if appended:
+            # New items go right before the end tag of the table
+            end = shared_strings.rfind("</")
+            output.append(shared_strings[position:end])
+            output.extend(appended)
+            position = end
+        output.append(shared_strings[position:])
+        shared_strings = "".join(output)
+        if appended:
+            shared_strings = STRING_TABLE_TAG.sub(lambda tag: UNIQUE_COUNT_ATTRIBUTE.sub(
+                lambda count: "{}{}{}".format(count.group(1), len(items) + len(appended), count.group(2)),
+                tag.group(0)), shared_strings, count=1)
+        return shared_strings, moved
+
+    @staticmethod
+    def __rewrite_sheet(sheet, format_sources, default_source, moved, moved_cells, map_string_item):
+        # Point the cells of sheet to their appended shared string (moved_cells matching the cells whose string may
+        # have been moved, None when none was), and map its inline strings. Identical inline strings of cells with
+        # the same font are mapped once
+        def get_source(style):
+            style = int(style or 0)
+            return format_sources[style] if style < len(format_sources) else default_source
+
+        def move_cell(match):
+            new_index = moved.get((int(match.group(3)), get_source(match.group(2))))
+            if new_index is None:
+                return match.group(0)
+            return b"%s%d" % (match.group(1), new_index)
+
+        mapped_inline_strings = {}
+
+        def map_inline_string(match):
+            key = (match.group(3), get_source(match.group(2)))
+            if key not in mapped_inline_strings:
+                mapped_inline_strings[key] = INLINE_STRING.sub(lambda inline: b"<%sis>%s</%sis>" % (
+                    inline.group(1), map_string_item(inline.group(2).decode("utf-8"), key[1]).encode("utf-8"),
+                    inline.group(1)), key[0])
+            return match.group(1) + mapped_inline_strings[key]
+
+        if moved_cells is not None:
+            sheet = moved_cells.sub(move_cell, sheet)
+        return INLINE_STRING_CELL.sub(map_inline_string, sheet)
+
+    def map_fonts(self, original_file_path, output_file_path="mapped.xlsx", from_font="auto", to_font="unicode",
+                  components=None, known_unicode_fonts=None):
+        # original_file_path and output_file_path can also be binary file objects. In auto mode the cells and rich
+        # text runs in a supported font are mapped (when mapping to a font, also those in a known unicode font),
+        # otherwise every string is read as from_font. Numbers keep their value whatever their font.
+        # components serves no purpose, it is there to match the method call of DocxHandler
+        if known_unicode_fonts is None:
+            known_unicode_fonts = []
+        if to_font.lower() == "unicode":
+            target_font = self.default_unicode_font_name
+        else:
+            # Fail before writing anything when the target font is unknown
+            target_font = self.mapper.get_font_name(to_font)
+
+        def get_source_font(font_name):
+            return self.__get_source_font(font_name, from_font, to_font, known_unicode_fonts)
+
+        def map_string_item(content, cell_source):
+            return self.__map_string_item(content, cell_source, get_source_font, to_font, target_font)
+
+        # Source of the cells of a font without a name, or of a style styles.xml does not define
+        default_source = get_source_font(None)
+        replacements = {}
+        with zipfile.ZipFile(original_file_path) as zf:
+            parts = self.__get_workbook_parts(zf)
+            format_sources = []
+            styles = self.__read_text(zf, parts["styles"])
+            if styles is not None:
+                new_styles, format_sources = self.__map_styles(styles, get_source_font, target_font)
+                if new_styles != styles:
+                    replacements[parts["styles"][0]] = new_styles.encode("utf-8")
+            references = {}
+            sheets = {}
+            with instrumentation.timed("xlsx.scan"):
+                for name in parts["worksheet"]:
+                    sheet = zf.read(name)
+                    used = self.__scan_sheet(sheet, format_sources, default_source, references)
+                    # Only sheets that have to be rewritten anyway are kept in memory
+                    sheets[name] = (sheet if INLINE_STRING_CELL.search(sheet) else None, used)
+            moved = {}
+            shared_strings = self.__read_text(zf, parts["sharedStrings"])
+            if shared_strings is not None:
+                with instrumentation.timed("xlsx.shared_strings", len(shared_strings)):
+                    new_shared_strings, moved = self.__map_shared_strings(shared_strings, references,
+                                                                          map_string_item)
+                if new_shared_strings != shared_strings:
+                    replacements[parts["sharedStrings"][0]] = new_shared_strings.encode("utf-8")
+            moved_cells = _compile_shared_string_cells({index for index, _ in moved}) if moved else None
+            with instrumentation.timed("xlsx.rewrite_sheets"):
+                for name, (sheet, used) in sheets.items():
+                    if sheet is None:
+                        if not any(key in moved for key in used):
+                            continue
+                        sheet = zf.read(name)
+                    new_sheet = self.__rewrite_sheet(sheet, format_sources, default_source, moved, moved_cells,
+                                                     map_string_item)
+                    if new_sheet != sheet:
+                        replacements[name] = new_sheet
+        # Every other part is copied without being decompressed
+        with instrumentation.timed("xlsx.repack"):
+            repack_zip(original_file_path, output_file_path, replacements)
+        return True
+
+    async def amap_fonts(self, original_file_path, output_file_path=None, from_font="auto", to_font="unicode",
+                         components=None, known_unicode_fonts=None):
+        # map_fonts() for asyncio code, run in the shared executor (see executor.py). original_file_path can also be
+        # a file object or the bytes of the file. Returns the bytes of the mapped file when output_file_path is None
+        from .executor import run_in_executor, map_to_output
+        return await run_in_executor(map_to_output, self.map_fonts, original_file_path, output_file_path,
+                                     from_font=from_font, to_font=to_font, components=components,
+                                     known_unicode_fonts=known_unicode_fonts)
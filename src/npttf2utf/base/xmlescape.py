@@ -0,0 +1,16 @@
+# Characters ElementTree writes as character references in attribute values, besides the ones escape() handles
+ATTRIBUTE_ENTITIES = {"\n": "&#10;", "\r": "&#13;", "\t": "&#09;", '"': "&quot;"}
+
+
+def escape(data, entities=None):
+    # Same as xml.sax.saxutils.escape(), which would pull in urllib when imported. entities maps more characters to
+    # their entity
+    data = data.replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;")
+    for character, entity in (entities or {}).items():
+        data = data.replace(character, entity)
+    return data
+
+
+def quote_attribute(data):
+    # Attribute value the way ElementTree writes it
+    return '"{}"'.format(escape(data, ATTRIBUTE_ENTITIES))
@@ -0,0 +1,105 @@
+import shutil
+import struct
+import zipfile
+
+# Size of the fixed part of a local file header
+_LOCAL_HEADER_SIZE = 30
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_FLAG_ENCRYPTED = 0x01
+_FLAG_DATA_DESCRIPTOR = 0x08
+_ZIP64_EXTRA_ID = 0x0001
+_COPY_BUFFER_SIZE = 1 << 20
+# Largest growth of a member rewritten by a function. A legacy font character maps to at most 12 bytes of UTF-8
+# (a conjunct of several Devanagari characters), text as a whole grows about 4 times
+_MAX_GROWTH = 12
+# Private zipfile attributes the raw copy relies on, members are recompressed when one of them is missing
+_ZIPFILE_INTERNALS = ("fp", "_seekable", "start_dir", "_didModify", "filelist", "NameToInfo")
+
+
+def _strip_zip64_extra(extra):
+    # The ZIP64 record of the original archive would be wrong for the copy, the header is written without one
+    kept = []
+    index = 0
+    while index + 4 <= len(extra):
+        header_id, size = struct.unpack("<HH", extra[index:index + 4])
+        if header_id != _ZIP64_EXTRA_ID:
+            kept.append(extra[index:index + 4 + size])
+        index += 4 + size
+    return b"".join(kept)
+
+
+def _copy_info(info):
+    copied = zipfile.ZipInfo(info.filename, info.date_time)
+    copied.compress_type = info.compress_type
+    copied.comment = info.comment
+    copied.extra = _strip_zip64_extra(info.extra)
+    copied.create_system = info.create_system
+    copied.internal_attr = info.internal_attr
+    copied.external_attr = info.external_attr
+    return copied
+
+
+def _copy_member_raw(source, target, info):
+    # Copy the still compressed bytes of a member from one archive to the other. zipfile has no public API for
+    # this, so the local header is written the way ZipFile._open_to_write() does it. Returns False when the member
+    # has to go through the regular (decompress and recompress) path instead
+    if info.flag_bits & _FLAG_ENCRYPTED or max(info.file_size, info.compress_size) >= zipfile.ZIP64_LIMIT \
+            or not all(hasattr(target, name) for name in _ZIPFILE_INTERNALS) \
+            or not hasattr(zipfile.ZipInfo, "FileHeader") or not target._seekable:
+        return False
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(_LOCAL_HEADER_SIZE)
+    if len(header) != _LOCAL_HEADER_SIZE or header[:4] != _LOCAL_HEADER_SIGNATURE:
+        return False
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    copied = _copy_info(info)
+    # Sizes and CRC are known from the central directory, so a data descriptor is never needed
+    copied.flag_bits = info.flag_bits & ~_FLAG_DATA_DESCRIPTOR
+    copied.CRC = info.CRC
+    copied.compress_size = info.compress_size
+    copied.file_size = info.file_size
+    target.fp.seek(target.start_dir)
+    copied.header_offset = target.fp.tell()
+    target._didModify = True
+    target.fp.write(copied.FileHeader(False))
+    source.fp.seek(info.header_offset + _LOCAL_HEADER_SIZE + name_length + extra_length)
+    remaining = info.compress_size
+    while remaining:
+        data = source.fp.read(min(remaining, _COPY_BUFFER_SIZE))
+        if not data:
+            raise zipfile.BadZipFile("Truncated data for member {!r}".format(info.filename))
+        target.fp.write(data)
+        remaining -= len(data)
+    target.start_dir = target.fp.tell()
+    target.filelist.append(copied)
+    target.NameToInfo[copied.filename] = copied
+    return True
+
+
+def repack_zip(original_file, output_file, replacements):
+    # Write a copy of the zip archive original_file to output_file in which the members named in replacements get
+    # new content. A replacement is either bytes or a function receiving a writable stream for the member. Every
+    # other member is copied as is, without being decompressed, and nothing is extracted to disk
+    with zipfile.ZipFile(original_file, "r") as source, zipfile.ZipFile(output_file, "w") as target:
+        for info in source.infolist():
+            replacement = replacements.get(info.filename)
+            if replacement is None:
+                if not _copy_member_raw(source, target, info):
+                    copied = _copy_info(info)
+                    copied.file_size = info.file_size
+                    with source.open(info) as member, target.open(copied, "w") as copy:
+                        shutil.copyfileobj(member, copy, _COPY_BUFFER_SIZE)
+                continue
+            new_info = _copy_info(info)
+            if new_info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                new_info.compress_type = zipfile.ZIP_DEFLATED
+            if callable(replacement):
+                # The final size is unknown, a ZIP64 header is written whenever the new content could reach the limit
+                with target.open(new_info, "w", force_zip64=info.file_size * _MAX_GROWTH >= zipfile.ZIP64_LIMIT) \
+                        as member:
+                    replacement(member)
+            else:
+                new_info.file_size = len(replacement)
+                with target.open(new_info, "w") as member:
+                    member.write(replacement)
+    return True
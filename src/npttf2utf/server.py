@@ -0,0 +1,344 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+from xml.etree import ElementTree as ET
+from .base.exceptions import NoMapForOriginException, UnsupportedMapToException, TxtAutoModeException, \
+    MapFileNotFoundException
+from .base.fontmapper import FontMapper, DEFAULT_CACHE_SIZE, MAX_CACHED_LENGTH
+from .base.txthandler import TxtHandler
+from .base.docxhandler import DocxHandler
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# Files being converted or waiting for a worker process, requests beyond this get a 503 response
+DEFAULT_MAX_QUEUE = 32
+DEFAULT_MAX_BODY_SIZE = 64 << 20
+# Longest /string body (in bytes) mapped on the event loop, longer strings are handed to the worker processes like
+# files so that they do not hold up the other connections
+MAX_INLINE_STRING_SIZE = MAX_CACHED_LENGTH
+# Longest request line or header line accepted
+MAX_HEADER_SIZE = 64 << 10
+# Seconds an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 60
+# Most bytes of a request body larger than the limit read and dropped after the 413 response, see __discard()
+MAX_DISCARDED_BODY_SIZE = 16 << 20
+# Seconds the client is given to send the rest of such a body
+DISCARD_TIMEOUT = 10
+
+TEXT_CONTENT_TYPE = "text/plain; charset=utf-8"
+JSON_CONTENT_TYPE = "application/json"
+DOCX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+STATUS_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+# Responses to the errors raised for a bad request, the same messages as the command line tool
+ERROR_MESSAGES = {
+    NoMapForOriginException: "The mapping for selected origin font does not exist",
+    UnsupportedMapToException: "Cannot map to given output font",
+    TxtAutoModeException: "Font auto detection does not work on plain text",
+}
+FILE_FORMAT_ERRORS = (zipfile.BadZipFile, KeyError, UnicodeDecodeError, ET.ParseError)
+
+# Handlers of the current worker process, created once per process by _init_worker()
+_worker_handlers = {}
+
+
+def _warm_up(mapper):
+    # Compile the rules of every font before the first request needs them
+    for font in mapper.all_rules:
+        mapper.get_rule_engine(font)
+
+
+def _init_worker(rules_file, cache_size):
+    mapper = FontMapper.get(rules_file, cache_size)
+    _warm_up(mapper)
+    _worker_handlers["plain"] = TxtHandler(mapper)
+    _worker_handlers["docx"] = DocxHandler(mapper)
+
+
+def _ping():
+    return os.getpid()
+
+
+def _convert_string(data, from_font, to_font):
+    return _worker_handlers["plain"].mapper.map_to_font(data.decode("utf-8"), from_font=from_font,
+                                                        to_font=to_font).encode("utf-8")
+
+
+def _convert_plain(data, from_font, to_font):
+    if from_font == "auto":
+        raise TxtAutoModeException
+    map_chunk = _worker_handlers["plain"].get_chunk_mapper(from_font, to_font)
+    return map_chunk(data.decode("utf-8")).encode("utf-8")
+
+
+def _convert_docx(data, options):
+    output = BytesIO()
+    _worker_handlers["docx"].map_fonts(BytesIO(data), output, **options)
+    return output.getvalue()
+
+
+def _split_list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+class ConversionServer:
+    # Local HTTP daemon (over TCP or a Unix socket) keeping the compiled rules in memory between requests. Short
+    # strings are mapped on the event loop, longer ones, plain text and docx files by a pool of jobs worker
+    # processes, which is replaced when one of them dies. At most max_queue of those are converted or waiting for a
+    # worker at a time, further requests get a 503 response right away instead of piling up. Endpoints:
+    #   POST /string, /plain, /docx ?from_font=...&to_font=...  (docx also takes components, known_unicode_fonts,
+    #                                                           low_memory and coalesce_runs), the body is the input
+    #   GET /health                                             JSON with the queue state
+
+    def __init__(self, rules_file=None, jobs=None, max_queue=DEFAULT_MAX_QUEUE, max_body_size=DEFAULT_MAX_BODY_SIZE,
+                 cache_size=DEFAULT_CACHE_SIZE):
+        self.mapper = FontMapper.get(rules_file, cache_size)
+        self.rules_file = self.mapper.map_json
+        self.cache_size = cache_size
+        self.jobs = max(1, jobs or os.cpu_count() or 1)
+        self.max_queue = max(1, max_queue)
+        self.max_body_size = max_body_size
+        self.queued = 0
+        self.executor = None
+        self.server = None
+        self.unix_socket = None
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None):
+        _warm_up(self.mapper)
+        self.executor = self.__new_executor()
+        loop = asyncio.get_running_loop()
+        # Start the worker processes now so that the first requests do not wait for them
+        await asyncio.gather(*[loop.run_in_executor(self.executor, _ping) for _ in range(self.jobs)])
+        if unix_socket is not None:
+            self.unix_socket = unix_socket
+            self.server = await asyncio.start_unix_server(self.__handle_connection, path=unix_socket,
+                                                          limit=MAX_HEADER_SIZE)
+        else:
+            self.server = await asyncio.start_server(self.__handle_connection, host, port, limit=MAX_HEADER_SIZE)
+        return self.server
+
+    def __new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker,
+                                   initargs=(self.rules_file, self.cache_size))
+
+    async def __run_in_worker(self, function, *args):
+        # A worker process that dies (e.g. killed for using too much memory) breaks the whole pool, every later
+        # conversion would fail with it. The broken pool is replaced so that only the requests in progress fail
+        executor = self.executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+        except BrokenProcessPool:
+            if self.executor is executor:
+                self.executor = self.__new_executor()
+                executor.shutdown(wait=False)
+            raise
+
+    def addresses(self):
+        # Addresses the server listens on, "http://host:port" or the path of the Unix socket
+        if self.unix_socket is not None:
+            return [self.unix_socket]
+        return ["http://{}:{}".format(*sock.getsockname()[:2]) for sock in self.server.sockets]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.unix_socket is not None:
+            try:
+                os.remove(self.unix_socket)
+            except OSError:
+                pass
+            self.unix_socket = None
+
+    async def serve_forever(self):
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def __handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+                    await self.__respond(writer, *self.__error(400, "Malformed request line"), keep_alive=False)
+                    break
+                method, target, version = parts
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                if "transfer-encoding" in headers:
+                    await self.__respond(writer, *self.__error(411, "Chunked requests are not supported"),
+                                         keep_alive=False)
+                    break
+                try:
+                    length = int(headers.get("content-length", "0"))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.__respond(writer, *self.__error(400, "Invalid Content-Length"), keep_alive=False)
+                    break
+                if length > self.max_body_size:
+                    # The body is not kept, the connection cannot be reused
+                    await self.__respond(writer, *self.__error(413, "Request body larger than {} bytes".format(
+                        self.max_body_size)), keep_alive=False)
+                    await self.__discard(reader, writer, length)
+                    break
+                body = await reader.readexactly(length)
+                status, content_type, payload = await self.__dispatch(method, target, body)
+                await self.__respond(writer, status, content_type, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def __discard(reader, writer, length):
+        # Closing the connection while the client is still sending the body resets it, and the client gets a
+        # broken pipe instead of the response. The write side is shut down and the body read and dropped (up to
+        # MAX_DISCARDED_BODY_SIZE bytes) until the client is done or stops sending
+        if writer.can_write_eof():
+            writer.write_eof()
+        remaining = min(length, MAX_DISCARDED_BODY_SIZE)
+        try:
+            while remaining > 0:
+                data = await asyncio.wait_for(reader.read(min(remaining, 1 << 16)), DISCARD_TIMEOUT)
+                if not data:
+                    break
+                remaining -= len(data)
+        except asyncio.TimeoutError:
+            pass
+
+    @staticmethod
+    def __error(status, message):
+        return status, JSON_CONTENT_TYPE, json.dumps({"error": message}).encode("utf-8")
+
+    async def __respond(self, writer, status, content_type, payload, keep_alive):
+        head = ["HTTP/1.1 {} {}".format(status, STATUS_REASONS[status]),
+                "Content-Type: {}".format(content_type),
+                "Content-Length: {}".format(len(payload)),
+                "Connection: {}".format("keep-alive" if keep_alive else "close")]
+        if status == 503:
+            head.append("Retry-After: 1")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+        # Waits while the client is not reading, so a slow client cannot make responses pile up in memory
+        await writer.drain()
+
+    async def __dispatch(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == "/health":
+            if method != "GET":
+                return self.__error(405, "Use GET")
+            return 200, JSON_CONTENT_TYPE, json.dumps({"status": "ok", "jobs": self.jobs, "queued": self.queued,
+                                                       "max_queue": self.max_queue}).encode("utf-8")
+        if url.path not in ("/string", "/plain", "/docx"):
+            return self.__error(404, "Unknown endpoint {}".format(url.path))
+        if method != "POST":
+            return self.__error(405, "Use POST")
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        from_font = query.get("from_font", "auto" if url.path == "/docx" else "Preeti")
+        to_font = query.get("to_font", "unicode")
+        try:
+            if url.path == "/string" and len(body) <= MAX_INLINE_STRING_SIZE:
+                text = self.mapper.map_to_font(body.decode("utf-8"), from_font=from_font, to_font=to_font)
+                return 200, TEXT_CONTENT_TYPE, text.encode("utf-8")
+            if self.queued >= self.max_queue:
+                return self.__error(503, "Too many conversions in progress, retry later")
+            self.queued += 1
+            try:
+                if url.path != "/docx":
+                    convert = _convert_string if url.path == "/string" else _convert_plain
+                    result = await self.__run_in_worker(convert, body, from_font, to_font)
+                    return 200, TEXT_CONTENT_TYPE, result
+                options = {"from_font": from_font, "to_font": to_font,
+                           "known_unicode_fonts": _split_list(query.get("known_unicode_fonts", "")),
+                           "low_memory": query.get("low_memory", "0").lower() in ("1", "true", "yes"),
+                           "coalesce_runs": query.get("coalesce_runs", "0").lower() in ("1", "true", "yes")}
+                if "components" in query:
+                    options["components"] = _split_list(query["components"])
+                result = await self.__run_in_worker(_convert_docx, body, options)
+                return 200, DOCX_CONTENT_TYPE, result
+            finally:
+                self.queued -= 1
+        except tuple(ERROR_MESSAGES) as e:
+            return self.__error(400, ERROR_MESSAGES[type(e)])
+        except BrokenProcessPool:
+            return self.__error(500, "A worker process stopped during the conversion")
+        except FILE_FORMAT_ERRORS:
+            return self.__error(400, "The request body either does not match the endpoint or is corrupted")
+        except Exception as e:
+            return self.__error(500, "{}: {}".format(type(e).__name__, e))
+
+
+async def _serve(server, args):
+    try:
+        # Stop cleanly (workers shut down, socket file removed) when terminated
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass
+    await server.start(args.host, args.port, args.socket)
+    for address in server.addresses():
+        print("Listening on {}".format(address), flush=True)
+    await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="npttf2utf serve",
+                                     description="Run a local conversion daemon keeping the mapping rules loaded")
+    parser.add_argument('--host', dest='host', default=DEFAULT_HOST,
+                        help='Address to listen on (Defaults to {})'.format(DEFAULT_HOST))
+    parser.add_argument('-p', '--port', dest='port', type=int, default=DEFAULT_PORT,
+                        help='Port to listen on, 0 picks a free one (Defaults to {})'.format(DEFAULT_PORT))
+    parser.add_argument('-s', '--socket', dest='socket',
+                        help='Listen on this Unix socket instead of a TCP port')
+    parser.add_argument('-mf', '--map-file', dest='mapfile', help='Mapping definition file')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                        help='Number of worker processes converting files (Defaults to the number of CPUs)')
+    parser.add_argument('-q', '--max-queue', dest='maxqueue', type=int, default=DEFAULT_MAX_QUEUE,
+                        help='Files converted or waiting at once, more requests are answered with 503 (Defaults '
+                             'to {})'.format(DEFAULT_MAX_QUEUE))
+    parser.add_argument('-b', '--max-body-size', dest='maxbodysize', type=int, default=DEFAULT_MAX_BODY_SIZE,
+                        help='Largest accepted request body in bytes (Defaults to {})'.format(DEFAULT_MAX_BODY_SIZE))
+    args = parser.parse_args(argv)
+    rule_file = args.mapfile or os.path.join(os.path.dirname(os.path.realpath(__file__)), "map.json")
+    try:
+        server = ConversionServer(rule_file, jobs=args.jobs, max_queue=args.maxqueue, max_body_size=args.maxbodysize)
+    except MapFileNotFoundException:
+        print("Cannot find the map file '{}'".format(rule_file))
+        return
+    try:
+        asyncio.run(_serve(server, args))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
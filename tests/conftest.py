@@ -0,0 +1,116 @@
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape
+
+import pytest
+
+MAP_JSON = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "src", "npttf2utf", "map.json")
+
+WORD_NAMESPACES = ('xmlns:mc="http://schemas.openxmlformats.org/markup-compatibility/2006" '
+                   'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" '
+                   'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+                   'xmlns:wps="http://schemas.microsoft.com/office/word/2010/wordprocessingShape" '
+                   'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+                   'xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing"')
+RELATIONSHIP_TYPE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/"
+SHEET_NAMESPACE = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+WORD_TEXT = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}t"
+
+_cache_directory = None
+
+
+def pytest_configure(config):
+    # The compiled map cache of the tests is kept apart from the one of the user
+    global _cache_directory
+    _cache_directory = tempfile.mkdtemp(prefix="npttf2utf-tests-")
+    os.environ["NPTTF2UTF_CACHE_DIR"] = _cache_directory
+
+
+def pytest_unconfigure(config):
+    if _cache_directory is not None:
+        shutil.rmtree(_cache_directory, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def map_json():
+    return MAP_JSON
+
+
+@pytest.fixture(scope="session")
+def all_rules():
+    with open(MAP_JSON, encoding="utf-8") as map_file:
+        return json.load(map_file)
+
+
+def word_run(text, font="Preeti"):
+    properties = '<w:rFonts w:ascii="{0}" w:hAnsi="{0}"/>'.format(font) if font else '<w:rFonts w:cs="Mangal"/>'
+    return '<w:r><w:rPr>{}</w:rPr><w:t xml:space="preserve">{}</w:t></w:r>'.format(properties, escape(text))
+
+
+def word_paragraph(*runs):
+    return "<w:p>{}</w:p>".format("".join(runs))
+
+
+def write_docx(path, body, story_parts=None):
+    # Minimal docx package: document.xml with body (the children of w:body) and story_parts, {part name: (type of
+    # relationship, root element)}, along with an image copied as it is
+    story_parts = story_parts or {}
+    relationships = ['<Relationship Id="rId1" Type="{}image" Target="media/image1.png"/>'.format(RELATIONSHIP_TYPE)]
+    for number, (name, (relationship_type, _)) in enumerate(story_parts.items(), 2):
+        relationships.append('<Relationship Id="rId{}" Type="{}{}" Target="{}"/>'.format(
+            number, RELATIONSHIP_TYPE, relationship_type, name[len("word/"):]))
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as package:
+        package.writestr("[Content_Types].xml", '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas'
+                                                '.openxmlformats.org/package/2006/content-types"/>')
+        package.writestr("word/document.xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                                              '<w:document {}><w:body>{}<w:sectPr/></w:body></w:document>'.format(
+                                                  WORD_NAMESPACES, body))
+        package.writestr("word/_rels/document.xml.rels", '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns'
+                                                         '="http://schemas.openxmlformats.org/package/2006/relationsh'
+                                                         'ips">{}</Relationships>'.format("".join(relationships)))
+        package.writestr("word/media/image1.png", bytes(range(256)) * 64, compress_type=zipfile.ZIP_STORED)
+        for name, (_, root) in story_parts.items():
+            package.writestr(name, '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' +
+                             root.format(namespaces=WORD_NAMESPACES))
+
+
+def part_texts(path, name):
+    # Texts of the runs of the part name of a docx package
+    with zipfile.ZipFile(path) as package:
+        return [element.text for element in ET.fromstring(package.read(name)).iter(WORD_TEXT)]
+
+
+def write_xlsx(path, shared_strings, rows, fonts=("Calibri", "Preeti")):
+    # Minimal xlsx package with a single sheet. shared_strings are the <si> items, rows lists the (style, shared
+    # string index) of the cells of each row. Style n uses the font fonts[n], None for a font without a name
+    font_elements = "".join('<font><name val="{}"/></font>'.format(font) if font else '<font><sz val="11"/></font>'
+                            for font in fonts)
+    cell_formats = "".join('<xf fontId="{}" applyFont="1"/>'.format(number) for number in range(len(fonts)))
+    sheet_rows = "".join('<row r="{0}">{1}</row>'.format(number, "".join(
+        '<c r="{}{}" s="{}" t="s"><v>{}</v></c>'.format(chr(ord("A") + column), number, style, index)
+        for column, (style, index) in enumerate(cells))) for number, cells in enumerate(rows, 1))
+    parts = {
+        "[Content_Types].xml": '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.'
+                               'org/package/2006/content-types"/>',
+        "xl/workbook.xml": '<workbook xmlns="{}" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/'
+                           'relationships"><sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>'
+                           '</workbook>'.format(SHEET_NAMESPACE),
+        "xl/_rels/workbook.xml.rels": '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+                                      'relationships"><Relationship Id="rId1" Type="{0}worksheet" Target="worksheets/'
+                                      'sheet1.xml"/><Relationship Id="rId2" Type="{0}styles" Target="styles.xml"/>'
+                                      '<Relationship Id="rId3" Type="{0}sharedStrings" Target="sharedStrings.xml"/>'
+                                      '</Relationships>'.format(RELATIONSHIP_TYPE),
+        "xl/styles.xml": '<styleSheet xmlns="{0}"><fonts count="{1}">{2}</fonts><cellXfs count="{1}">{3}</cellXfs>'
+                         '</styleSheet>'.format(SHEET_NAMESPACE, len(fonts), font_elements, cell_formats),
+        "xl/sharedStrings.xml": '<sst xmlns="{}" uniqueCount="{}">{}</sst>'.format(
+            SHEET_NAMESPACE, len(shared_strings), "".join(shared_strings)),
+        "xl/worksheets/sheet1.xml": '<worksheet xmlns="{}"><sheetData>{}</sheetData></worksheet>'.format(
+            SHEET_NAMESPACE, sheet_rows),
+    }
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as package:
+        for name, content in parts.items():
+            package.writestr(name, content)
@@ -0,0 +1,27 @@
+# FontMapper.map_to_unicode() and FontMapper.map_to_preeti() as they were before the compiled rule engine: every rule
+# of the font is applied to every word, one after another. The reference the current implementation is compared with
+# (see test_ruleengine.py)
+import re
+from legacy_preetimapper import convert as pmconvert
+
+
+def map_to_unicode(all_rules, string, from_font="Preeti"):
+    if from_font.lower() == "unicode":
+        return string
+    rules = all_rules[from_font]['rules']
+    split_pattern = re.compile(r'(\s+|\S+)')
+    mapped_string = ''
+    for word in re.findall(split_pattern, string):
+        for rule in rules['pre-rules']:
+            word = re.sub(re.compile(rule[0]), rule[1], word)
+        mapped_word = ''.join(rules['character-map'].get(character, character) for character in word)
+        for rule in rules['post-rules']:
+            mapped_word = re.sub(re.compile(rule[0]), rule[1], mapped_word)
+        mapped_string = mapped_string + mapped_word
+    return mapped_string
+
+
+def map_to_preeti(all_rules, string, from_font="Preeti"):
+    if from_font.lower() == "preeti":
+        return string
+    return pmconvert(map_to_unicode(all_rules, string, from_font))
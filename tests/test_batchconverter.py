@@ -0,0 +1,79 @@
+import json
+import os
+
+import pytest
+
+from conftest import word_paragraph, word_run, write_docx
+from npttf2utf.base.batchconverter import BatchConverter
+from npttf2utf.base.exceptions import BatchOutputCollisionException, TxtAutoModeException
+
+PREETI_TEXT = "g]kfn ;/sf/"
+UNICODE_TEXT = "नेपाल सरकार"
+
+
+def read_manifest(path):
+    with open(path, encoding="utf-8") as manifest:
+        return sorted((json.loads(line) for line in manifest), key=lambda result: result["input"])
+
+
+@pytest.fixture
+def input_tree(tmp_path):
+    root = tmp_path / "input"
+    (root / "nested" / "deeper").mkdir(parents=True)
+    (root / "a.txt").write_text(PREETI_TEXT, encoding="utf-8")
+    (root / "nested" / "b.txt").write_text(PREETI_TEXT + "\n", encoding="utf-8")
+    (root / "nested" / "deeper" / "c.html").write_text('<p style="font-family: Preeti">{}</p>'.format(PREETI_TEXT),
+                                                       encoding="utf-8")
+    write_docx(str(root / "nested" / "d.docx"), word_paragraph(word_run(PREETI_TEXT)))
+    (root / "broken.docx").write_bytes(b"not a docx")
+    (root / "ignored.pdf").write_bytes(b"%PDF")
+    return root
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_convert(tmp_path, input_tree, map_json, jobs):
+    output = tmp_path / "output"
+    converted, failed = BatchConverter(map_json, jobs=jobs).convert([str(input_tree)], str(output),
+                                                                    txt_from_font="Preeti")
+    assert (converted, failed) == (4, 1)
+    # The input tree is mirrored in the output directory
+    assert (output / "a.txt").read_text(encoding="utf-8") == UNICODE_TEXT
+    assert (output / "nested" / "b.txt").read_text(encoding="utf-8") == UNICODE_TEXT + "\n"
+    assert UNICODE_TEXT in (output / "nested" / "deeper" / "c.html").read_text(encoding="utf-8")
+    assert (output / "nested" / "d.docx").is_file()
+    assert not (output / "ignored.pdf").exists()
+    results = read_manifest(output / "manifest.jsonl")
+    assert [(os.path.relpath(result["input"], str(input_tree)), result["status"]) for result in results] == [
+        ("a.txt", "ok"), ("broken.docx", "failed"), (os.path.join("nested", "b.txt"), "ok"),
+        (os.path.join("nested", "d.docx"), "ok"), (os.path.join("nested", "deeper", "c.html"), "ok")]
+    assert results[1]["error"].startswith("BadZipFile")
+
+
+def test_output_inside_input(input_tree, map_json):
+    # Outputs of an earlier run written inside the input tree are not converted again
+    output = input_tree / "converted"
+    for _ in range(2):
+        assert BatchConverter(map_json).convert([str(input_tree)], str(output), txt_from_font="Preeti") == (4, 1)
+    assert not (output / "converted").exists()
+    assert BatchConverter(map_json).convert([str(input_tree / "**" / "*.txt")], str(output),
+                                            txt_from_font="Preeti") == (2, 0)
+
+
+def test_input_inside_output(input_tree, map_json):
+    # An input inside the output directory is still searched
+    assert BatchConverter(map_json).convert([str(input_tree / "nested")], str(input_tree),
+                                            txt_from_font="Preeti") == (3, 0)
+    assert (input_tree / "b.txt").read_text(encoding="utf-8") == UNICODE_TEXT + "\n"
+
+
+def test_refused_batches(tmp_path, input_tree, map_json):
+    output = tmp_path / "output"
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "a.txt").write_text(PREETI_TEXT, encoding="utf-8")
+    with pytest.raises(BatchOutputCollisionException):
+        BatchConverter(map_json).convert([str(input_tree), str(other)], str(output), txt_from_font="Preeti")
+    # Plain text files have no fonts to detect
+    with pytest.raises(TxtAutoModeException):
+        BatchConverter(map_json).convert([str(input_tree)], str(output))
+    assert not output.exists()
@@ -0,0 +1,180 @@
+import os
+import pstats
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+from conftest import MAP_JSON, part_texts, word_paragraph, word_run, write_docx, write_xlsx
+from npttf2utf.base.fontmapper import FontMapper
+
+PREETI_TEXT = "g]kfn ;/sf/"
+UNICODE_TEXT = "नेपाल सरकार"
+
+SOURCE_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "src")
+
+
+def run_cli(*args, input=None):
+    # Run "python -m npttf2utf" with args, input being the bytes given on stdin
+    environment = dict(os.environ, PYTHONPATH=SOURCE_DIRECTORY, PYTHONIOENCODING="utf-8")
+    return subprocess.run([sys.executable, "-m", "npttf2utf"] + list(args), input=input, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, env=environment, check=False)
+
+
+def test_string_mode():
+    result = run_cli("-m", "string", "-if", "Preeti", "-i", "g]kfn", ";/sf/")
+    assert result.returncode == 0
+    assert result.stdout.decode("utf-8").strip() == UNICODE_TEXT
+
+
+def test_plain_mode(tmp_path):
+    text_file = tmp_path / "input.txt"
+    text_file.write_text(PREETI_TEXT + "\n", encoding="utf-8")
+    output = tmp_path / "output.txt"
+    result = run_cli("-m", "plain", "-if", "Preeti", "-i", str(text_file), "-o", str(output), "-mf", MAP_JSON)
+    assert result.returncode == 0
+    assert output.read_text(encoding="utf-8") == UNICODE_TEXT + "\n"
+    assert str(output) in result.stdout.decode("utf-8")
+
+
+def test_plain_mode_standard_streams():
+    # "-" reads stdin and writes stdout, nothing else is printed there
+    result = run_cli("-m", "plain", "-if", "Preeti", "-i", "-", "-o", "-",
+                     input=((PREETI_TEXT + "\n") * 3 + PREETI_TEXT).encode("utf-8"))
+    assert result.returncode == 0
+    assert result.stdout.decode("utf-8") == (UNICODE_TEXT + "\n") * 3 + UNICODE_TEXT
+
+
+def test_plain_mode_errors(tmp_path):
+    result = run_cli("-m", "plain", "-if", "Preeti", "-i", str(tmp_path / "missing.txt"), "-o", "-")
+    assert "Cannot find the input file" in result.stdout.decode("utf-8")
+    text_file = tmp_path / "input.txt"
+    text_file.write_text(PREETI_TEXT, encoding="utf-8")
+    result = run_cli("-m", "plain", "-if", "Unknown", "-i", str(text_file), "-o", "-")
+    assert "The mapping for selected origin font does not exist" in result.stdout.decode("utf-8")
+    result = run_cli("-m", "plain", "-if", "Preeti", "-i", str(text_file), "-o", "-", "-mf",
+                     str(tmp_path / "missing.json"))
+    assert "Cannot find the map file" in result.stdout.decode("utf-8")
+
+
+def test_batch_mode(tmp_path):
+    input_directory = tmp_path / "input"
+    (input_directory / "nested").mkdir(parents=True)
+    (input_directory / "a.txt").write_text(PREETI_TEXT, encoding="utf-8")
+    (input_directory / "nested" / "b.html").write_text('<p style="font-family: Preeti">{}</p>'.format(PREETI_TEXT),
+                                                      encoding="utf-8")
+    output = tmp_path / "output"
+    result = run_cli("-m", "batch", "-if", "auto", "-tif", "Preeti", "-i", str(input_directory), "-o", str(output))
+    assert result.stdout.decode("utf-8").startswith("Converted 2 files into")
+    assert (output / "a.txt").read_text(encoding="utf-8") == UNICODE_TEXT
+    assert UNICODE_TEXT in (output / "nested" / "b.html").read_text(encoding="utf-8")
+    assert (output / "manifest.jsonl").is_file()
+    # Plain text files need their font
+    result = run_cli("-m", "batch", "-if", "auto", "-i", str(input_directory), "-o", str(output))
+    assert "give their font with -tif" in result.stdout.decode("utf-8")
+
+
+def test_batch_arguments(tmp_path):
+    result = run_cli("-m", "batch", "-if", "Preeti", "-i", str(tmp_path))
+    assert result.returncode == 2 and b"batch mode needs an output directory" in result.stderr
+    result = run_cli("-m", "plain", "-if", "Preeti", "-i", "a.txt", "b.txt", "-o", "-")
+    assert result.returncode == 2 and b"use batch mode for more" in result.stderr
+
+
+@pytest.mark.parametrize("options", [[], ["-lm"]])
+def test_docx_mode(tmp_path, options):
+    docx_file = tmp_path / "input.docx"
+    write_docx(str(docx_file), word_paragraph(word_run(PREETI_TEXT), word_run("English", "Calibri")))
+    output = tmp_path / "output.docx"
+    result = run_cli("-m", "docx", "-if", "auto", "-i", str(docx_file), "-o", str(output), *options)
+    assert result.stdout.decode("utf-8").startswith("The converted file is saved as")
+    assert part_texts(output, "word/document.xml") == [UNICODE_TEXT, "English"]
+    # A file of another type
+    text_file = tmp_path / "input.txt"
+    text_file.write_text(PREETI_TEXT, encoding="utf-8")
+    result = run_cli("-m", "docx", "-if", "auto", "-i", str(text_file), "-o", str(output), *options)
+    assert "does not match the conversion mode" in result.stdout.decode("utf-8")
+
+
+def test_docx_coalesce_runs(tmp_path):
+    docx_file = tmp_path / "input.docx"
+    write_docx(str(docx_file), word_paragraph(word_run("g]k"), word_run("fn")))
+    output = tmp_path / "output.docx"
+    run_cli("-m", "docx", "-if", "auto", "-i", str(docx_file), "-o", str(output), "-cr")
+    assert part_texts(output, "word/document.xml") == ["नेपाल"]
+
+
+def test_conversion_cache(tmp_path):
+    text_file = tmp_path / "input.txt"
+    text_file.write_text(PREETI_TEXT, encoding="utf-8")
+    output = tmp_path / "output.txt"
+    arguments = ["-m", "plain", "-if", "Preeti", "-i", str(text_file), "-o", str(output),
+                 "-cc", str(tmp_path / "cache")]
+    assert b"Reused" not in run_cli(*arguments).stdout
+    output.unlink()
+    assert run_cli(*arguments).stdout.decode("utf-8").startswith("Reused the output of an earlier conversion")
+    assert output.read_text(encoding="utf-8") == UNICODE_TEXT
+
+
+def test_serve_command():
+    # "serve" hands the other arguments to the conversion daemon
+    result = run_cli("serve", "-h")
+    assert result.returncode == 0 and b"--max-body-size" in result.stdout
+    assert b'npttf2utf serve -h' in run_cli("-h").stdout
+
+
+def test_profile(tmp_path):
+    text_file = tmp_path / "input.txt"
+    text_file.write_text(PREETI_TEXT, encoding="utf-8")
+    profile = tmp_path / "conversion.prof"
+    result = run_cli("-m", "plain", "-if", "Preeti", "-i", str(text_file), "-o", "-", "--profile", str(profile))
+    assert result.stdout.decode("utf-8") == UNICODE_TEXT
+    assert b"The profile is saved as" in result.stderr
+    assert pstats.Stats(str(profile)).total_calls > 0
+    # Without a file the slowest functions are printed to stderr
+    result = run_cli("-m", "plain", "-if", "Preeti", "-i", str(text_file), "-o", "-", "--profile")
+    assert result.stdout.decode("utf-8") == UNICODE_TEXT
+    assert b"cumulative" in result.stderr
+
+
+def test_output_font(tmp_path):
+    # Any font of the mapping definition can be the output font
+    result = run_cli("-m", "string", "-if", "Preeti", "-of", "kantipur", "-i", PREETI_TEXT)
+    assert result.stdout.decode("utf-8").strip() == FontMapper(MAP_JSON).map_to_font(PREETI_TEXT, "Preeti",
+                                                                                      "Kantipur")
+    text_file = tmp_path / "input.txt"
+    text_file.write_text(PREETI_TEXT, encoding="utf-8")
+    result = run_cli("-m", "plain", "-if", "Preeti", "-of", "Unknown", "-i", str(text_file), "-o", "-")
+    assert "Cannot map to given output font" in result.stdout.decode("utf-8")
+
+
+def test_xlsx_mode(tmp_path):
+    xlsx_file = tmp_path / "input.xlsx"
+    write_xlsx(str(xlsx_file), ["<si><t>{}</t></si>".format(PREETI_TEXT)], [[(1, 0)]])
+    output = tmp_path / "output.xlsx"
+    result = run_cli("-m", "xlsx", "-if", "auto", "-i", str(xlsx_file), "-o", str(output))
+    assert result.stdout.decode("utf-8").startswith("The converted file is saved as")
+    with zipfile.ZipFile(output) as package:
+        assert UNICODE_TEXT.encode("utf-8") in package.read("xl/sharedStrings.xml")
+
+
+def test_html_mode(tmp_path):
+    # Read from stdin and written to stdout like plain text
+    page = '<p style="font-family: Preeti">{}</p><p>English</p>'.format(PREETI_TEXT)
+    result = run_cli("-m", "html", "-if", "auto", "-i", "-", "-o", "-", input=page.encode("utf-8"))
+    assert result.stdout.decode("utf-8") == '<p style="font-family: Kalimati">{}</p><p>English</p>'.format(
+        UNICODE_TEXT)
+
+
+def test_tabular_mode(tmp_path):
+    csv_file = tmp_path / "input.csv"
+    csv_file.write_text("id,name\n1,{}\n".format(PREETI_TEXT), encoding="utf-8")
+    result = run_cli("-m", "tabular", "-if", "Preeti", "-i", str(csv_file), "-o", "-", "-c", "name")
+    assert result.stdout.decode("utf-8") == "id,name\n1,{}\n".format(UNICODE_TEXT)
+    result = run_cli("-m", "tabular", "-if", "Preeti", "-i", str(csv_file), "-o", "-", "-c", "1", "-nh")
+    assert result.stdout.decode("utf-8") == "id,{}\n1,{}\n".format(FontMapper(MAP_JSON).map_to_unicode("name"),
+                                                                   UNICODE_TEXT)
+    # The columns are required
+    result = run_cli("-m", "tabular", "-if", "Preeti", "-i", str(csv_file), "-o", "-")
+    assert result.returncode == 2 and b"tabular mode needs the columns to map" in result.stderr
@@ -0,0 +1,131 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from npttf2utf import TxtHandler
+from npttf2utf.base.batchconverter import BatchConverter
+from npttf2utf.base.convcache import ConversionCache
+from npttf2utf.base.fontmapper import FontMapper
+
+PREETI_TEXT = "g]kfn ;/sf/"
+UNICODE_TEXT = "नेपाल सरकार"
+
+
+class CountingTxtHandler(TxtHandler):
+    # TxtHandler counting the conversions it really does
+
+    def __init__(self, rules_file):
+        super().__init__(rules_file)
+        self.conversions = 0
+
+    def map_fonts(self, *args, **kwargs):
+        self.conversions += 1
+        return super().map_fonts(*args, **kwargs)
+
+
+@pytest.fixture
+def text_file(tmp_path):
+    path = tmp_path / "input.txt"
+    path.write_text(PREETI_TEXT, encoding="utf-8")
+    return path
+
+
+def entries(cache):
+    return sorted(os.path.join(directory, name) for directory, _, files in os.walk(cache.directory) for name in files)
+
+
+def test_hit(tmp_path, text_file, map_json):
+    cache = ConversionCache(str(tmp_path / "cache"))
+    handler = CountingTxtHandler(map_json)
+    first, second = tmp_path / "first.txt", tmp_path / "second.txt"
+    assert cache.convert(handler, str(text_file), str(first), from_font="Preeti") is False
+    assert cache.convert(handler, str(text_file), str(second), from_font="Preeti") is True
+    assert handler.conversions == 1 and (cache.hits, cache.misses) == (1, 1)
+    assert second.read_text(encoding="utf-8") == first.read_text(encoding="utf-8") == UNICODE_TEXT
+    # Another process (a new cache object) finds the same entry
+    assert ConversionCache(str(tmp_path / "cache")).convert(handler, str(text_file), str(second),
+                                                            from_font="Preeti") is True
+    assert handler.conversions == 1
+
+
+def test_invalidation(tmp_path, text_file, map_json):
+    cache = ConversionCache(str(tmp_path / "cache"))
+    handler = CountingTxtHandler(map_json)
+    output = tmp_path / "output.txt"
+    cache.convert(handler, str(text_file), str(output), from_font="Preeti")
+    # Other options changing the output
+    assert cache.convert(handler, str(text_file), str(output), from_font="Kantipur") is False
+    assert cache.convert(handler, str(text_file), str(output), from_font="Preeti", to_font="Kantipur") is False
+    # Another input
+    text_file.write_text(PREETI_TEXT + "!", encoding="utf-8")
+    assert cache.convert(handler, str(text_file), str(output), from_font="Preeti") is False
+    assert output.read_text(encoding="utf-8") == UNICODE_TEXT + "१"
+    # Another mapping definition
+    with open(map_json, encoding="utf-8") as map_file:
+        rules = json.load(map_file)
+    rules["Preeti"]["rules"]["character-map"]["!"] = "!"
+    modified_map = tmp_path / "map.json"
+    modified_map.write_text(json.dumps(rules, ensure_ascii=False), encoding="utf-8")
+    modified_handler = CountingTxtHandler(FontMapper(str(modified_map)))
+    assert cache.convert(modified_handler, str(text_file), str(output), from_font="Preeti") is False
+    assert output.read_text(encoding="utf-8") == UNICODE_TEXT + "!"
+    assert handler.conversions == 4 and len(entries(cache)) == 5
+    # Nothing changed, the entry of the unmodified definition is found again
+    assert cache.convert(handler, str(text_file), str(output), from_font="Preeti") is True
+    assert output.read_text(encoding="utf-8") == UNICODE_TEXT + "१"
+
+
+def test_standard_streams_not_cached(tmp_path, text_file, map_json, capsys):
+    cache = ConversionCache(str(tmp_path / "cache"))
+    handler = CountingTxtHandler(map_json)
+    for _ in range(2):
+        assert cache.convert(handler, str(text_file), "-", from_font="Preeti") is False
+    assert capsys.readouterr().out == UNICODE_TEXT * 2
+    assert handler.conversions == 2 and entries(cache) == []
+
+
+def test_hardlink(tmp_path, text_file, map_json):
+    cache = ConversionCache(str(tmp_path / "cache"), hardlink=True)
+    handler = CountingTxtHandler(map_json)
+    first, second = tmp_path / "first.txt", tmp_path / "second.txt"
+    cache.convert(handler, str(text_file), str(first), from_font="Preeti")
+    assert cache.convert(handler, str(text_file), str(second), from_font="Preeti") is True
+    assert os.path.samefile(str(second), entries(cache)[0])
+
+
+def test_eviction(tmp_path, map_json):
+    # Once the entries take more than max_size bytes, the least recently used ones are removed
+    cache = ConversionCache(str(tmp_path / "cache"), max_size=5 * len(UNICODE_TEXT.encode("utf-8")))
+    handler = CountingTxtHandler(map_json)
+    output = tmp_path / "output.txt"
+    inputs = []
+    for number in range(3):
+        path = tmp_path / "input{}.txt".format(number)
+        path.write_text(PREETI_TEXT * 2 + "!" * number, encoding="utf-8")
+        stored = set(entries(cache))
+        cache.convert(handler, str(path), str(output), from_font="Preeti")
+        # Entries are used one second apart
+        for entry in set(entries(cache)) - stored:
+            os.utime(entry, (1000000 + number, 1000000 + number))
+        inputs.append(path)
+    assert len(entries(cache)) == 2
+    assert cache.convert(handler, str(inputs[2]), str(output), from_font="Preeti") is True
+    assert cache.convert(handler, str(inputs[1]), str(output), from_font="Preeti") is True
+    assert cache.convert(handler, str(inputs[0]), str(output), from_font="Preeti") is False
+
+
+def test_batch(tmp_path, map_json):
+    input_directory = tmp_path / "input"
+    input_directory.mkdir()
+    (input_directory / "a.txt").write_text(PREETI_TEXT, encoding="utf-8")
+    cache = ConversionCache(str(tmp_path / "cache"))
+    output = tmp_path / "output"
+    for cached in (False, True):
+        shutil.rmtree(str(output), ignore_errors=True)
+        assert BatchConverter(map_json, conversion_cache=cache).convert([str(input_directory)], str(output),
+                                                                        txt_from_font="Preeti") == (1, 0)
+        with open(str(output / "manifest.jsonl"), encoding="utf-8") as manifest:
+            assert json.loads(manifest.readline())["cached"] is cached
+        assert (output / "a.txt").read_text(encoding="utf-8") == UNICODE_TEXT
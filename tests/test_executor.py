@@ -0,0 +1,100 @@
+import asyncio
+import io
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import word_paragraph, word_run, write_docx
+from npttf2utf import DocxHandler, TxtHandler, configure_executor
+from npttf2utf.base.executor import get_executor, run_in_executor
+from npttf2utf.base.fontmapper import MAX_CACHED_LENGTH, FontMapper
+
+PREETI_TEXT = "g]kfn ;/sf/"
+UNICODE_TEXT = "नेपाल सरकार"
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    # Thread pool counting the work submitted to it
+
+    def __init__(self):
+        super().__init__(max_workers=2)
+        self.submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+@pytest.fixture
+def executor():
+    executor = CountingExecutor()
+    configure_executor(executor)
+    yield executor
+    # Back to a shared thread pool of the default size
+    configure_executor()
+    executor.shutdown()
+
+
+def test_amap_to_font(map_json, executor):
+    mapper = FontMapper(map_json)
+    long_text = " ".join([PREETI_TEXT] * (MAX_CACHED_LENGTH // len(PREETI_TEXT) + 1))
+
+    async def run():
+        # Short strings are mapped right away, long ones in the executor
+        assert await mapper.amap_to_unicode(PREETI_TEXT) == UNICODE_TEXT
+        assert executor.submitted == 0
+        assert await mapper.amap_to_unicode(long_text) == mapper.map_to_unicode(long_text)
+        assert await mapper.amap_to_preeti(long_text) == mapper.map_to_preeti(long_text)
+        assert executor.submitted == 2
+    asyncio.run(run())
+
+
+def test_handlers(tmp_path, map_json, executor):
+    docx_file = tmp_path / "input.docx"
+    write_docx(str(docx_file), word_paragraph(word_run(PREETI_TEXT)))
+    expected_docx = tmp_path / "expected.docx"
+    DocxHandler(map_json).map_fonts(str(docx_file), str(expected_docx))
+
+    async def run():
+        # Bytes in, bytes out when there is no output path
+        text = PREETI_TEXT.encode("utf-8")
+        assert await TxtHandler(map_json).amap_fonts(text, from_font="Preeti") == UNICODE_TEXT.encode("utf-8")
+        output = tmp_path / "output.txt"
+        await TxtHandler(map_json).amap_fonts(text, str(output), from_font="Preeti")
+        assert output.read_text(encoding="utf-8") == UNICODE_TEXT
+        return await DocxHandler(map_json).amap_fonts(docx_file.read_bytes())
+    mapped_docx = asyncio.run(run())
+    assert executor.submitted == 3
+    with zipfile.ZipFile(io.BytesIO(mapped_docx)) as mapped, zipfile.ZipFile(expected_docx) as expected:
+        assert mapped.read("word/document.xml") == expected.read("word/document.xml")
+
+
+def test_max_concurrency():
+    # Conversions beyond max_concurrency wait on the event loop instead of queueing in the executor
+    executor = ThreadPoolExecutor(max_workers=8)
+    configure_executor(executor, max_concurrency=2)
+    lock = threading.Lock()
+    running = []
+    most_running = []
+
+    def convert(number):
+        with lock:
+            running.append(number)
+            most_running.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(number)
+        return number
+
+    async def run():
+        return await asyncio.gather(*(run_in_executor(convert, number) for number in range(8)))
+    try:
+        assert asyncio.run(run()) == list(range(8))
+        assert get_executor() is executor
+    finally:
+        configure_executor()
+        executor.shutdown()
+    assert max(most_running) == 2
@@ -0,0 +1,78 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+from npttf2utf import DocxHandler, HtmlHandler, TxtHandler, XlsxHandler
+from npttf2utf.base.exceptions import MapFileNotFoundException
+from npttf2utf.base.fontmapper import FontMapper
+
+PREETI_TEXT = "g]kfn ;/sf/"
+
+
+@pytest.fixture
+def map_copy(tmp_path, map_json):
+    path = tmp_path / "map.json"
+    shutil.copyfile(map_json, str(path))
+    return path
+
+
+def test_shared_mapper(map_copy, monkeypatch):
+    mapper = FontMapper.get(str(map_copy))
+    # The same file, however it is named, gives the same mapper
+    monkeypatch.chdir(str(map_copy.parent))
+    assert FontMapper.get("map.json") is mapper
+    link = map_copy.parent / "link.json"
+    link.symlink_to(map_copy)
+    assert FontMapper.get(str(link)) is mapper
+    assert FontMapper.get(str(map_copy), cache_size=0) is not mapper
+    assert FontMapper.get(str(map_copy), cache_size=0).cache.maxsize == 0
+
+
+def test_shared_mapper_reloaded(map_copy):
+    mapper = FontMapper.get(str(map_copy))
+    stat = os.stat(str(map_copy))
+    os.utime(str(map_copy), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    reloaded = FontMapper.get(str(map_copy))
+    assert reloaded is not mapper
+    assert FontMapper.get(str(map_copy)) is reloaded
+
+
+def test_shared_mapper_missing_file(tmp_path):
+    with pytest.raises(MapFileNotFoundException):
+        FontMapper.get(str(tmp_path / "missing.json"))
+
+
+def test_handlers_share_mapper(map_copy):
+    mapper = FontMapper.get(str(map_copy))
+    for handler_class in (TxtHandler, DocxHandler, XlsxHandler, HtmlHandler):
+        assert handler_class(str(map_copy)).mapper is mapper
+    # A mapper can also be given directly
+    own_mapper = FontMapper(str(map_copy))
+    assert TxtHandler(own_mapper).mapper is own_mapper
+
+
+def test_shared_mapper_threads(map_copy):
+    # Threads getting the mapper at the same time get the same one, and map with it at the same time
+    mappers = []
+    results = []
+    barrier = threading.Barrier(8)
+
+    def run():
+        barrier.wait()
+        mapper = FontMapper.get(str(map_copy))
+        mappers.append(mapper)
+        results.extend(mapper.map_to_unicode("{} {}".format(PREETI_TEXT, number), font)
+                       for number in range(200) for font in ("Preeti", "Kantipur"))
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(mappers) == 8 and all(mapper is mappers[0] for mapper in mappers)
+    expected = FontMapper(str(map_copy), cache_size=0)
+    assert sorted(results) == sorted(expected.map_to_unicode("{} {}".format(PREETI_TEXT, number), font)
+                                     for number in range(200) for font in ("Preeti", "Kantipur")
+                                     for _ in range(8))
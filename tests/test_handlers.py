@@ -0,0 +1,307 @@
+import json
+import zipfile
+from xml.etree import ElementTree as ET
+
+import pytest
+
+import legacy_fontmapper
+from conftest import part_texts, word_paragraph, word_run, write_docx, write_xlsx
+from npttf2utf import DocxHandler, HtmlHandler, TabularHandler, TxtHandler, XlsxHandler
+from npttf2utf.base import textstream
+from npttf2utf.base.docxhandler import scan_run_fonts
+from npttf2utf.base.exceptions import NoMapForOriginException, TabularFileException
+
+PREETI_TEXT = "g]kfn ;/sf/"
+UNICODE_TEXT = "नेपाल सरकार"
+
+
+@pytest.fixture
+def text_file(tmp_path, all_rules):
+    lines = ["{} {}\n".format(PREETI_TEXT, number) for number in range(20000)] + ["k|b]z g+= !\r\n", "\n", "cGt"]
+    path = tmp_path / "input.txt"
+    path.write_text("".join(lines), encoding="utf-8", newline="")
+    return path
+
+
+def test_txt(tmp_path, text_file, map_json, all_rules):
+    output = tmp_path / "output.txt"
+    TxtHandler(map_json).map_fonts(str(text_file), str(output), from_font="Preeti")
+    with open(text_file, encoding="utf-8") as original:
+        expected = "".join(legacy_fontmapper.map_to_unicode(all_rules, line, "Preeti") for line in original)
+    assert output.read_text(encoding="utf-8") == expected
+
+
+def test_txt_parallel(tmp_path, text_file, map_json, monkeypatch):
+    sequential = tmp_path / "sequential.txt"
+    parallel = tmp_path / "parallel.txt"
+    TxtHandler(map_json).map_fonts(str(text_file), str(sequential), from_font="Preeti")
+    # Small chunks, so that the file is split between the workers
+    ranges = textstream.iter_line_aligned_ranges
+    monkeypatch.setattr("npttf2utf.base.txthandler.iter_line_aligned_ranges",
+                        lambda data: ranges(data, chunk_size=4096, max_line_size=8192))
+    TxtHandler(map_json).map_fonts(str(text_file), str(parallel), from_font="Preeti", jobs=2)
+    assert parallel.read_bytes() == sequential.read_bytes()
+
+
+def test_txt_missing_input(tmp_path, map_json):
+    output = tmp_path / "output.txt"
+    for jobs in (1, 2):
+        with pytest.raises(FileNotFoundError):
+            TxtHandler(map_json).map_fonts(str(tmp_path / "missing.txt"), str(output), jobs=jobs)
+    assert not output.exists()
+
+
+@pytest.fixture
+def docx_file(tmp_path):
+    textbox = ('<w:r><w:drawing><wp:anchor><a:graphic><a:graphicData><wps:wsp><wps:txbx><w:txbxContent>{}'
+               '</w:txbxContent></wps:txbx></wps:wsp></a:graphicData></a:graphic></wp:anchor></w:drawing></w:r>')
+    body = "".join([
+        word_paragraph(word_run(PREETI_TEXT), word_run("English", "Calibri")),
+        "<w:tbl><w:tr><w:tc>{}</w:tc></w:tr></w:tbl>".format(word_paragraph(word_run(PREETI_TEXT))),
+        word_paragraph(textbox.format(word_paragraph(word_run(PREETI_TEXT)))),
+        word_paragraph(word_run(UNICODE_TEXT, None)),
+    ] * 50)
+    paragraph = word_paragraph(word_run(PREETI_TEXT))
+    story_parts = {
+        "word/header1.xml": ("header", "<w:hdr {namespaces}>" + paragraph + "</w:hdr>"),
+        "word/footer1.xml": ("footer", "<w:ftr {namespaces}>" + paragraph + "</w:ftr>"),
+        "word/footnotes.xml": ("footnotes", '<w:footnotes {namespaces}><w:footnote w:id="1">' + paragraph +
+                               "</w:footnote></w:footnotes>"),
+        "word/endnotes.xml": ("endnotes", '<w:endnotes {namespaces}><w:endnote w:id="1">' + paragraph +
+                              "</w:endnote></w:endnotes>"),
+        "word/comments.xml": ("comments", '<w:comments {namespaces}><w:comment w:id="0">' + paragraph +
+                              "</w:comment></w:comments>"),
+    }
+    path = tmp_path / "input.docx"
+    write_docx(str(path), body, story_parts)
+    return path
+
+
+def test_docx_story_parts(tmp_path, docx_file, map_json):
+    output = tmp_path / "output.docx"
+    DocxHandler(map_json).map_fonts(str(docx_file), str(output), from_font="auto")
+    assert set(part_texts(output, "word/document.xml")) == {UNICODE_TEXT, "English"}
+    for name in ("word/header1.xml", "word/footer1.xml", "word/footnotes.xml", "word/endnotes.xml",
+                 "word/comments.xml"):
+        assert part_texts(output, name) == [UNICODE_TEXT], name
+    with zipfile.ZipFile(docx_file) as original, zipfile.ZipFile(output) as mapped:
+        assert mapped.namelist() == original.namelist()
+        assert mapped.read("word/media/image1.png") == original.read("word/media/image1.png")
+        assert mapped.testzip() is None
+
+
+@pytest.mark.parametrize("options", [{"low_memory": True}, {"jobs": 2}, {"low_memory": True, "jobs": 2}])
+def test_docx_same_output(tmp_path, docx_file, map_json, options):
+    # Low memory and parallel mapping write the same document as the default mode
+    expected = tmp_path / "expected.docx"
+    output = tmp_path / "output.docx"
+    DocxHandler(map_json).map_fonts(str(docx_file), str(expected), from_font="auto")
+    DocxHandler(map_json).map_fonts(str(docx_file), str(output), from_font="auto", **options)
+    with zipfile.ZipFile(expected) as first, zipfile.ZipFile(output) as second:
+        assert second.namelist() == first.namelist()
+        for name in first.namelist():
+            if name == "word/document.xml" and options.get("low_memory"):
+                # The root element keeps the namespace declarations of the input
+                document, streamed = first.read(name), second.read(name)
+                assert ET.canonicalize(streamed.decode("utf-8")) == ET.canonicalize(document.decode("utf-8"))
+                assert streamed[streamed.index(b"<w:body>"):] == document[document.index(b"<w:body>"):]
+            else:
+                assert second.read(name) == first.read(name), name
+
+
+def test_scan_run_fonts():
+    part = ('<w:document><w:r><w:rPr><w:rFonts w:ascii="Preeti" w:hAnsi="Preeti"/></w:rPr></w:r>'
+            "<x:rFonts x:ascii='A&amp;B' /><w:rFonts w:cs=\"Mangal\"/><w:rFonts w:ascii=\"Preeti\"/>"
+            '<w:rFonts\n w:ascii = "Kantipur"></w:rFonts><w:rFonts w:hAnsi="Calibri"/></w:document>').encode("utf-8")
+    expected = (["Preeti", "A&B", "Kantipur"], True)
+    assert scan_run_fonts([part]) == expected
+    # Tags cut between chunks are found all the same
+    for size in (1, 2, 7, 64):
+        assert scan_run_fonts(part[start:start + size] for start in range(0, len(part), size)) == expected
+    assert scan_run_fonts([b'<w:rFonts w:ascii="Calibri"/>']) == (["Calibri"], False)
+
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_docx_parts_without_legacy_fonts(tmp_path, map_json, low_memory):
+    # In auto mode parts in which the pre-scan finds no legacy font are copied byte for byte
+    docx_file = tmp_path / "input.docx"
+    paragraph = word_paragraph(word_run(PREETI_TEXT))
+    write_docx(str(docx_file), word_paragraph(word_run("English", "Calibri"), word_run(UNICODE_TEXT, "Kalimati")),
+               {"word/header1.xml": ("header", "<w:hdr  {namespaces}>" + paragraph + "</w:hdr>"),
+                "word/footer1.xml": ("footer", "<w:ftr  {namespaces}>" + word_paragraph(word_run("Page", "Arial")) +
+                                     "</w:ftr>")})
+    output = tmp_path / "output.docx"
+    DocxHandler(map_json).map_fonts(str(docx_file), str(output), from_font="auto", low_memory=low_memory)
+    with zipfile.ZipFile(docx_file) as original, zipfile.ZipFile(output) as mapped:
+        for name in ("word/document.xml", "word/footer1.xml"):
+            assert mapped.read(name) == original.read(name), name
+    assert part_texts(output, "word/header1.xml") == [UNICODE_TEXT]
+    # A document without any legacy font is copied as it is
+    unicode_file = tmp_path / "unicode.docx"
+    write_docx(str(unicode_file), word_paragraph(word_run(UNICODE_TEXT, "Kalimati")))
+    DocxHandler(map_json).map_fonts(str(unicode_file), str(output), from_font="auto", low_memory=low_memory)
+    with zipfile.ZipFile(unicode_file) as original, zipfile.ZipFile(output) as mapped:
+        assert [(info.filename, info.CRC) for info in mapped.infolist()] == \
+            [(info.filename, info.CRC) for info in original.infolist()]
+
+
+def test_docx_scan_reused(tmp_path, docx_file, map_json):
+    # Parts parsed by detect_used_fonts() are mapped by map_fonts() without being parsed again
+    handler = DocxHandler(map_json)
+    scan = handler.scan(str(docx_file))
+    assert handler.detect_used_fonts(scan) == ["Preeti"]
+    assert "word/document.xml" in scan.trees
+    expected = tmp_path / "expected.docx"
+    output = tmp_path / "output.docx"
+    DocxHandler(map_json).map_fonts(str(docx_file), str(expected), from_font="auto")
+    handler.map_fonts(str(docx_file), str(output), from_font="auto", scan=scan)
+    assert output.read_bytes() == expected.read_bytes()
+
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_docx_coalesce_runs(tmp_path, map_json, low_memory):
+    # A word split over runs with the same properties is mapped as a whole, runs with other properties or separated
+    # by something else than spell check marks are kept apart
+    paragraph = word_paragraph(word_run("g]k"), '<w:proofErr w:type="spellStart"/>', word_run("fn "),
+                               word_run(";/sf/"), word_run("English", "Calibri"), word_run("g]"), "<w:bookmarkStart/>",
+                               word_run("kfn"))
+    docx_file = tmp_path / "input.docx"
+    write_docx(str(docx_file), paragraph)
+    output = tmp_path / "output.docx"
+    DocxHandler(map_json).map_fonts(str(docx_file), str(output), from_font="auto", coalesce_runs=True,
+                                    low_memory=low_memory)
+    assert part_texts(output, "word/document.xml") == [UNICODE_TEXT, "English", "ने", "पाल"]
+    with zipfile.ZipFile(output) as package:
+        document = package.read("word/document.xml")
+    assert b"proofErr" not in document and b"bookmarkStart" in document
+    # Off by default, every run is mapped on its own
+    DocxHandler(map_json).map_fonts(str(docx_file), str(output), from_font="auto", low_memory=low_memory)
+    assert len(part_texts(output, "word/document.xml")) == 6
+
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_docx_failure_leaves_no_output(tmp_path, map_json, monkeypatch, low_memory):
+    # Without other story parts, document.xml is the first part mapped
+    docx_file = tmp_path / "input.docx"
+    write_docx(str(docx_file), word_paragraph(word_run(PREETI_TEXT)) * 10)
+    output = tmp_path / "output.docx"
+    with pytest.raises(NoMapForOriginException):
+        DocxHandler(map_json).map_fonts(str(docx_file), str(output), from_font="Unknown", low_memory=low_memory)
+    assert not output.exists()
+    # A failure while document.xml is being written to the output archive
+    handler = DocxHandler(map_json)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("mapping failed")
+    monkeypatch.setattr(handler.mapper, "map_to_unicode", fail)
+    with pytest.raises(RuntimeError):
+        handler.map_fonts(str(docx_file), str(output), from_font="Preeti", low_memory=low_memory)
+    assert not output.exists()
+
+
+def test_html(tmp_path, map_json):
+    original = tmp_path / "input.html"
+    original.write_text('<html><head><style>p {{ font-family: Preeti; }}</style><script>var x = "{0}";</script>'
+                        '</head><body><p style="font-family: Preeti">{0}</p><p>English &amp; more</p>'
+                        '<font face="Preeti">{0}<b>{0}</b></font></body></html>'.format(PREETI_TEXT),
+                        encoding="utf-8")
+    output = tmp_path / "output.html"
+    HtmlHandler(map_json).map_fonts(str(original), str(output), from_font="auto")
+    assert output.read_text(encoding="utf-8") == (
+        '<html><head><style>p {{ font-family: Preeti; }}</style><script>var x = "{0}";</script></head><body><p '
+        'style="font-family: Kalimati">{1}</p><p>English &amp; more</p><font face="Kalimati">{1}<b>{1}</b></font>'
+        '</body></html>'.format(PREETI_TEXT, UNICODE_TEXT))
+
+
+def test_html_font_names(tmp_path, map_json):
+    # CSS font names are matched ignoring case
+    original = tmp_path / "input.html"
+    original.write_text('<p style="font-family: PREETI, serif">{0}</p><font face="preeti">{0}</font>'.format(
+        PREETI_TEXT), encoding="utf-8")
+    output = tmp_path / "output.html"
+    HtmlHandler(map_json).map_fonts(str(original), str(output), from_font="auto")
+    assert output.read_text(encoding="utf-8") == \
+        '<p style="font-family: Kalimati, serif">{0}</p><font face="Kalimati">{0}</font>'.format(UNICODE_TEXT)
+    assert HtmlHandler(map_json).detect_used_fonts(str(original)) == ["Preeti"]
+
+
+def test_html_missing_input(tmp_path, map_json):
+    output = tmp_path / "output.html"
+    with pytest.raises(FileNotFoundError):
+        HtmlHandler(map_json).map_fonts(str(tmp_path / "missing.html"), str(output))
+    assert not output.exists()
+
+
+def xlsx_cell_strings(path):
+    # Text of the shared string of every cell of the first sheet, in order
+    namespace = {"s": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+    with zipfile.ZipFile(path) as package:
+        strings = ["".join(text.text for text in item.iterfind(".//s:t", namespace))
+                   for item in ET.fromstring(package.read("xl/sharedStrings.xml")).iterfind("s:si", namespace)]
+        cells = [int(value.text) for value in ET.fromstring(package.read("xl/worksheets/sheet1.xml")).iterfind(
+            ".//s:v", namespace)]
+    return [strings[index] for index in cells]
+
+
+def test_xlsx(tmp_path, map_json):
+    shared_strings = [
+        "<si><t>{}</t></si>".format(PREETI_TEXT),
+        "<si><t>English</t></si>",
+        '<si><r><rPr><rFont val="Preeti"/></rPr><t xml:space="preserve">{} </t></r><r><t>plain</t></r></si>'.format(
+            PREETI_TEXT),
+    ]
+    # The first string is used by a Preeti cell and a Calibri one, it is then kept for the Calibri cell
+    original = tmp_path / "input.xlsx"
+    write_xlsx(str(original), shared_strings, [[(1, 0), (0, 1), (0, 2)], [(0, 0)]])
+    output = tmp_path / "output.xlsx"
+    XlsxHandler(map_json).map_fonts(str(original), str(output), from_font="auto")
+    assert xlsx_cell_strings(output) == [UNICODE_TEXT, "English", UNICODE_TEXT + " plain", PREETI_TEXT]
+
+
+def test_xlsx_font_names(tmp_path, map_json):
+    # Font names are matched ignoring case in auto mode. Outside of auto mode every cell is mapped, including those
+    # whose font has no name or whose style is not defined
+    shared_strings = ["<si><t>{}</t></si>".format(PREETI_TEXT)] * 4
+    original = tmp_path / "input.xlsx"
+    write_xlsx(str(original), shared_strings, [[(0, 0), (1, 1), (2, 2), (7, 3)]], fonts=("Calibri", "preeti", None))
+    output = tmp_path / "output.xlsx"
+    XlsxHandler(map_json).map_fonts(str(original), str(output), from_font="auto")
+    assert xlsx_cell_strings(output) == [PREETI_TEXT, UNICODE_TEXT, PREETI_TEXT, PREETI_TEXT]
+    assert XlsxHandler(map_json).detect_used_fonts(str(original)) == ["Preeti"]
+    XlsxHandler(map_json).map_fonts(str(original), str(output), from_font="Preeti")
+    assert xlsx_cell_strings(output) == [UNICODE_TEXT] * 4
+
+
+def test_tabular_csv(tmp_path, map_json):
+    original = tmp_path / "input.csv"
+    original.write_bytes('id,name,note\r\n1,{0},"a\r\nb"\r\n2,"{0}, {0}",{0}\r\n'.format(PREETI_TEXT).encode("utf-8"))
+    output = tmp_path / "output.csv"
+    TabularHandler(map_json).map_fonts(str(original), str(output), components=["name"])
+    assert output.read_bytes() == 'id,name,note\n1,{0},"a\r\nb"\n2,"{0}, {0}",{1}\n'.format(
+        UNICODE_TEXT, PREETI_TEXT).encode("utf-8")
+    parallel = tmp_path / "parallel.csv"
+    TabularHandler(map_json).map_fonts(str(original), str(parallel), components=["1"], jobs=2)
+    assert parallel.read_bytes() == output.read_bytes()
+
+
+def test_tabular_unknown_column(tmp_path, map_json):
+    original = tmp_path / "input.csv"
+    original.write_text("id,name\n1,{}\n".format(PREETI_TEXT), encoding="utf-8")
+    output = tmp_path / "output.csv"
+    with pytest.raises(TabularFileException):
+        TabularHandler(map_json).map_fonts(str(original), str(output), components=["missing"])
+    assert not output.exists()
+
+
+def test_tabular_jsonl(tmp_path, map_json):
+    original = tmp_path / "input.jsonl"
+    lines = ['{{"id": 1.10, "name" : "{0}", "other": "{0}", "list": [1.0, 2]}}\n'.format(PREETI_TEXT),
+             '{"id": 2e3}\n', "\n", '{{"name": "{0}\\u0021", "name": "{0}"}}\n'.format(PREETI_TEXT), "[1, 2]\n"]
+    original.write_text("".join(lines), encoding="utf-8")
+    output = tmp_path / "output.jsonl"
+    TabularHandler(map_json).map_fonts(str(original), str(output), components=["name"])
+    mapped = output.read_text(encoding="utf-8").splitlines(True)
+    # Only the mapped values change, numbers and spacing are written back as they were read
+    assert mapped == [lines[0].replace('"name" : "{}"'.format(PREETI_TEXT), '"name" : "{}"'.format(UNICODE_TEXT))] + \
+        lines[1:3] + ['{{"name": "{0}\\u0021", "name": "{1}"}}\n'.format(PREETI_TEXT, UNICODE_TEXT), lines[4]]
+    assert [json.loads(line) for line in mapped if line.strip()][0]["name"] == UNICODE_TEXT
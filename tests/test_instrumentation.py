@@ -0,0 +1,87 @@
+import sys
+
+from conftest import word_paragraph, word_run, write_docx
+import npttf2utf
+from npttf2utf import DocxHandler, TxtHandler
+from npttf2utf.base import instrumentation
+from npttf2utf.base.fontmapper import FontMapper
+
+PREETI_TEXT = "g]kfn ;/sf/"
+UNICODE_TEXT = "नेपाल सरकार"
+
+
+def test_not_recording():
+    # Nothing is wrapped while no hook is registered
+    assert not instrumentation.recording
+    assert instrumentation.instrument(len, "stage") is len
+    items = [PREETI_TEXT]
+    assert instrumentation.instrument_iterator(items, "stage") is items
+    with instrumentation.timed("stage") as timer:
+        pass
+    assert timer.start is None
+
+
+def test_hooks():
+    calls = []
+    hook = lambda stage, seconds, chars: calls.append((stage, chars))
+    instrumentation.add_hook(hook)
+    try:
+        assert instrumentation.recording
+        assert instrumentation.instrument(len, "measured")(PREETI_TEXT) == len(PREETI_TEXT)
+        assert list(instrumentation.instrument_iterator(["ab", "cde"], "produced")) == ["ab", "cde"]
+        with instrumentation.timed("block") as timer:
+            timer.chars = 5
+        instrumentation.record("event")
+    finally:
+        instrumentation.remove_hook(hook)
+    assert not instrumentation.recording
+    assert calls == [("measured", len(PREETI_TEXT)), ("produced", 2), ("produced", 3), ("block", 5), ("event", 0)]
+
+
+def test_mapper_stages(map_json):
+    with instrumentation.collect() as stats:
+        mapper = FontMapper(map_json, compiled_cache=False)
+        for _ in range(3):
+            assert mapper.map_to_unicode(PREETI_TEXT, "Preeti") == UNICODE_TEXT
+    stages = stats.as_dict()
+    assert stages["mapper.cache_miss"] == {"calls": 1, "seconds": 0.0, "chars": len(PREETI_TEXT)}
+    assert stages["mapper.cache_hit"]["calls"] == 2
+    assert stages["mapper.load_definition"]["calls"] == stages["mapper.compile"]["calls"] == 1
+    # Only the string that was not cached went through the rules
+    assert stages["rules.pre"]["calls"] == stages["rules.character_map"]["calls"] == stages["rules.post"]["calls"] == 1
+    assert stages["rules.character_map"]["chars"] == len(PREETI_TEXT)
+
+
+def test_handler_stages(tmp_path, map_json):
+    text_file = tmp_path / "input.txt"
+    text_file.write_text((PREETI_TEXT + "\n") * 10, encoding="utf-8")
+    docx_file = tmp_path / "input.docx"
+    write_docx(str(docx_file), word_paragraph(word_run(PREETI_TEXT)))
+    with instrumentation.collect() as stats:
+        TxtHandler(map_json).map_fonts(str(text_file), str(tmp_path / "output.txt"), from_font="Preeti")
+        DocxHandler(map_json).map_fonts(str(docx_file), str(tmp_path / "output.docx"), from_font="auto")
+    stages = stats.as_dict()
+    for stage in ("txt.read", "txt.map", "txt.write"):
+        assert stages[stage]["chars"] == len(text_file.read_text(encoding="utf-8")), stage
+    for stage in ("docx.scan", "docx.parse", "docx.map", "docx.serialize", "docx.repack"):
+        assert stages[stage]["calls"] >= 1, stage
+    summary = stats.summary().splitlines()
+    assert summary[0].split() == ["stage", "calls", "seconds", "chars", "chars/s"]
+    assert sorted(line.split()[0] for line in summary[1:]) == sorted(stages)
+    assert not instrumentation.recording
+
+
+def test_stats_option(tmp_path, monkeypatch, capsys):
+    text_file = tmp_path / "input.txt"
+    text_file.write_text(PREETI_TEXT, encoding="utf-8")
+    output = tmp_path / "output.txt"
+    monkeypatch.setattr(sys, "argv", ["npttf2utf", "-m", "plain", "-if", "Preeti", "-i", str(text_file),
+                                      "-o", str(output), "--stats"])
+    try:
+        npttf2utf.main()
+    finally:
+        for hook in list(instrumentation._hooks):
+            instrumentation.remove_hook(hook)
+    assert output.read_text(encoding="utf-8") == UNICODE_TEXT
+    stages = [line.split()[0] for line in capsys.readouterr().err.splitlines()]
+    assert stages[0] == "stage" and "txt.map" in stages
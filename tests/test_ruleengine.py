@@ -0,0 +1,157 @@
+import glob
+import json
+import os
+import random
+import string
+
+import pytest
+
+import legacy_fontmapper
+import legacy_preetimapper
+from conftest import MAP_JSON
+from npttf2utf.base import preetimapper
+from npttf2utf.base.fontmapper import FontMapper
+from npttf2utf.base.fonttransform import FontTransform
+
+with open(MAP_JSON, encoding="utf-8") as _map_file:
+    FONTS = list(json.load(_map_file))
+
+# Whitespace the rules and the whole buffer mapping have to handle like the word by word mapping did, including the
+# separator of map_many() batches
+WHITESPACE = [" ", "  ", "\n", "\r\n", "\t", "\xa0", "\u2029", "\u3000"]
+FIXED_STRINGS = [
+    "",
+    " ",
+    "\n\n",
+    "g]kfn ;/sf/",
+    "k|b]z g+= !",
+    "sf7df8f} dxfgu/kflnsf",
+    "lj1fg tyf k|ljlw dGqfno",
+    "cfFvf 5f]K5",
+    "  leading and trailing  ",
+    "line one\nline two\r\n\ttabbed",
+    "नेपाल g]kfn mixed",
+    "!@#$%^&*()_+-=[]{};':\",./<>?\\|`~",
+    "1234567890 ! @ # $ % ^ & * ( )",
+    "xl/ em\"\\ /fd' l;+x ?\\f",
+    "If]q k|ltlglwTj ;+u7g",
+    "ljBfno M ^) ÷ !%",
+]
+
+
+def random_strings(all_rules, font, seed, count=300, max_length=40):
+    # Strings made of the characters of the font (its character map), other printable ASCII and whitespace
+    generator = random.Random("{}/{}".format(font, seed))
+    characters = [character for character in all_rules[font]["rules"]["character-map"] if len(character) == 1]
+    characters += list(string.ascii_letters + string.digits + string.punctuation)
+    strings = []
+    for _ in range(count):
+        pieces = []
+        for _ in range(generator.randint(0, max_length)):
+            if generator.random() < 0.15:
+                pieces.append(generator.choice(WHITESPACE))
+            else:
+                pieces.append(generator.choice(characters))
+        strings.append("".join(pieces))
+    return strings
+
+
+def random_unicode_strings(seed, count=2000, max_length=12):
+    # Devanagari text with the constructs the Preeti conversion treats specially (conjuncts, reph, i kar...)
+    generator = random.Random(seed)
+    alphabet = list(legacy_preetimapper.unicodeToPreetiDict) + list("िि्््ररर टठड।,﻿") + \
+        list("qSiHbwzTtjlf\\`0|«") + ["\n", "x", "Q", "ज्ञ"]
+    return ["".join(generator.choice(alphabet) for _ in range(generator.randint(0, max_length)))
+            for _ in range(count)]
+
+
+@pytest.fixture(scope="module")
+def mapper(map_json):
+    return FontMapper(map_json)
+
+
+@pytest.mark.parametrize("font", FONTS)
+def test_map_to_unicode_fixed_strings(mapper, all_rules, font):
+    for text in FIXED_STRINGS:
+        assert mapper.map_to_unicode(text, font) == legacy_fontmapper.map_to_unicode(all_rules, text, font), text
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("font", FONTS)
+def test_map_to_unicode_random_strings(mapper, all_rules, font, seed):
+    for text in random_strings(all_rules, font, seed):
+        assert mapper.map_to_unicode(text, font) == legacy_fontmapper.map_to_unicode(all_rules, text, font), text
+
+
+@pytest.mark.parametrize("font", FONTS)
+def test_map_to_unicode_long_text(mapper, all_rules, font):
+    # Long inputs are mapped as a whole buffer instead of token by token
+    text = "".join(random_strings(all_rules, font, "long", count=200))
+    assert mapper.map_to_unicode(text, font) == legacy_fontmapper.map_to_unicode(all_rules, text, font)
+
+
+@pytest.mark.parametrize("font", FONTS)
+def test_map_to_preeti(mapper, all_rules, font):
+    # Text of a font sharing the rules of Preeti is rewritten character by character instead of going through
+    # unicode, the result then means exactly what the original meant (where the old conversion could not keep "="
+    # apart from ".", for instance). Anything else is converted the way it always was
+    transform = mapper.get_font_transform(font, "Preeti") if font != "Preeti" else None
+    for text in FIXED_STRINGS + random_strings(all_rules, font, "preeti", count=100):
+        mapped = mapper.map_to_preeti(text, font)
+        if transform is not None and transform.supports(text):
+            assert legacy_fontmapper.map_to_unicode(all_rules, mapped, "Preeti") == \
+                legacy_fontmapper.map_to_unicode(all_rules, text, font), text
+        else:
+            assert mapped == legacy_fontmapper.map_to_preeti(all_rules, text, font), text
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_unicode_to_preeti(mapper, seed):
+    for text in random_unicode_strings(seed):
+        assert preetimapper.normalizeUnicode(text) == legacy_preetimapper.normalizeUnicode(text), text
+        expected = legacy_preetimapper.convert(text)
+        assert preetimapper.convert(text) == expected, text
+        assert mapper.map_to_preeti(text, "unicode") == expected, text
+
+
+@pytest.mark.parametrize("dedupe", [False, True])
+@pytest.mark.parametrize("font", FONTS)
+def test_map_many(mapper, all_rules, font, dedupe):
+    strings = random_strings(all_rules, font, "many", count=100)
+    # Repeated strings, and batches cut in the middle of them
+    strings = strings + strings[::3] + FIXED_STRINGS
+    expected = [legacy_fontmapper.map_to_unicode(all_rules, text, font) for text in strings]
+    assert list(mapper.map_many(strings, font, "unicode", dedupe=dedupe, batch_size=7)) == expected
+
+
+def test_compiled_cache(tmp_path, monkeypatch, map_json, all_rules):
+    # Rules loaded from the compiled map cache map exactly like freshly compiled ones, and the cache is plain JSON.
+    # The cache directory is not shared with the other tests, which also compile other mapping definitions
+    monkeypatch.setenv("NPTTF2UTF_CACHE_DIR", str(tmp_path))
+    compiled = FontMapper(map_json, cache_size=0, compiled_cache=False)
+    first = FontMapper(map_json, cache_size=0)
+    for font in FONTS:
+        first.get_rule_engine(font)
+    cached = FontMapper(map_json, cache_size=0)
+    cache_files = glob.glob(os.path.join(os.environ["NPTTF2UTF_CACHE_DIR"], "compiled-maps", "*"))
+    assert len(cache_files) == 1
+    with open(cache_files[0], encoding="utf-8") as cache_file:
+        assert set(json.load(cache_file)["engines"]) == set(FONTS)
+    for font in FONTS:
+        assert cached.get_rule_engine(font).rule_report() == compiled.get_rule_engine(font).rule_report()
+        for text in random_strings(all_rules, font, "cache", count=50):
+            assert cached.map_to_unicode(text, font) == compiled.map_to_unicode(text, font), text
+
+
+def test_font_transform_rules():
+    # Fonts differing only in their character maps get a transform, it is refused as soon as a font has pre-rules,
+    # even the same ones, or the post-rules differ
+    source = {"character-map": {"a": "क", "b": "ख"}, "pre-rules": [], "post-rules": [["क्ष", "x"]]}
+    target = {"character-map": {"b": "क", "c": "ख"}, "pre-rules": [], "post-rules": [["क्ष", "x"]]}
+    transform = FontTransform.compile("Source", source, "Target", target)
+    assert transform.supports("ab") and transform.map("ab a") == "bc b"
+    shared_pre_rules = [["aa", "b"]]
+    assert FontTransform.compile("Source", dict(source, **{"pre-rules": shared_pre_rules}), "Target",
+                                 dict(target, **{"pre-rules": shared_pre_rules})) is None
+    assert FontTransform.compile("Source", source, "Target", dict(target, **{"pre-rules": [["c", "b"]]})) is None
+    assert FontTransform.compile("Source", source, "Target", dict(target, **{"post-rules": []})) is None
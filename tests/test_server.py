@@ -0,0 +1,95 @@
+import asyncio
+import http.client
+import json
+import os
+import signal
+import socket
+import zipfile
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from conftest import word_paragraph, word_run, write_docx
+from npttf2utf.base.fontmapper import FontMapper
+from npttf2utf.server import ConversionServer, MAX_INLINE_STRING_SIZE
+
+PREETI_TEXT = "g]kfn ;/sf/"
+UNICODE_TEXT = "नेपाल सरकार"
+
+
+def request(address, method, path, body=b""):
+    url = urlsplit(address)
+    connection = http.client.HTTPConnection(url.hostname, url.port, timeout=60)
+    try:
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def raw_request(address, data):
+    # Send data as it is and return the status line of the response
+    url = urlsplit(address)
+    with socket.create_connection((url.hostname, url.port), timeout=60) as connection:
+        connection.sendall(data)
+        with connection.makefile("rb") as response:
+            return response.readline()
+
+
+def run_server(map_json, test, **options):
+    # Start a server on a free port, run test(address, server) in a thread and stop the server
+    async def run():
+        server = ConversionServer(map_json, jobs=1, **options)
+        await server.start(port=0)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, test, server.addresses()[0], server)
+        finally:
+            await server.close()
+    return asyncio.run(run())
+
+
+def test_server(tmp_path, map_json):
+    docx_file = tmp_path / "input.docx"
+    write_docx(str(docx_file), word_paragraph(word_run(PREETI_TEXT)))
+    long_text = " ".join([PREETI_TEXT] * (MAX_INLINE_STRING_SIZE // len(PREETI_TEXT)))
+
+    def test(address, server):
+        assert address.startswith("http://127.0.0.1:")
+        assert request(address, "POST", "/string?from_font=Preeti", PREETI_TEXT.encode("utf-8")) == \
+            (200, UNICODE_TEXT.encode("utf-8"))
+        # Long strings are mapped by the worker processes
+        assert request(address, "POST", "/string?from_font=Preeti&to_font=unicode", long_text.encode("utf-8")) == \
+            (200, FontMapper(map_json).map_to_unicode(long_text, "Preeti").encode("utf-8"))
+        assert request(address, "POST", "/plain", "{0}\n{0}\n".format(PREETI_TEXT).encode("utf-8")) == \
+            (200, "{0}\n{0}\n".format(UNICODE_TEXT).encode("utf-8"))
+        status, payload = request(address, "POST", "/docx", docx_file.read_bytes())
+        assert status == 200
+        with zipfile.ZipFile(BytesIO(payload)) as package:
+            assert UNICODE_TEXT in package.read("word/document.xml").decode("utf-8")
+        assert request(address, "POST", "/docx", b"not a docx")[0] == 400
+        assert request(address, "POST", "/string?from_font=Unknown", long_text.encode("utf-8"))[0] == 400
+        # The 413 response comes before the body is sent, and also reaches a client sending the whole body
+        assert raw_request(address, b"POST /string HTTP/1.1\r\nContent-Length: 2097152\r\n\r\n") == \
+            b"HTTP/1.1 413 Payload Too Large\r\n"
+        for _ in range(5):
+            assert request(address, "POST", "/string", b"x" * ((1 << 20) + 1))[0] == 413
+        assert request(address, "GET", "/string")[0] == 405
+        assert request(address, "GET", "/missing")[0] == 404
+        status, payload = request(address, "GET", "/health")
+        assert status == 200 and json.loads(payload)["queued"] == 0
+
+    run_server(map_json, test, max_body_size=1 << 20)
+
+
+def test_server_replaces_broken_pool(map_json):
+    def test(address, server):
+        executor = server.executor
+        for process in list(executor._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+        # The requests reaching the broken pool fail, the next ones get a new pool
+        statuses = [request(address, "POST", "/plain", PREETI_TEXT.encode("utf-8"))[0] for _ in range(3)]
+        assert server.executor is not executor
+        assert statuses[-1] == 200 and set(statuses) <= {200, 500}
+        assert request(address, "POST", "/plain", PREETI_TEXT.encode("utf-8")) == (200, UNICODE_TEXT.encode("utf-8"))
+
+    run_server(map_json, test)